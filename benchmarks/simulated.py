@@ -0,0 +1,318 @@
+"""A simulated Azure Container Registry for end-to-end benchmarks
+
+Both halves serve the same generated registry: `FakeAzCli` answers the az
+commands the bot runs, either in-process or as a fake `az` executable, and
+`SimulatedRegistry` serves the registry HTTP API. Manifests are generated
+from their index when they are listed, so the simulation itself holds
+almost nothing in memory. Only the standard library is used, so the fake
+`az` starts quickly.
+
+The fake `az` reads its settings from environment variables:
+
+    FAKE_AZ_REPOS          Number of repositories
+    FAKE_AZ_MANIFESTS      Manifests per repository
+    FAKE_AZ_LATENCY        Seconds each call takes
+    FAKE_AZ_THROTTLE       Fraction of calls rejected with a 429
+    FAKE_AZ_LOGIN_SERVER   Login server returned by `az acr login`
+    FAKE_AZ_CALLS          File to count calls in, one byte per call
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import datetime
+import threading
+from urllib.parse import parse_qs, urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# One in OLD_EVERY images is older than the default --max-age
+OLD_EVERY = 10
+SIZE_BYTES = 5 * 10**12
+
+
+class Simulation:
+    """The shape of a simulated registry
+
+    Args:
+        repos (int): Number of repositories
+        manifests (int): Manifests per repository
+        latency (float, optional): Seconds each call takes. Defaults to 0.
+        throttle (float, optional): Fraction of calls rejected with a 429.
+                                    Defaults to 0.
+    """
+
+    def __init__(
+        self,
+        repos: int,
+        manifests: int,
+        latency: float = 0.0,
+        throttle: float = 0.0,
+    ) -> None:
+        self.repos = repos
+        self.manifests = manifests
+        self.latency = latency
+        self.throttle = throttle
+        self.now = datetime.datetime.utcnow()
+
+    @classmethod
+    def from_env(cls) -> "Simulation":
+        return cls(
+            int(os.environ.get("FAKE_AZ_REPOS", 10)),
+            int(os.environ.get("FAKE_AZ_MANIFESTS", 100)),
+            float(os.environ.get("FAKE_AZ_LATENCY", 0)),
+            float(os.environ.get("FAKE_AZ_THROTTLE", 0)),
+        )
+
+    def env(self) -> dict:
+        """Environment variables describing this simulation to a fake az"""
+        return {
+            "FAKE_AZ_REPOS": str(self.repos),
+            "FAKE_AZ_MANIFESTS": str(self.manifests),
+            "FAKE_AZ_LATENCY": str(self.latency),
+            "FAKE_AZ_THROTTLE": str(self.throttle),
+        }
+
+    @property
+    def total(self) -> int:
+        return self.repos * self.manifests
+
+    def repo_names(self) -> list:
+        return ["binder/image-%05d" % i for i in range(self.repos)]
+
+    def manifest(self, repo: str, i: int) -> dict:
+        """Generate manifest i of a repository, like `--detail` output"""
+        age = 200 if i % OLD_EVERY == 0 else 1
+        timestamp = (self.now - datetime.timedelta(days=age)).strftime(
+            "%Y-%m-%dT%H:%M:%S.0000000Z"
+        )
+        return {
+            "digest": "sha256:%s%056x" % (repo[-5:].rjust(8, "0"), i),
+            "tags": ["v%d" % i],
+            "createdTime": timestamp,
+            "lastUpdateTime": timestamp,
+            "imageSize": 10**8,
+            "architecture": "amd64",
+            "os": "linux",
+            "mediaType": "application/vnd.docker.distribution.manifest.v2+json",
+        }
+
+    def manifests_of(self, repo: str):
+        return (self.manifest(repo, i) for i in range(self.manifests))
+
+    def throttled(self) -> bool:
+        return self.throttle > 0 and random.random() < self.throttle
+
+
+class FakeAzCli:
+    """Answers the az commands the bot runs from a Simulation
+
+    Works as the CLI factory of an AzWorkerPool, via `get_default_cli`, and
+    as the body of a fake `az` executable, via `main`.
+    """
+
+    def __init__(self, simulation: Simulation = None) -> None:
+        self.sim = simulation or Simulation.from_env()
+
+    def invoke(self, args: list, out_file=None) -> int:
+        out_file = out_file or sys.stdout
+        calls = os.environ.get("FAKE_AZ_CALLS")
+        if calls:
+            with open(calls, "a") as f:
+                f.write(".")
+
+        time.sleep(self.sim.latency)
+        if self.sim.throttled():
+            print(
+                "ERROR: (TooManyRequests) 429 Too Many Requests",
+                file=sys.stderr,
+            )
+            return 1
+
+        command = [arg for arg in args if not arg.startswith("-")]
+        options = dict(zip(args, args[1:]))
+
+        if command[:1] == ["login"]:
+            out_file.write("[]")
+        elif command[:2] == ["acr", "login"]:
+            if "--expose-token" in args:
+                out_file.write(
+                    json.dumps(
+                        {
+                            "accessToken": "token",
+                            "loginServer": os.environ.get(
+                                "FAKE_AZ_LOGIN_SERVER", "localhost"
+                            ),
+                        }
+                    )
+                )
+            else:
+                out_file.write("Login Succeeded")
+        elif command[:2] == ["acr", "show-usage"]:
+            out_file.write(str(SIZE_BYTES))
+        elif command[:3] == ["acr", "repository", "list"]:
+            out_file.write("\n".join(self.sim.repo_names()))
+        elif command[:3] == ["acr", "repository", "show-manifests"]:
+            json.dump(
+                list(self.sim.manifests_of(options["--repository"])),
+                out_file,
+            )
+        elif command[:3] == ["acr", "repository", "show"]:
+            json.dump(
+                {
+                    "lastUpdateTime": self.sim.now.isoformat(),
+                    "manifestCount": self.sim.manifests,
+                },
+                out_file,
+            )
+        elif command[:3] == ["acr", "repository", "delete"]:
+            pass
+        else:
+            print(
+                "ERROR: unknown command: %s" % " ".join(args), file=sys.stderr
+            )
+            return 2
+
+        return 0
+
+
+def get_default_cli() -> FakeAzCli:
+    return FakeAzCli()
+
+
+def main() -> int:
+    return FakeAzCli().invoke(sys.argv[1:])
+
+
+class SimulatedRegistryHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, code: int, body, headers: dict = None):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def serve(self, handler):
+        """Count a request, then throttle it or pass it to handler"""
+        registry = self.server.registry
+        with registry.lock:
+            registry.calls += 1
+            registry.in_flight += 1
+            busy = 0 < registry.max_in_flight < registry.in_flight
+
+        try:
+            time.sleep(registry.sim.latency)
+            if busy or registry.sim.throttled():
+                with registry.lock:
+                    registry.throttled += 1
+                self.send_json(
+                    429,
+                    {"errors": [{"code": "TOOMANYREQUESTS"}]},
+                    {"Retry-After": "0"},
+                )
+            else:
+                handler()
+        finally:
+            with registry.lock:
+                registry.in_flight -= 1
+
+    def page(self, items: list, path: str):
+        query = parse_qs(urlparse(self.path).query)
+        n = int(query.get("n", [1000])[0])
+        start = int(query.get("last", [-1])[0]) + 1
+        link = None
+        if start + n < len(items):
+            link = '<%s?last=%d&n=%d>; rel="next"' % (path, start + n - 1, n)
+        return items[start : start + n], link
+
+    def do_GET(self):
+        self.serve(self.get)
+
+    def do_DELETE(self):
+        self.serve(self.delete)
+
+    def get(self):
+        sim = self.server.registry.sim
+        path = urlparse(self.path).path
+
+        if path == "/v2/_catalog":
+            repos, link = self.page(sim.repo_names(), path)
+            self.send_json(
+                200, {"repositories": repos}, {"Link": link} if link else {}
+            )
+        elif path.endswith("/_manifests"):
+            repo = path[len("/acr/v1/") : -len("/_manifests")]
+            query = parse_qs(urlparse(self.path).query)
+            n = int(query.get("n", [1000])[0])
+            start = int(query.get("last", [-1])[0]) + 1
+            stop = min(start + n, sim.manifests)
+            link = None
+            if stop < sim.manifests:
+                link = '<%s?last=%d&n=%d>; rel="next"' % (path, stop - 1, n)
+            self.send_json(
+                200,
+                {
+                    "imageName": repo,
+                    "manifests": [
+                        sim.manifest(repo, i) for i in range(start, stop)
+                    ],
+                },
+                {"Link": link} if link else {},
+            )
+        else:
+            self.send_json(404, {"errors": [{"code": "NOT_FOUND"}]})
+
+    def delete(self):
+        self.send_response(202)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class SimulatedRegistry:
+    """Serves the registry HTTP API for a Simulation
+
+    Args:
+        simulation (Simulation): The registry to serve
+        max_in_flight (int, optional): Reject requests with a 429 while more
+                                       than this many are being served.
+                                       Defaults to no limit.
+    """
+
+    def __init__(self, simulation: Simulation, max_in_flight: int = 0):
+        self.sim = simulation
+        self.max_in_flight = max_in_flight
+        self.calls = 0
+        self.throttled = 0
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+        self.server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), SimulatedRegistryHandler
+        )
+        self.server.daemon_threads = True
+        self.server.registry = self
+        self.login_server = "127.0.0.1:%d" % self.server.server_port
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, args=(0.01,), daemon=True
+        )
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
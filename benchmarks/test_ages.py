@@ -0,0 +1,47 @@
+"""Benchmarks for computing image ages from manifest timestamps
+
+Run with: python -m pytest benchmarks/test_ages.py
+"""
+
+import pytest
+import datetime
+from docker_bot.app import compute_image_ages, pull_image_age
+
+NOW = datetime.datetime(2020, 8, 1, 9, 30)
+
+
+def make_manifests(n: int, n_repos: int = 100) -> list:
+    start = datetime.datetime(2019, 1, 1)
+    return [
+        {
+            "repo": "repo%d" % (i % n_repos),
+            "digest": "sha256:%064x" % i,
+            "timestamp": (start + datetime.timedelta(minutes=i)).strftime(
+                "%Y-%m-%dT%H:%M:%S.0000000Z"
+            ),
+        }
+        for i in range(n)
+    ]
+
+
+@pytest.mark.parametrize("n", [1000, 10000, 100000])
+def test_compute_image_ages(benchmark, n):
+    manifests = make_manifests(n)
+    benchmark.group = "compute-image-ages"
+
+    out = benchmark(compute_image_ages, manifests, now=NOW)
+
+    assert len(out) == n
+
+
+@pytest.mark.parametrize("n", [1000])
+def test_pull_image_age(benchmark, n):
+    manifests = make_manifests(n)
+    benchmark.group = "pull-image-age"
+
+    def age_one_by_one():
+        return [pull_image_age("test_acr", manifest) for manifest in manifests]
+
+    out = benchmark.pedantic(age_one_by_one, rounds=3)
+
+    assert len(out) == n
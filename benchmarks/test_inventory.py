@@ -0,0 +1,168 @@
+"""Benchmarks for building the image inventory DataFrame
+
+Run with: python -m pytest benchmarks/test_inventory.py
+"""
+
+import pytest
+import datetime
+import tracemalloc
+import numpy as np
+import pandas as pd
+from unittest.mock import patch
+from docker_bot.app import compute_image_ages, sort_image_df
+from docker_bot.inventory import ImageInventory, make_inventory
+
+
+class InventoryBuilder:
+    """Collect image information column by column and build one DataFrame
+
+    The inventory before ImageInventory, kept as a baseline to compare with.
+
+    Ages and repository codes are written into preallocated NumPy arrays
+    that double in size when they run out of room, so adding an image is
+    amortised O(1) instead of copying a whole DataFrame per row.
+
+    Args:
+        capacity (int, optional): Number of images to preallocate room for.
+                                  Defaults to 1024.
+    """
+
+    def __init__(self, capacity: int = 1024) -> None:
+        capacity = max(capacity, 1)
+        self._ages = np.empty(capacity, dtype=np.int32)
+        self._repo_codes = np.empty(capacity, dtype=np.int32)
+        self._digests = [None] * capacity
+        self._repos = {}
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _grow(self) -> None:
+        capacity = 2 * len(self._ages)
+        self._ages = np.resize(self._ages, capacity)
+        self._repo_codes = np.resize(self._repo_codes, capacity)
+        self._digests.extend([None] * (capacity - len(self._digests)))
+
+    def add(self, repo: str, digest: str, age_days: int) -> None:
+        """Add an image to the inventory
+
+        Args:
+            repo (str): Name of the repository the image is stored in
+            digest (str): Digest of the image manifest
+            age_days (int): Age of the image in days
+        """
+        if self._size == len(self._ages):
+            self._grow()
+
+        code = self._repos.setdefault(repo, len(self._repos))
+
+        self._ages[self._size] = age_days
+        self._repo_codes[self._size] = code
+        self._digests[self._size] = digest
+        self._size += 1
+
+    def build(self) -> "pd.DataFrame":
+        """Build a DataFrame of all the images added so far
+
+        Returns:
+            pd.DataFrame: One row per image with columns image_name
+                          (repo@digest), repo (categorical), digest (string),
+                          age_days (int32) and image_size (int64)
+        """
+        size = self._size
+        repo = pd.Categorical.from_codes(
+            self._repo_codes[:size], categories=list(self._repos)
+        )
+
+        return make_inventory(
+            repo, self._digests[:size], self._ages[:size].copy()
+        )
+
+
+def make_results(n: int, n_repos: int = 100) -> list:
+    return [
+        ("repo%d" % (i % n_repos), "sha256:%064x" % i, i % 365)
+        for i in range(n)
+    ]
+
+
+def build_inventory(results: list) -> pd.DataFrame:
+    builder = InventoryBuilder(capacity=len(results))
+    for repo, digest, age_days in results:
+        builder.add(repo, digest, age_days)
+    return builder.build()
+
+
+def build_row_by_row(results: list) -> pd.DataFrame:
+    """The previous approach: one DataFrame copy per image"""
+    image_df = pd.DataFrame(columns=["image_name", "age_days"])
+    for repo, digest, age_days in results:
+        row = pd.DataFrame(
+            {"image_name": [f"{repo}@{digest}"], "age_days": [age_days]}
+        )
+        image_df = pd.concat([image_df, row], ignore_index=True)
+    return image_df
+
+
+@pytest.mark.parametrize("n", [1000, 10000, 100000])
+def test_inventory_builder(benchmark, n):
+    results = make_results(n)
+    benchmark.group = "inventory-builder"
+
+    out = benchmark(build_inventory, results)
+
+    assert len(out) == n
+
+
+@pytest.mark.parametrize("n", [250, 500, 1000])
+def test_row_by_row(benchmark, n):
+    results = make_results(n)
+    benchmark.group = "row-by-row"
+
+    out = benchmark.pedantic(build_row_by_row, args=(results,), rounds=3)
+
+    assert len(out) == n
+
+
+def make_manifests(n: int, n_repos: int = 100) -> ImageInventory:
+    return ImageInventory.from_manifests(
+        {
+            "repo": "repo%d" % (i % n_repos),
+            "digest": "sha256:%064x" % i,
+            "timestamp": "2020-%02d-%02dT10:00:00.0000000Z"
+            % (i % 12 + 1, i % 28 + 1),
+            "imageSize": 1000 * i,
+        }
+        for i in range(n)
+    )
+
+
+def age_and_select(manifests: ImageInventory):
+    now = datetime.datetime(2021, 1, 1)
+    image_df = compute_image_ages(manifests, now=now)
+    selected = sort_image_df(image_df, 180)
+    return image_df, selected.sort_values("age_days", ascending=False)
+
+
+@pytest.mark.parametrize("backend", ["pandas", "array"])
+@pytest.mark.parametrize("n", [10000, 100000])
+def test_inventory_backend(benchmark, n, backend):
+    manifests = make_manifests(n)
+    benchmark.group = "inventory-backend-%d" % n
+
+    with patch("docker_bot.inventory.INVENTORY_BACKEND", backend):
+        tracemalloc.start()
+        held = age_and_select(manifests)
+        benchmark.extra_info["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del held
+
+        image_df, selected = benchmark(age_and_select, manifests)
+
+    assert len(image_df) == n
+    assert 0 < len(selected) < n
+    print(
+        "\n%s inventory of %d images: %.1f MB peak"
+        % (backend, n, benchmark.extra_info["peak_bytes"] / 1e6)
+    )
@@ -0,0 +1,63 @@
+"""Memory footprint of the manifests held between listing and ageing
+
+Run with: python -m pytest benchmarks/test_memory.py -s
+"""
+
+import pytest
+import tracemalloc
+from docker_bot.inventory import ImageInventory
+
+
+def make_manifest(i: int, n_repos: int = 100) -> dict:
+    # Shaped like the output of `az acr repository show-manifests --detail`
+    return {
+        "architecture": "amd64",
+        "changeableAttributes": {
+            "deleteEnabled": True,
+            "listEnabled": True,
+            "readEnabled": True,
+            "writeEnabled": True,
+        },
+        "configMediaType": "application/vnd.docker.container.image.v1+json",
+        "createdTime": "2020-07-30T19:56:00.0000000Z",
+        "digest": "sha256:%064x" % i,
+        "imageSize": 1000 * i,
+        "lastUpdateTime": "2020-07-30T19:56:00.0000000Z",
+        "mediaType": "application/vnd.docker.distribution.manifest.v2+json",
+        "os": "linux",
+        "tags": ["tag-%d" % i],
+        "timestamp": "2020-07-30T19:56:%02d.0000000Z" % (i % 60),
+        "repo": "binder-prod/r2d-g5b5b759-repo%d" % (i % n_repos),
+    }
+
+
+def bytes_per_manifest(collect, n: int) -> float:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    held = collect(make_manifest(i) for i in range(n))
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del held
+    return (after - before) / n
+
+
+@pytest.mark.parametrize("n", [10000, 100000])
+def test_manifest_footprint(benchmark, n):
+    benchmark.group = "manifest-footprint"
+
+    dicts = bytes_per_manifest(list, n)
+    records = bytes_per_manifest(ImageInventory.from_manifests, n)
+    benchmark.extra_info["dict_bytes_per_manifest"] = dicts
+    benchmark.extra_info["inventory_bytes_per_manifest"] = records
+    print(
+        "\n%d manifests: %.0f bytes each as dicts, %.0f bytes each in an "
+        "ImageInventory" % (n, dicts, records)
+    )
+
+    benchmark.pedantic(
+        ImageInventory.from_manifests,
+        args=([make_manifest(i) for i in range(n)],),
+        rounds=1,
+    )
+
+    assert records < dicts / 4
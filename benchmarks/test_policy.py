@@ -0,0 +1,90 @@
+"""Benchmarks for evaluating a retention policy over the image inventory
+
+Run with: python -m pytest benchmarks/test_policy.py
+"""
+
+import pytest
+import datetime
+import pandas as pd
+from unittest.mock import patch
+from docker_bot.app import compute_image_ages
+from docker_bot.policy import RetentionPolicy, RetentionRule
+
+TAGS = ["latest", "v1.%d", "main", "pr-%d", ""]
+
+
+def make_manifests(n: int, n_repos: int = 100) -> list:
+    now = datetime.datetime(2020, 8, 1)
+    manifests = []
+    for i in range(n):
+        timestamp = now - datetime.timedelta(days=i % 365)
+        tag = TAGS[i % len(TAGS)]
+        manifests.append(
+            {
+                "repo": ("releases/repo%d" if i % 2 else "ci/repo%d")
+                % (i % n_repos),
+                "digest": "sha256:%064x" % i,
+                "timestamp": timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "tags": [tag % i if "%" in tag else tag] if tag else [],
+            }
+        )
+    return manifests
+
+
+def make_policy() -> RetentionPolicy:
+    return RetentionPolicy(
+        90,
+        [
+            RetentionRule("ci", "ci/*", max_age=7, protect=["main"]),
+            RetentionRule(
+                "releases",
+                "releases/*",
+                max_age=365,
+                keep_last=10,
+                protect=["latest", "v*"],
+            ),
+        ],
+        protect=["latest"],
+    )
+
+
+def evaluate_repo_by_repo(policy: RetentionPolicy, image_df) -> pd.Series:
+    """Filtering the inventory once per repository"""
+    delete = pd.Series(False, index=image_df.index)
+    for repo in image_df["repo"].unique():
+        rule = policy.rules[policy.rule_index(repo)]
+        rows = image_df[image_df["repo"] == repo]
+        protected = (
+            rows["tags"].str.contains(rule.tag_pattern)
+            if rule.tag_pattern is not None
+            else False
+        )
+        newest = rows["age_days"].rank(method="first") <= rule.keep_last
+        delete[rows.index] = (
+            ~protected & ~newest & (rows["age_days"] >= rule.max_age)
+        )
+    return delete
+
+
+@pytest.mark.parametrize("backend", ["pandas", "array"])
+@pytest.mark.parametrize("n", [10000, 100000])
+def test_policy_evaluate(benchmark, backend, n):
+    with patch("docker_bot.inventory.INVENTORY_BACKEND", backend):
+        image_df = compute_image_ages(make_manifests(n))
+        benchmark.group = "policy-%d" % n
+
+        out = benchmark(make_policy().evaluate, image_df)
+
+    assert len(out) == n
+
+
+@pytest.mark.parametrize("n_repos", [100, 1000])
+def test_policy_repo_by_repo(benchmark, n_repos):
+    image_df = compute_image_ages(make_manifests(100000, n_repos))
+    policy = make_policy()
+    benchmark.group = "policy-repos-%d" % n_repos
+
+    out = benchmark(evaluate_repo_by_repo, policy, image_df)
+    bulk = policy.evaluate(image_df)["delete"]
+
+    assert out.tolist() == bulk.tolist()
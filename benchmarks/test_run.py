@@ -0,0 +1,166 @@
+"""End-to-end benchmarks of run() against a simulated registry
+
+Each benchmark runs the whole clean up, from logging in to re-checking the
+size, against a registry of 100 manifests per repository where one image in
+ten is old enough to delete. The az backend runs a fake `az` executable for
+every call, like the real CLI; `--az-workers` and the http backend are
+measured too.
+
+Run with: python -m pytest benchmarks/test_run.py
+"""
+
+import os
+import sys
+import stat
+import time
+import pytest
+import tracemalloc
+from functools import partial
+from unittest.mock import patch
+from docker_bot.app import run
+from docker_bot.azpool import AzWorkerPool
+from docker_bot.registry import RegistryClient
+from simulated import Simulation, SimulatedRegistry
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+MANIFESTS_PER_REPO = 100
+
+
+@pytest.fixture
+def fake_az(tmp_path, monkeypatch):
+    """Put a fake `az` executable first on the PATH
+
+    Returns a function that configures it for a Simulation and counts the
+    calls made to it.
+    """
+    az = tmp_path / "bin" / "az"
+    az.parent.mkdir()
+    az.write_text(
+        "#!%s\nimport sys\nsys.path.insert(0, %r)\n"
+        "from simulated import main\nsys.exit(main())\n"
+        % (sys.executable, BENCHMARKS)
+    )
+    az.chmod(az.stat().st_mode | stat.S_IEXEC)
+
+    calls = tmp_path / "calls"
+    monkeypatch.setenv(
+        "PATH", "%s%s%s" % (az.parent, os.pathsep, os.environ["PATH"])
+    )
+    monkeypatch.setenv("PYTHONPATH", BENCHMARKS)
+    monkeypatch.setenv("FAKE_AZ_CALLS", str(calls))
+
+    def configure(sim: Simulation, login_server: str = "localhost"):
+        for key, value in sim.env().items():
+            monkeypatch.setenv(key, value)
+        monkeypatch.setenv("FAKE_AZ_LOGIN_SERVER", login_server)
+        calls.write_text("")
+        return lambda: len(calls.read_text())
+
+    return configure
+
+
+def run_cleanup(backend: str, **kwargs) -> None:
+    # The simulated registry speaks plain HTTP
+    with patch(
+        "docker_bot.app.RegistryClient", partial(RegistryClient, scheme="http")
+    ):
+        run("simacr", 90, 2.0, backend=backend, **kwargs)
+
+
+def measure(benchmark, sim: Simulation, count_calls, func) -> None:
+    """Time one run of func and record its throughput"""
+
+    def timed():
+        start = time.perf_counter()
+        func()
+        return time.perf_counter() - start
+
+    elapsed = benchmark.pedantic(timed, rounds=1, iterations=1)
+    calls = count_calls()
+
+    benchmark.extra_info["manifests"] = sim.total
+    benchmark.extra_info["calls"] = calls
+    benchmark.extra_info["calls_per_second"] = calls / elapsed
+    benchmark.extra_info["manifests_per_second"] = sim.total / elapsed
+
+
+@pytest.mark.parametrize("n", [1000, 10000])
+def test_run_az(benchmark, fake_az, n):
+    sim = Simulation(n // MANIFESTS_PER_REPO, MANIFESTS_PER_REPO)
+    count_calls = fake_az(sim)
+    benchmark.group = "run-az"
+
+    measure(benchmark, sim, count_calls, lambda: run_cleanup("az"))
+
+
+@pytest.mark.parametrize("n", [1000, 10000, 100000])
+def test_run_az_workers(benchmark, fake_az, n):
+    sim = Simulation(n // MANIFESTS_PER_REPO, MANIFESTS_PER_REPO)
+    count_calls = fake_az(sim)
+    benchmark.group = "run-az-workers"
+
+    # Workers import the fake CLI instead of azure-cli
+    with patch(
+        "docker_bot.app.AzWorkerPool",
+        partial(AzWorkerPool, cli="simulated:get_default_cli"),
+    ):
+        measure(
+            benchmark,
+            sim,
+            count_calls,
+            lambda: run_cleanup("az", az_workers=8),
+        )
+
+
+@pytest.mark.parametrize("n", [1000, 10000, 100000])
+def test_run_http(benchmark, fake_az, n):
+    sim = Simulation(n // MANIFESTS_PER_REPO, MANIFESTS_PER_REPO)
+    benchmark.group = "run-http"
+
+    with SimulatedRegistry(sim) as registry:
+        fake_az(sim, registry.login_server)
+        measure(
+            benchmark,
+            sim,
+            lambda: registry.calls,
+            lambda: run_cleanup("http"),
+        )
+
+
+def test_run_http_throttled(benchmark, fake_az):
+    """A slow registry that rejects calls beyond 8 at once"""
+    sim = Simulation(100, MANIFESTS_PER_REPO, latency=0.005)
+    benchmark.group = "run-http-throttled"
+
+    with SimulatedRegistry(sim, max_in_flight=8) as registry:
+        fake_az(sim, registry.login_server)
+        measure(
+            benchmark,
+            sim,
+            lambda: registry.calls,
+            lambda: run_cleanup("http", list_threads=32, delete_threads=32),
+        )
+        benchmark.extra_info["throttled"] = registry.throttled
+
+
+@pytest.mark.parametrize("n", [10000, 100000])
+def test_run_peak_memory(benchmark, fake_az, n):
+    """Peak memory traced during a run, kept apart from the timings since
+    tracing slows everything down"""
+    sim = Simulation(n // MANIFESTS_PER_REPO, MANIFESTS_PER_REPO)
+    benchmark.group = "run-peak-memory"
+
+    def traced():
+        tracemalloc.start()
+        try:
+            run_cleanup("http")
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    with SimulatedRegistry(sim) as registry:
+        fake_az(sim, registry.login_server)
+        peak = benchmark.pedantic(traced, rounds=1, iterations=1)
+
+    benchmark.extra_info["peak_bytes"] = peak
+    benchmark.extra_info["peak_bytes_per_manifest"] = peak / n
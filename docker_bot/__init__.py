@@ -1,14 +1,73 @@
-from .cli import parse_args, check_parser
-from .helper_functions import run_cmd
-
-from .app import (
-    check_acr_size,
-    delete_image,
-    login,
-    pull_repos,
-    pull_manifests,
-    pull_image_age,
-    purge_all,
-    sort_image_df,
-    run,
-)
+from importlib import import_module
+
+# Most of the package imports pandas, which takes far longer than parsing
+# the command line, so every name is only imported from its module the
+# first time it is used
+_EXPORTS = {
+    "parse_args": "cli",
+    "check_parser": "cli",
+    "run_cmd": "helper_functions",
+    "RegistryClient": "registry",
+    "TokenCache": "credentials",
+    "bulk_delete": "deletion",
+    "run_deletions": "deletion",
+    "DeletionJournal": "journal",
+    "RunMetrics": "metrics",
+    "collect_metrics": "metrics",
+    "ConcurrencyController": "throttle",
+    "UsageMonitor": "usage",
+    "ThrottledError": "throttle",
+    "LayerIndex": "layers",
+    "build_layer_index": "layers",
+    "plan_to_limit": "planner",
+    "plan_with_layers": "planner",
+    "CachingBackend": "cache",
+    "ManifestCache": "cache",
+    "ImageInventory": "inventory",
+    "ImageRecord": "inventory",
+    "ImageTable": "table",
+    "AzCliBackend": "app",
+    "RegistryBackend": "app",
+    "azure_login": "app",
+    "check_acr_size": "app",
+    "compute_image_ages": "app",
+    "delete_image": "app",
+    "delete_repo": "app",
+    "get_backend": "app",
+    "list_images": "app",
+    "login": "app",
+    "pull_manifest_body": "app",
+    "pull_repo_metadata": "app",
+    "pull_repos": "app",
+    "pull_manifests": "app",
+    "pull_image_age": "app",
+    "purge_all": "app",
+    "resume_deletions": "app",
+    "select_images": "app",
+    "sort_image_df": "app",
+    "run": "app",
+    "run_async": "pipeline",
+    "stream_cleanup": "pipeline",
+    "load_registries": "multi",
+    "run_many": "multi",
+    "merge_reports": "sharding",
+    "shard_repos": "sharding",
+    "RetentionPolicy": "policy",
+    "RetentionRule": "policy",
+    "load_policy": "policy",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = getattr(import_module(f".{_EXPORTS[name]}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
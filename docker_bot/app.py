@@ -1,24 +1,79 @@
-import sys
+from __future__ import annotations
+
+import re
 import json
 import logging
 import datetime
-import pandas as pd
-from typing import Tuple
-from .helper_functions import run_cmd
+from array import array
+from collections import Counter
+from functools import partial
+from typing import Optional, Tuple
+from .azpool import AzWorkerPool
+from .defaults import AGE_MODES, DELETE_THREADS, LIST_THREADS
+from .helper_functions import run_cmd, set_az_pool, stream_cmd
+from .metrics import instrument, record_reclaimed, watch_controller
+from .registry import RegistryClient
+from .inventory import (
+    ImageInventory,
+    make_inventory,
+    require_pandas,
+    use_pandas,
+)
+from .table import ImageTable
+from .deletion import bulk_delete, run_deletions
+from .journal import DeletionJournal
+from .sharding import shard_repos
+from .policy import RetentionPolicy, apply_policy
+from .usage import UsageMonitor
+from .credentials import (
+    REFRESH_TOKEN_MARGIN,
+    REFRESH_TOKEN_TTL,
+    TokenCache,
+    token_expiry,
+)
+from .layers import build_layer_index
+from .cache import CachingBackend, ManifestCache
+from .throttle import ConcurrencyController
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:
+    np = pd = None
+
 logger = logging.getLogger()
 
+# Seconds to let an az listing run before killing it
+LIST_TIMEOUT = 600
 
-def login(acr_name: str, identity: bool = False) -> None:
-    """Login to Azure and the specified Container Registry
+# Seconds to let any other az command run before killing it
+AZ_TIMEOUT = 120
+
+# How the Azure CLI reports that its own login is missing or has expired
+AZ_LOGIN_NEEDED = re.compile(
+    r"az login|\b(?:401|403)\b|unauthori[sz]ed|forbidden|AADSTS\d+|expired",
+    re.IGNORECASE,
+)
+
+# pandas >= 2.0 infers a single format from the first timestamp it parses,
+# but ACR doesn't always print the same number of fractional seconds
+TIMESTAMP_FORMAT = (
+    "ISO8601"
+    if pd is not None and int(pd.__version__.split(".")[0]) >= 2
+    else None
+)
+
+ONE_DAY = datetime.timedelta(days=1)
+
+
+def azure_login(identity: bool = False) -> None:
+    """Login to Azure
 
     Args:
-        acr_name (str): The ACR to be accessed
         identity (bool, optional): Login to Azure using a Managed Identity.
                                    Defaults to False.
     """
-    # Login to Azure
     login_cmd = ["az", "login"]
 
     if identity:
@@ -27,7 +82,8 @@ def login(acr_name: str, identity: bool = False) -> None:
     else:
         logger.info("Logging into Azure interactively")
 
-    result = run_cmd(login_cmd)
+    # Interactive logins wait for the user for as long as they take
+    result = run_cmd(login_cmd, timeout=AZ_TIMEOUT if identity else None)
 
     if result["returncode"] != 0:
         logger.error(result["err_msg"])
@@ -35,11 +91,49 @@ def login(acr_name: str, identity: bool = False) -> None:
 
     logger.info("Successfully logged into Azure")
 
+
+def login(
+    acr_name: str,
+    identity: bool = False,
+    expose_token: bool = False,
+    azure: bool = True,
+) -> Optional[dict]:
+    """Login to Azure and the specified Container Registry
+
+    Args:
+        acr_name (str): The ACR to be accessed
+        identity (bool, optional): Login to Azure using a Managed Identity.
+                                   Defaults to False.
+        expose_token (bool, optional): Return an ACR refresh token instead of
+                                       logging the Docker daemon into the ACR.
+                                       Defaults to False.
+        azure (bool, optional): Login to Azure before the ACR. Set to False
+                                when the process is already logged in.
+                                Defaults to True.
+
+    Returns:
+        dict: The accessToken and loginServer of the ACR if expose_token is
+              True, otherwise None
+    """
+    if azure:
+        azure_login(identity=identity)
+
     # Login to ACR
     logger.info("Logging into ACR: %s" % acr_name)
     acr_cmd = ["az", "acr", "login", "-n", acr_name]
 
-    result = run_cmd(acr_cmd)
+    if expose_token:
+        acr_cmd.extend(["--expose-token", "-o", "json"])
+
+    result = run_cmd(acr_cmd, timeout=AZ_TIMEOUT)
+
+    if expose_token:
+        if result["returncode"] != 0:
+            logger.error(result["err_msg"])
+            raise RuntimeError(result["err_msg"])
+
+        logger.info("Successfully retrieved ACR token")
+        return json.loads(result["output"])
 
     if "login succeeded" in result["output"].lower():
         logger.info("Successfully logged into ACR")
@@ -73,7 +167,7 @@ def check_acr_size(acr_name: str, limit: float) -> Tuple[float, bool]:
         "-o",
         "tsv",
     ]
-    result = run_cmd(size_cmd)
+    result = run_cmd(size_cmd, timeout=AZ_TIMEOUT)
 
     if result["returncode"] != 0:
         logging.error(result["err_msg"])
@@ -104,7 +198,7 @@ def pull_repos(acr_name: str) -> list:
     logger.info("Pulling repositories in: %s" % acr_name)
     list_cmd = ["az", "acr", "repository", "list", "-n", acr_name, "-o", "tsv"]
 
-    result = run_cmd(list_cmd)
+    result = run_cmd(list_cmd, timeout=LIST_TIMEOUT)
 
     if result["returncode"] != 0:
         logger.error(result["err_msg"])
@@ -117,12 +211,14 @@ def pull_repos(acr_name: str) -> list:
     return repos
 
 
-def pull_manifests(acr_name: str, repo: str) -> dict:
+def pull_manifests(acr_name: str, repo: str, detail: bool = False) -> dict:
     """Return image manifests for a repository in an Azure Container Registry
 
     Args:
         acr_name (str): Name of the ACR
         repo (str): Name of the repository
+        detail (bool, optional): Include the size and other attributes of
+                                 each image. Defaults to False.
 
     Returns:
         dict: The image manifests
@@ -139,7 +235,10 @@ def pull_manifests(acr_name: str, repo: str) -> dict:
         repo,
     ]
 
-    result = run_cmd(show_cmd)
+    if detail:
+        show_cmd.append("--detail")
+
+    result = run_cmd(show_cmd, timeout=LIST_TIMEOUT)
 
     if result["returncode"] != 0:
         logger.error(result["err_msg"])
@@ -151,10 +250,208 @@ def pull_manifests(acr_name: str, repo: str) -> dict:
 
     for manifest in manifests:
         manifest["repo"] = repo
+        # Detailed manifests don't have a timestamp, only lastUpdateTime
+        if "timestamp" not in manifest:
+            manifest["timestamp"] = manifest.get("lastUpdateTime")
 
     return manifests
 
 
+def iter_manifests(
+    acr_name: str, repo: str, page_size: int = 1000, oldest_first: bool = False
+):
+    """Yield the image manifests for a repository in an Azure Container
+    Registry
+
+    The Azure CLI can't continue a listing from a given manifest, so the
+    whole listing comes from one call. Its output is parsed as it arrives
+    and each manifest is reduced to a compact record as soon as it has been
+    read, so the full listing is never held in memory. A call still running
+    after LIST_TIMEOUT seconds, or when the caller stops iterating, is
+    killed.
+
+    Args:
+        acr_name (str): Name of the ACR
+        repo (str): Name of the repository
+        page_size (int, optional): Unused by the Azure CLI. Defaults to 1000.
+        oldest_first (bool, optional): Have the registry order the manifests
+                                       by time, oldest first. Defaults to
+                                       False.
+
+    Yields:
+        dict: An image manifest with digest, tags, timestamp, imageSize and
+              repo keys
+    """
+    logger.info("Pulling manifests for: %s" % repo)
+    show_cmd = [
+        "az",
+        "acr",
+        "repository",
+        "show-manifests",
+        "-n",
+        acr_name,
+        "--repository",
+        repo,
+        "--detail",
+    ]
+
+    if oldest_first:
+        show_cmd.extend(["--orderby", "time_asc"])
+
+    for manifest in stream_cmd(show_cmd, timeout=LIST_TIMEOUT):
+        yield {
+            "digest": manifest["digest"],
+            "tags": manifest.get("tags") or [],
+            # Detailed manifests only have lastUpdateTime
+            "timestamp": manifest.get(
+                "timestamp", manifest.get("lastUpdateTime")
+            ),
+            "imageSize": manifest.get("imageSize", 0),
+            "repo": repo,
+        }
+
+
+def pull_repo_metadata(acr_name: str, repo: str) -> dict:
+    """Return the attributes of a repository in an Azure Container Registry
+
+    Args:
+        acr_name (str): Name of the ACR
+        repo (str): Name of the repository
+
+    Returns:
+        dict: The repository attributes, including lastUpdateTime and
+              manifestCount
+    """
+    logger.info("Pulling metadata for: %s" % repo)
+    show_cmd = [
+        "az",
+        "acr",
+        "repository",
+        "show",
+        "-n",
+        acr_name,
+        "--repository",
+        repo,
+    ]
+
+    result = run_cmd(show_cmd, timeout=AZ_TIMEOUT)
+
+    if result["returncode"] != 0:
+        logger.error(result["err_msg"])
+        raise RuntimeError(result["err_msg"])
+
+    return json.loads(result["output"])
+
+
+def pull_manifest_body(acr_name: str, image_name: str) -> dict:
+    """Return the body of an image manifest in an Azure Container Registry,
+    listing its config and layer blobs
+
+    Args:
+        acr_name (str): Name of the ACR
+        image_name (str): The image -> repo@digest
+
+    Returns:
+        dict: The image manifest
+    """
+    logger.info("Pulling manifest for: %s" % image_name)
+    show_cmd = [
+        "az",
+        "acr",
+        "manifest",
+        "show",
+        "--registry",
+        acr_name,
+        "--name",
+        image_name,
+    ]
+
+    result = run_cmd(show_cmd, timeout=AZ_TIMEOUT)
+
+    if result["returncode"] != 0:
+        logger.error(result["err_msg"])
+        raise RuntimeError(result["err_msg"])
+
+    return json.loads(result["output"])
+
+
+def _age_in_days(timestamps: list, now: Optional[datetime.datetime]):
+    """Parse manifest timestamps in one go and return their ages in days"""
+    if now is None:
+        now = datetime.datetime.now()
+
+    if not use_pandas():
+        return _age_in_days_without_pandas(timestamps, now)
+
+    now = pd.Timestamp(now)
+    if now.tzinfo is not None:
+        now = now.tz_convert(None)
+
+    timestamps = pd.to_datetime(
+        timestamps, utc=True, format=TIMESTAMP_FORMAT
+    ).tz_convert(None)
+
+    return (now.to_datetime64() - timestamps.values) // np.timedelta64(1, "D")
+
+
+def _age_in_days_without_pandas(timestamps: list, now: datetime.datetime):
+    """Return the ages in days of manifest timestamps, parsed one by one
+
+    ACR timestamps are in UTC and only read to the second, which can't
+    change an age in whole days unless it is within a second of a day.
+    """
+    if now.tzinfo is not None:
+        now = now.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    parse = datetime.datetime.fromisoformat
+    return array(
+        "i",
+        ((now - parse(timestamp[:19])) // ONE_DAY for timestamp in timestamps),
+    )
+
+
+@instrument("compute_image_ages")
+def compute_image_ages(
+    manifests,
+    now: Optional[datetime.datetime] = None,
+    keep_tags: bool = True,
+) -> pd.DataFrame:
+    """Get the ages of a set of images in an Azure Container Registry
+
+    With pandas, all the manifest timestamps are parsed in one call to
+    pd.to_datetime and the ages are computed as a single NumPy array
+    operation. Without it, the inventory is an ImageTable.
+
+    Args:
+        manifests (ImageInventory or list): The images to age, or a list of
+                                            image manifests each with repo,
+                                            digest and timestamp keys
+        now (datetime.datetime, optional): The time to measure ages from.
+                                           Defaults to the current time.
+        keep_tags (bool, optional): Keep the tags of a list of manifests.
+                                    An ImageInventory keeps its own.
+                                    Defaults to True.
+
+    Returns:
+        pd.DataFrame: The image inventory with columns image_name, repo,
+                      digest, age_days and image_size
+    """
+    if not isinstance(manifests, ImageInventory):
+        manifests = ImageInventory.from_manifests(manifests, keep_tags)
+
+    age_days = _age_in_days(manifests.timestamps, now)
+
+    return make_inventory(
+        manifests.repo,
+        manifests.digests,
+        age_days,
+        manifests.sizes,
+        manifests.tags,
+        manifests.timestamps,
+    )
+
+
+@instrument("pull_image_age")
 def pull_image_age(acr_name: str, manifest: dict) -> Tuple[str, int]:
     """Get the age of an image in an Azure Container Registry
 
@@ -166,9 +463,7 @@ def pull_image_age(acr_name: str, manifest: dict) -> Tuple[str, int]:
         image_name (str): Name of the image -> repo@digest
         age_days (int): Age of the image in days
     """
-    # Get the time difference between now and the manifest timestamp in days
-    timestamp = pd.to_datetime(manifest["timestamp"]).tz_localize(None)
-    diff = (datetime.datetime.now() - timestamp).days
+    diff = int(_age_in_days([manifest["timestamp"]], None)[0])
     logger.info(
         "%s@%s is %d days old" % (manifest["repo"], manifest["digest"], diff)
     )
@@ -197,6 +492,56 @@ def sort_image_df(image_df: pd.DataFrame, max_age: int) -> pd.DataFrame:
     return image_df.reset_index(drop=True)
 
 
+def age_cutoff(max_age: int, now: Optional[datetime.datetime] = None) -> str:
+    """The timestamp before which images may be older than max_age days
+
+    A day of slack is added so that no image `sort_image_df` would select
+    is left out, whatever timezone the ages are measured in.
+
+    Args:
+        max_age (int): The maximum image age in days
+        now (datetime.datetime, optional): The UTC time to measure ages
+                                           from. Defaults to the current
+                                           time.
+
+    Returns:
+        str: The cutoff as an ISO 8601 timestamp, to the second
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    cutoff = now - datetime.timedelta(days=max_age - 1)
+    return cutoff.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def take_older(manifests, older_than: str) -> Tuple[list, bool]:
+    """Take manifests from an oldest-first listing up to a cutoff
+
+    The listing is closed at the first manifest newer than the cutoff, so
+    no further pages of it are fetched.
+
+    Args:
+        manifests (Iterator): Manifests ordered by timestamp, oldest first
+        older_than (str): ISO 8601 timestamp of the cutoff
+
+    Returns:
+        manifests (list): The manifests up to the cutoff
+        complete (bool): Whether the whole listing was read
+    """
+    older = []
+
+    try:
+        for manifest in manifests:
+            if manifest["timestamp"][:19] > older_than[:19]:
+                return older, False
+            older.append(manifest)
+    finally:
+        if hasattr(manifests, "close"):
+            manifests.close()
+
+    return older, True
+
+
 def delete_image(acr_name: str, image_name: str) -> None:
     """Delete an image in an Azure Container Regsitry
 
@@ -218,7 +563,7 @@ def delete_image(acr_name: str, image_name: str) -> None:
         "--yes",
     ]
 
-    result = run_cmd(del_cmd)
+    result = run_cmd(del_cmd, timeout=AZ_TIMEOUT)
 
     if result["returncode"] != 0:
         logger.error(result["err_msg"])
@@ -227,153 +572,938 @@ def delete_image(acr_name: str, image_name: str) -> None:
     logger.info("Successfully deleted image")
 
 
-def purge_all(acr_name: str, df: pd.DataFrame) -> None:
+def delete_repo(acr_name: str, repo: str) -> None:
+    """Delete a repository, and all the images in it, from an Azure Container
+    Registry
+
+    Args:
+        acr_name (str): Name of the ACR
+        repo (str): Repository to be deleted
+    """
+    logger.info("Deleting repository: %s" % repo)
+
+    del_cmd = [
+        "az",
+        "acr",
+        "repository",
+        "delete",
+        "-n",
+        acr_name,
+        "--repository",
+        repo,
+        "--yes",
+    ]
+
+    # Deleting a repository deletes all its images, which can take as
+    # long as listing them
+    result = run_cmd(del_cmd, timeout=LIST_TIMEOUT)
+
+    if result["returncode"] != 0:
+        logger.error(result["err_msg"])
+        raise RuntimeError(result["err_msg"])
+
+    logger.info("Successfully deleted repository")
+
+
+def purge_all(
+    acr_name: str,
+    df: pd.DataFrame,
+    registry=None,
+    workers: int = 1,
+    controller: Optional[ConcurrencyController] = None,
+    journal: Optional[DeletionJournal] = None,
+    time_limit: Optional[float] = None,
+) -> int:
     """Purge all images from an Azure Container Registry
 
     Args:
         acr_name (str): The name of the ACR to purge
         df (pd.DataFrame): A DataFrame containing images stored in the ACR
+        registry (AzCliBackend, optional): The backend to delete images with.
+                                           Defaults to the az CLI.
+        workers (int, optional): Number of deletions to run at once.
+                                 Defaults to 1.
+        controller (ConcurrencyController, optional): Adapts the number of
+                                                      deletions in flight to
+                                                      the registry. Defaults
+                                                      to None.
+        journal (DeletionJournal, optional): Journal to record the purge in
+                                             so it can be resumed. Defaults
+                                             to None.
+        time_limit (float, optional): Seconds after which no more deletions
+                                      are started. Defaults to no limit.
+
+    Returns:
+        int: The number of images deleted
     """
-    for image_name in df.index:
-        logger.info("Deleting image: %s" % image_name)
+    if registry is None:
+        registry = AzCliBackend(acr_name)
+
+    # Every image is going, so whole repositories can be deleted at once
+    repo_counts = None
+    if "repo" in df.columns:
+        repo_counts = dict(Counter(df["repo"]))
+
+    report = bulk_delete(
+        registry,
+        df.index,
+        workers=workers,
+        repo_counts=repo_counts,
+        controller=controller,
+        journal=journal,
+        acr_name=acr_name,
+        time_limit=time_limit,
+    )
+
+    if report["failed"]:
+        raise RuntimeError(
+            "Could not delete %d images or repositories"
+            % len(report["failed"])
+        )
+
+    return report["deleted"]
+
+
+class AzCliBackend:
+    """Registry backend that runs every operation through the Azure CLI
+
+    Args:
+        acr_name (str): The name of the ACR
+        identity (bool, optional): Login to Azure with a Managed Identity.
+                                   Defaults to False.
+        az_workers (int, optional): Number of warm Azure CLI workers to run
+                                    az commands on after logging in. If 0, a
+                                    new az process is started for every
+                                    command. Defaults to 0.
+        logged_in (bool, optional): The process is already logged in to
+                                    Azure, so only login to the ACR.
+                                    Defaults to False.
+    """
+
+    def __init__(
+        self,
+        acr_name: str,
+        identity: bool = False,
+        az_workers: int = 0,
+        logged_in: bool = False,
+        **kwargs,
+    ):
+        self.acr_name = acr_name
+        self.identity = identity
+        self.az_workers = az_workers
+        self.logged_in = logged_in
+        self.az_pool = None
+
+    def _start_az_pool(self) -> None:
+        if self.az_workers and self.az_pool is None:
+            logger.info("Starting %d az workers" % self.az_workers)
+            self.az_pool = AzWorkerPool(self.az_workers)
+            set_az_pool(self.az_pool)
+
+    def _stop_az_pool(self) -> None:
+        if self.az_pool is not None:
+            set_az_pool(None)
+            self.az_pool.close()
+            self.az_pool = None
+
+    @instrument("login")
+    def login(self) -> None:
+        login(self.acr_name, identity=self.identity, azure=not self.logged_in)
+        self._start_az_pool()
+
+    @instrument("check_acr_size")
+    def check_size(self, limit: float) -> Tuple[float, bool]:
+        return check_acr_size(self.acr_name, limit)
+
+    @instrument("pull_repos")
+    def pull_repos(self) -> list:
+        return pull_repos(self.acr_name)
+
+    @instrument("pull_manifests")
+    def pull_manifests(self, repo: str) -> list:
+        manifests = list(iter_manifests(self.acr_name, repo))
+        logger.info(
+            "Total number of manifests in %s: %d" % (repo, len(manifests))
+        )
+        return manifests
+
+    @instrument("pull_manifests")
+    def iter_manifests(
+        self, repo: str, page_size: int = 1000, oldest_first: bool = False
+    ):
+        yield from iter_manifests(
+            self.acr_name, repo, page_size=page_size, oldest_first=oldest_first
+        )
+
+    @instrument("pull_repo_metadata")
+    def pull_repo_metadata(self, repo: str) -> dict:
+        return pull_repo_metadata(self.acr_name, repo)
+
+    @instrument("pull_manifest_body")
+    def pull_manifest_body(self, image_name: str) -> dict:
+        return pull_manifest_body(self.acr_name, image_name)
+
+    @instrument("delete_image")
+    def delete_image(self, image_name: str) -> None:
+        delete_image(self.acr_name, image_name)
+
+    @instrument("delete_repo")
+    def delete_repo(self, repo: str) -> None:
+        delete_repo(self.acr_name, repo)
+
+    def close(self) -> None:
+        self._stop_az_pool()
+
+
+class RegistryBackend(AzCliBackend):
+    """Registry backend that lists and deletes images over HTTP
+
+    Logging in and checking the size of the ACR are still done with the
+    Azure CLI, since they happen once per run. The ACR refresh token returned
+    by `az acr login --expose-token` is handed to a RegistryClient which
+    keeps a pool of connections to the registry open for the whole run.
+
+    With a token cache, the refresh token and the access tokens for each
+    scope are kept on disk until they expire. A later run with a refresh
+    token still valid for REFRESH_TOKEN_MARGIN skips logging in entirely,
+    and relies on the Azure CLI's own stored login for checking the size.
 
-        delete_cmd = [
-            "az",
-            "acr",
-            "repository",
-            "delete",
-            "-n",
+    Args:
+        acr_name (str): The name of the ACR
+        identity (bool, optional): Login to Azure with a Managed Identity.
+                                   Defaults to False.
+        pool_size (int, optional): Number of pooled HTTP connections.
+                                   Defaults to 10.
+        az_workers (int, optional): Number of warm Azure CLI workers to run
+                                    the remaining az commands on. Defaults
+                                    to 0.
+        logged_in (bool, optional): The process is already logged in to
+                                    Azure, so only login to the ACR.
+                                    Defaults to False.
+        token_cache (str, optional): Path to a file to keep tokens in
+                                     between runs. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        acr_name: str,
+        identity: bool = False,
+        pool_size: int = 10,
+        az_workers: int = 0,
+        logged_in: bool = False,
+        token_cache: Optional[str] = None,
+    ):
+        super().__init__(
             acr_name,
-            "--image",
-            image_name,
-            "--yes",
-        ]
+            identity=identity,
+            az_workers=az_workers,
+            logged_in=logged_in,
+        )
+        self.pool_size = pool_size
+        self.client = None
+        self.token_cache = None
+        if token_cache is not None:
+            self.token_cache = TokenCache(token_cache)
+
+    @instrument("login")
+    def login(self) -> None:
+        key = "refresh:%s" % self.acr_name
+        cached = None
+        if self.token_cache is not None:
+            cached = self.token_cache.get(key, margin=REFRESH_TOKEN_MARGIN)
+
+        if cached is not None:
+            logger.info(
+                "Using cached ACR refresh token for: %s" % self.acr_name
+            )
+            token = {
+                "accessToken": cached["token"],
+                "loginServer": cached["login_server"],
+            }
+        else:
+            token = login(
+                self.acr_name,
+                identity=self.identity,
+                expose_token=True,
+                azure=not self.logged_in,
+            )
+            self.logged_in = True
+
+            if self.token_cache is not None:
+                self.token_cache.put(
+                    key,
+                    token["accessToken"],
+                    token_expiry(token["accessToken"], REFRESH_TOKEN_TTL),
+                    login_server=token["loginServer"],
+                )
+                self.token_cache.save()
+
+        self._start_az_pool()
+        self.client = RegistryClient(
+            token["loginServer"],
+            refresh_token=token["accessToken"],
+            pool_size=self.pool_size,
+            token_cache=self.token_cache,
+        )
+
+    @instrument("check_acr_size")
+    def check_size(self, limit: float) -> Tuple[float, bool]:
+        try:
+            return check_acr_size(self.acr_name, limit)
+        except RuntimeError as err:
+            # A cached token skipped az login, which the Azure CLI needs
+            # again once its own stored login has expired
+            if self.logged_in or not AZ_LOGIN_NEEDED.search(str(err)):
+                raise
+            azure_login(identity=self.identity)
+            self.logged_in = True
+            return check_acr_size(self.acr_name, limit)
+
+    @instrument("pull_repos")
+    def pull_repos(self) -> list:
+        logger.info("Pulling repositories in: %s" % self.acr_name)
+        repos = self.client.list_repos()
+        logger.info("Total number of repositories: %s" % len(repos))
+        return repos
+
+    @instrument("pull_manifests")
+    def pull_manifests(self, repo: str) -> list:
+        logger.info("Pulling manifests for: %s" % repo)
+        manifests = self.client.list_manifests(repo)
+        logger.info(
+            "Total number of manifests in %s: %d" % (repo, len(manifests))
+        )
+        return manifests
+
+    @instrument("pull_manifests")
+    def iter_manifests(
+        self, repo: str, page_size: int = 1000, oldest_first: bool = False
+    ):
+        logger.info("Pulling manifests for: %s" % repo)
+        yield from self.client.iter_manifests(
+            repo, page_size=page_size, oldest_first=oldest_first
+        )
+
+    @instrument("pull_repo_metadata")
+    def pull_repo_metadata(self, repo: str) -> dict:
+        return self.client.get_repo(repo)
+
+    @instrument("pull_manifest_body")
+    def pull_manifest_body(self, image_name: str) -> dict:
+        repo, digest = image_name.split("@", 1)
+        return self.client.get_manifest(repo, digest)
+
+    @instrument("delete_image")
+    def delete_image(self, image_name: str) -> None:
+        logger.info("Deleting image: %s" % image_name)
+        repo, digest = image_name.split("@", 1)
+        self.client.delete_manifest(repo, digest)
+        logger.info("Successfully deleted image")
 
-        result = run_cmd(delete_cmd)
+    @instrument("delete_repo")
+    def delete_repo(self, repo: str) -> None:
+        logger.info("Deleting repository: %s" % repo)
+        self.client.delete_repo(repo)
+        logger.info("Successfully deleted repository")
+
+    def close(self) -> None:
+        if self.client is not None:
+            self.client.close()
+        self._stop_az_pool()
 
-        if result["returncode"] != 0:
-            logger.error(result["err_msg"])
-            raise RuntimeError(result["err_msg"])
+
+BACKENDS = {"az": AzCliBackend, "http": RegistryBackend}
+
+
+def get_backend(
+    name: str, acr_name: str, cache: Optional[str] = None, **kwargs
+) -> AzCliBackend:
+    """Create a registry backend by name
+
+    Args:
+        name (str): Name of the backend, one of BACKENDS
+        acr_name (str): The name of the ACR
+        cache (str, optional): Path to a manifest cache database to read
+                               unchanged repositories from. Defaults to None.
+
+    Returns:
+        AzCliBackend: The registry backend
+    """
+    if name not in BACKENDS:
+        raise ValueError(
+            "Unknown backend: %s. Choose from: %s"
+            % (name, ", ".join(BACKENDS))
+        )
+
+    registry = BACKENDS[name](acr_name, **kwargs)
+
+    if cache is not None:
+        registry = CachingBackend(registry, ManifestCache(cache))
+
+    return registry
+
+
+def list_images(
+    registry,
+    repos: list,
+    workers: int = LIST_THREADS,
+    controller: Optional[ConcurrencyController] = None,
+    age_mode: str = "batch",
+    older_than: Optional[str] = None,
+    repo_counts: Optional[dict] = None,
+    keep_tags: bool = True,
+) -> pd.DataFrame:
+    """List the images in a set of repositories concurrently and age them
+
+    Args:
+        registry (AzCliBackend): The registry backend to list images with
+        repos (list): The repositories to list
+        workers (int, optional): Number of repositories to list at once.
+                                 Defaults to LIST_THREADS.
+        controller (ConcurrencyController, optional): Backs listings off
+                                                      when the registry
+                                                      throttles them.
+                                                      Defaults to None.
+        age_mode (str, optional): "batch" keeps every manifest in a compact
+                                  ImageInventory and ages them all at once
+                                  when listing finishes. "per-repo" ages each
+                                  repository in its listing thread while
+                                  others are still being listed.
+                                  Defaults to "batch".
+        older_than (str, optional): Only list the images with a timestamp
+                                    up to this one, asking the registry for
+                                    each repository's images oldest first
+                                    and stopping at the first newer one.
+                                    Defaults to listing every image.
+        repo_counts (dict, optional): Filled with the number of images in
+                                      each repository whose images were all
+                                      listed. Defaults to None.
+        keep_tags (bool, optional): Keep the tags of each image. Defaults to
+                                    True.
+
+    Returns:
+        pd.DataFrame: The image inventory with columns image_name, repo,
+                      digest, age_days and image_size
+    """
+    if age_mode not in AGE_MODES:
+        raise ValueError(
+            "Unknown age mode: %s. Choose from: %s"
+            % (age_mode, ", ".join(AGE_MODES))
+        )
+
+    def list_repo(repo):
+        if older_than is None:
+            manifests = registry.pull_manifests(repo)
+            complete = True
+        else:
+            manifests, complete = take_older(
+                registry.iter_manifests(repo, oldest_first=True), older_than
+            )
+
+        if complete and repo_counts is not None:
+            repo_counts[repo] = len(manifests)
+        return manifests
+
+    pull = list_repo
+    if controller is not None:
+        pull = partial(controller.call, list_repo)
+
+    def task(repo):
+        manifests = pull(repo)
+        if age_mode == "per-repo":
+            return compute_image_ages(manifests, keep_tags=keep_tags)
+        return manifests
+
+    manifests = ImageInventory(keep_tags)
+    frames = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(task, repo): repo for repo in repos}
+
+        for future in as_completed(futures):
+            if age_mode == "per-repo":
+                frames.append(future.result())
+            else:
+                manifests.extend(future.result())
+            del futures[future]
+
+    if age_mode == "batch":
+        return compute_image_ages(manifests)
+
+    if not frames:
+        return compute_image_ages([])
+
+    if not use_pandas():
+        return ImageTable.concat(frames)
+
+    image_df = pd.concat(frames, ignore_index=True)
+    image_df["repo"] = image_df["repo"].astype("category")
+
+    return image_df
+
+
+def select_images(
+    registry,
+    image_df,
+    size: float,
+    limit: float,
+    max_age: int,
+    to_limit: bool = False,
+    layers: bool = False,
+    workers: int = LIST_THREADS,
+    controller: Optional[ConcurrencyController] = None,
+    policy: Optional[RetentionPolicy] = None,
+    policy_report: Optional[str] = None,
+    oldest_first: bool = False,
+):
+    """Select the images to delete from an ACR
+
+    Args:
+        registry (AzCliBackend): The registry backend to fetch image
+                                 manifests with
+        image_df (pd.DataFrame or ImageTable): The image inventory
+        size (float): The current size of the ACR in GB
+        limit (float): The maximum size limit of the ACR in TB
+        max_age (int): The maximum image age in days
+        to_limit (bool, optional): Only select as many of the oldest images
+                                   as are needed to bring the ACR under the
+                                   size limit. Defaults to False.
+        layers (bool, optional): With to_limit, count the layers the images
+                                 share to pick the images that free the most
+                                 bytes. Defaults to False.
+        workers (int, optional): Number of image manifests to fetch at once.
+                                 Defaults to LIST_THREADS.
+        controller (ConcurrencyController, optional): Backs the manifest
+                                                      fetches off when the
+                                                      registry throttles
+                                                      them. Defaults to None.
+        policy (RetentionPolicy, optional): Rules deciding which images to
+                                            delete instead of max_age.
+                                            Defaults to None.
+        policy_report (str, optional): Path to a CSV file to write why the
+                                       policy keeps or deletes each image
+                                       to. Defaults to None.
+        oldest_first (bool, optional): Order the images oldest first, so
+                                       that deletions stopped early have
+                                       deleted the oldest. Defaults to False.
+
+    Returns:
+        pd.DataFrame or ImageTable: The images to delete
+    """
+    if policy is not None and to_limit:
+        raise ValueError("A retention policy can't be used with to_limit")
+
+    if not to_limit:
+        if policy is None:
+            images = sort_image_df(image_df, max_age)
+        else:
+            images = apply_policy(policy, image_df, report=policy_report)
+
+        if oldest_first:
+            images = images.sort_values(
+                "age_days", ascending=False, kind="stable"
+            ).reset_index(drop=True)
+        return images
+
+    # The planners group the images by repository with pandas
+    require_pandas("--to-limit")
+    from .planner import plan_to_limit, plan_with_layers
+
+    if not layers:
+        return plan_to_limit(image_df, size, limit, max_age)
+
+    logger.info("Indexing image layers")
+    index = build_layer_index(
+        registry,
+        image_df["image_name"],
+        workers=workers,
+        controller=controller,
+    )
+    return plan_with_layers(image_df, index, size, limit, max_age)
+
+
+def recheck_size(
+    acr_name: str, monitor: UsageMonitor, start_size: float
+) -> Tuple[float, bool]:
+    """Check the size of an ACR again after deleting images from it
+
+    Azure may not have updated the size it reports yet, in which case the
+    size estimated from the images deleted is logged too.
+
+    Args:
+        acr_name (str): The name of the ACR
+        monitor (UsageMonitor): The monitor the deletions were counted by
+        start_size (float): The size of the ACR in GB before deleting
+
+    Returns:
+        size (float): The size of the ACR in GB
+        proceed (bool): The ACR is still over its size limit
+    """
+    estimate = monitor.estimate()
+    size, proceed = monitor.read()
+    record_reclaimed(max(start_size - size, 0) * 1.0e9)
+
+    if proceed and estimate < monitor.limit * 1.0e3:
+        logger.info(
+            "Size of %s should be about %.2f GB once Azure has caught up with the deletions"
+            % (acr_name, estimate)
+        )
+    elif proceed:
+        # Advise the user to re-run since the ACR is still large
+        logger.info(
+            "Size of %s still LARGER THAN %s TB. Please re-run and optionally set the --purge flag."
+            % (acr_name, monitor.limit)
+        )
+
+    return size, proceed
+
+
+def resume_deletions(
+    registry,
+    acr_name: str,
+    journal: DeletionJournal,
+    limit: float,
+    dry_run: bool = False,
+    workers: int = DELETE_THREADS,
+    controller: Optional[ConcurrencyController] = None,
+    time_limit: Optional[float] = None,
+) -> dict:
+    """Continue the deletions remaining in a journal without listing the ACR
+    again
+
+    Args:
+        registry (AzCliBackend): The logged in registry backend
+        acr_name (str): The name of the ACR
+        journal (DeletionJournal): The journal of an interrupted run
+        limit (float): The maximum size limit of the ACR in TB
+        dry_run (bool, optional): Don't delete any images from the ACR.
+                                  Defaults to False.
+        workers (int, optional): Number of deletions to run at once.
+                                 Defaults to DELETE_THREADS.
+        controller (ConcurrencyController, optional): Adapts the number of
+                                                      deletions in flight to
+                                                      the registry. Defaults
+                                                      to None.
+        time_limit (float, optional): Seconds after which no more deletions
+                                      are started. Defaults to no limit.
+
+    Returns:
+        dict: The size of the ACR in GB afterwards and the number of images
+              deleted
+    """
+    tasks = journal.remaining(acr_name)
+    deleted = 0
+
+    if dry_run:
+        logger.info(
+            "Number of images elegible for deletion %s"
+            % sum(count for _, _, count in tasks)
+        )
+    else:
+        report = run_deletions(
+            registry,
+            tasks,
+            workers=workers,
+            controller=controller,
+            journal=journal,
+            time_limit=time_limit,
+        )
+        deleted = report["deleted"]
+
+        if report["failed"]:
+            raise RuntimeError(
+                "Could not delete %d images or repositories"
+                % len(report["failed"])
+            )
+
+    size, proceed = registry.check_size(limit)
+    if proceed:
+        logger.info(
+            "Size of %s still LARGER THAN %s TB. Please re-run and optionally set the --purge flag."
+            % (acr_name, limit)
+        )
+
+    return {"size": size, "deleted": deleted}
 
 
 def run(
     acr_name: str,
     max_age: int,
     limit: float,
-    threads: int,
+    threads: Optional[int] = None,
     dry_run: bool = False,
     purge: bool = False,
     identity: bool = False,
-) -> None:
+    backend: str = "az",
+    cache: Optional[str] = None,
+    to_limit: bool = False,
+    layers: bool = False,
+    list_threads: Optional[int] = None,
+    delete_threads: Optional[int] = None,
+    age_mode: str = "batch",
+    az_workers: int = 0,
+    journal: Optional[str] = None,
+    resume: bool = False,
+    time_limit: Optional[float] = None,
+    controller: Optional[ConcurrencyController] = None,
+    logged_in: bool = False,
+    token_cache: Optional[str] = None,
+    shard: Optional[Tuple[int, int]] = None,
+    policy: Optional[RetentionPolicy] = None,
+    policy_report: Optional[str] = None,
+    stop_under_limit: bool = False,
+) -> dict:
     """Run the Docker Clean Up process
 
     Args:
         acr_name (str): The name of the ACR to clean
         max_age (int): The maximum image age in days
         limit (float): The maximum size limit of the ACR in TB
-        threads (int): The number of threads to parallelise over
+        threads (int, optional): The number of registry calls each stage
+                                 runs at once, unless set per stage.
+                                 Defaults to None.
         dry_run (bool, optional): Don't delete any images from the ACR.
                                   Defaults to False.
         purge (bool, optional): Delete all images from the ACR.
                                 Defaults to False.
         identity (bool, optional): Login to Azure with a Managed Identity.
                                    Defaults to False.
+        backend (str, optional): How to talk to the ACR. "az" runs the Azure
+                                 CLI for every call, "http" uses the registry
+                                 API directly. Defaults to "az".
+        cache (str, optional): Path to a manifest cache database so that
+                               unchanged repositories aren't listed again.
+                               Defaults to None.
+        to_limit (bool, optional): Only delete as many of the oldest images
+                                   as are needed to bring the ACR under the
+                                   size limit. Defaults to False.
+        layers (bool, optional): With to_limit, fetch the manifest of every
+                                 image and count the layers they share to
+                                 pick the images that free the most bytes.
+                                 Defaults to False.
+        list_threads (int, optional): Number of repositories to list at
+                                      once. Defaults to threads, or
+                                      LIST_THREADS.
+        delete_threads (int, optional): Number of deletions to run at once.
+                                        Defaults to threads, or
+                                        DELETE_THREADS.
+        age_mode (str, optional): How to compute image ages, one of
+                                  AGE_MODES. Defaults to "batch".
+        az_workers (int, optional): Number of warm Azure CLI workers to run
+                                    az commands on instead of starting az
+                                    for every call. Defaults to 0.
+        journal (str, optional): Path to a journal of the planned and
+                                 completed deletions, so an interrupted run
+                                 can be resumed. Defaults to None.
+        resume (bool, optional): Continue the deletions remaining in the
+                                 journal instead of listing the ACR again.
+                                 Defaults to False.
+        time_limit (float, optional): Seconds after which no more deletions
+                                      are started, leaving the rest in the
+                                      journal. Defaults to no limit.
+        controller (ConcurrencyController, optional): Limits the registry
+                                                      calls in flight, which
+                                                      can be shared with
+                                                      other runs. Defaults
+                                                      to one sized from the
+                                                      stage threads.
+        logged_in (bool, optional): The process is already logged in to
+                                    Azure, so only login to the ACR.
+                                    Defaults to False.
+        token_cache (str, optional): Path to a file to keep registry tokens
+                                     in between runs, used by the "http"
+                                     backend. Defaults to None.
+        shard (tuple, optional): The index and count of the shard of the
+                                 ACR's repositories to clean, so that
+                                 several workers can clean one ACR.
+                                 Defaults to all the repositories.
+        policy (RetentionPolicy, optional): Rules deciding which images to
+                                            delete per repository, in place
+                                            of max_age. Defaults to None.
+        policy_report (str, optional): Path to a CSV file to write why the
+                                       policy keeps or deletes each image
+                                       to. Defaults to None.
+        stop_under_limit (bool, optional): Stop deleting images as soon as
+                                           the ACR is under the size limit,
+                                           leaving the rest for a later run.
+                                           Defaults to False.
+
+    Returns:
+        dict: The size of the ACR in GB when the run finished and the
+              number of images deleted
     """
+    if resume and journal is None:
+        raise ValueError("A journal is needed to resume deletions")
+    if to_limit:
+        require_pandas("--to-limit")
+
+    list_threads = list_threads or threads or LIST_THREADS
+    delete_threads = delete_threads or threads or DELETE_THREADS
+
+    # Start at the smaller stage size and let the registry decide whether
+    # the larger one can keep up
+    if controller is None:
+        controller = ConcurrencyController(
+            initial=min(list_threads, delete_threads),
+            maximum=max(list_threads, delete_threads),
+        )
+    watch_controller(controller)
+
+    registry = get_backend(
+        backend,
+        acr_name,
+        cache=cache,
+        identity=identity,
+        pool_size=controller.maximum,
+        az_workers=az_workers,
+        logged_in=logged_in,
+        token_cache=token_cache,
+    )
+    deleted = 0
+
     if dry_run:
         logger.info("THIS IS A DRY RUN. NO IMAGES WILL BE DELETED.")
     if purge:
         logger.info("ALL IMAGES WILL BE DELETED!")
 
-    # Login to Azure and ACR
-    login(acr_name, identity=identity)
-
-    # Check the size of the ACR
-    size, proceed = check_acr_size(acr_name, limit)
-
-    # If the ACR is too large or --purge was set, then when need to do stuff!
-    if proceed or purge:
-        # Get the repos in the ACR
-        repos = pull_repos(acr_name)
-
-        # Get the manifests for the repos in the ACR
-        logger.info("Checking repository manifests")
-        manifests = []
-
-        with ThreadPoolExecutor(max_workers=threads) as executor:
-            futures = {
-                executor.submit(pull_manifests, acr_name, repo): repo
-                for repo in repos
-            }
-
-            for cases in as_completed(futures):
-                for case in cases.result():
-                    manifests.append(case)
-
-        # Checking sizes of images
-        logger.info("Checking image sizes")
-        image_df = pd.DataFrame(columns=["image_name", "age_days"])
-
-        with ThreadPoolExecutor(max_workers=threads) as executor:
-            futures = {
-                executor.submit(pull_image_age, acr_name, manifest): manifest
-                for manifest in manifests
-            }
-
-            for future in as_completed(futures):
-                image_name, age_days = future.result()
-
-                image_df = image_df.append(
-                    {"image_name": image_name, "age_days": age_days},
-                    ignore_index=True,
-                )
-
-        image_df.set_index("image_name", inplace=True)
-
-        # If the ACR is under the size limit but purge has been set anyway,
-        # purge the ACR and exit the program
-        if purge and not proceed:
-            logging.info("Purging ACR: %s" % acr_name)
-            purge_all(acr_name, image_df)
-            sys.exit(0)
-
-        # If the ACR is above the size limit
-        if proceed and not purge:
-            # Find the oldest images to delete
-            logger.info("Filtering dataframe for old images")
-            images_to_delete = sort_image_df(image_df, max_age)
-
-            if dry_run:
-                logger.info(
-                    "Number of images elegible for deletion %s"
-                    % len(images_to_delete)
-                )
-            else:
-                logger.info(
-                    "Number of images to be deleted: %s"
-                    % len(images_to_delete)
+    deletion_journal = None
+    if journal is not None:
+        deletion_journal = DeletionJournal(journal)
+
+    try:
+        # Login to Azure and ACR
+        registry.login()
+
+        # Continue an interrupted run from its journal, without listing again
+        if resume:
+            return resume_deletions(
+                registry,
+                acr_name,
+                deletion_journal,
+                limit,
+                dry_run=dry_run,
+                workers=delete_threads,
+                controller=controller,
+                time_limit=time_limit,
+            )
+
+        # Check the size of the ACR
+        monitor = UsageMonitor(
+            registry, limit, stop_under_limit=stop_under_limit
+        )
+        size, proceed = monitor.read()
+
+        # If the ACR is too large or --purge was set, then when need to do stuff!
+        if proceed or purge:
+            # Get the repos in the ACR
+            repos = registry.pull_repos()
+            if shard is not None:
+                repos = shard_repos(repos, *shard)
+
+            # Only the images old enough to delete need listing, unless the
+            # bytes they free are estimated from the newer images they share
+            # layers with, or a policy keeps the newest images whatever their age
+            older_than = None
+            cutoff_age = (
+                max_age if policy is None else policy.listing_max_age()
+            )
+            if (
+                proceed
+                and not purge
+                and not to_limit
+                and cutoff_age is not None
+            ):
+                older_than = age_cutoff(cutoff_age)
+                logger.info("Listing images older than: %s" % older_than)
+
+            # Get the manifests for the repos in the ACR and check their ages
+            logger.info("Checking repository manifests and image ages")
+            repo_counts = {}
+            image_df = list_images(
+                registry,
+                repos,
+                workers=list_threads,
+                controller=controller,
+                age_mode=age_mode,
+                older_than=older_than,
+                repo_counts=repo_counts,
+                keep_tags=policy is not None and policy.protects_tags(),
+            )
+
+            # If the ACR is under the size limit but purge has been set anyway,
+            # purge the ACR and stop there
+            if purge and not proceed:
+                logging.info("Purging ACR: %s" % acr_name)
+                deleted = purge_all(
+                    acr_name,
+                    image_df.set_index("image_name"),
+                    registry=registry,
+                    workers=delete_threads,
+                    controller=controller,
+                    journal=deletion_journal,
+                    time_limit=time_limit,
                 )
-
-                # Delete the old images
-                with ThreadPoolExecutor(max_workers=threads) as executor:
-                    futures = {
-                        executor.submit(delete_image, acr_name, image_name)
-                        for image_name in images_to_delete.index
-                    }
-
-                    for future in as_completed(futures):
-                        original_image = futures.pop(future)
-                        image_df.drop(original_image, inplace=True)
-
-            # Re-check ACR size
-            size, proceed = check_acr_size(acr_name)
-
-            if proceed:
-                # Advise the user to re-run since the ACR is still large
-                logger.info(
-                    "Size of %s still LARGER THAN %s TB. Please re-run and optionally set the --purge flag."
-                    % (acr_name, limit)
+                size, _ = registry.check_size(limit)
+                return {"size": size, "deleted": deleted}
+
+            # If the ACR is above the size limit
+            if proceed and not purge:
+                # Find the oldest images to delete
+                logger.info("Filtering dataframe for old images")
+                images_to_delete = select_images(
+                    registry,
+                    image_df,
+                    size,
+                    limit,
+                    max_age,
+                    to_limit=to_limit,
+                    layers=layers,
+                    workers=list_threads,
+                    controller=controller,
+                    policy=policy,
+                    policy_report=policy_report,
+                    oldest_first=stop_under_limit,
                 )
 
-    # The ACR is under the size limit and the --purge flag has not been set
-    elif not proceed and not purge:
-        logger.info("Nothing to do. PROGRAM EXITING.")
+                if dry_run:
+                    logger.info(
+                        "Number of images elegible for deletion %s"
+                        % len(images_to_delete)
+                    )
+                else:
+                    logger.info(
+                        "Number of images to be deleted: %s"
+                        % len(images_to_delete)
+                    )
+
+                    # Delete the old images
+                    report = bulk_delete(
+                        registry,
+                        images_to_delete["image_name"],
+                        workers=delete_threads,
+                        repo_counts=repo_counts,
+                        controller=controller,
+                        journal=deletion_journal,
+                        acr_name=acr_name,
+                        time_limit=time_limit,
+                        sizes=images_to_delete["image_size"],
+                        monitor=monitor,
+                    )
+                    deleted = report["deleted"]
+
+                    if report["failed"]:
+                        raise RuntimeError(
+                            "Could not delete %d images or repositories"
+                            % len(report["failed"])
+                        )
+
+                # Re-check ACR size
+                size, proceed = recheck_size(acr_name, monitor, size)
+
+        # The ACR is under the size limit and the --purge flag has not been set
+        elif not proceed and not purge:
+            logger.info("Nothing to do. PROGRAM EXITING.")
+
+        return {"size": size, "deleted": deleted}
+    finally:
+        registry.close()
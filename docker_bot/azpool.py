@@ -0,0 +1,230 @@
+import io
+import os
+import sys
+import json
+import queue
+import logging
+import argparse
+import importlib
+import threading
+import subprocess
+from typing import Optional
+from contextlib import redirect_stderr, redirect_stdout
+
+logger = logging.getLogger()
+
+# The factory each worker calls to get an Azure CLI to invoke commands with.
+# Importing its module is what makes a worker warm.
+DEFAULT_CLI = "azure.cli.core:get_default_cli"
+
+
+def load_cli_factory(spec: str):
+    """Import a CLI factory given as "module:function"
+
+    Args:
+        spec (str): The module and the name of the factory in it
+
+    Returns:
+        callable: The factory. Each call returns an object with an
+                  `invoke(args, out_file=...)` method returning the exit code.
+    """
+    module, _, name = spec.partition(":")
+    return getattr(importlib.import_module(module), name)
+
+
+def invoke(get_cli, args: list) -> dict:
+    """Run one command with an in-process CLI, capturing its output
+
+    Args:
+        get_cli (callable): The CLI factory
+        args (list): The command without the leading "az"
+
+    Returns:
+        dict: The returncode, output and err_msg of the command, like
+              `run_cmd`
+    """
+    out = io.StringIO()
+    err = io.StringIO()
+
+    with redirect_stdout(err), redirect_stderr(err):
+        try:
+            returncode = get_cli().invoke(args, out_file=out)
+        except SystemExit as exc:
+            returncode = exc.code if isinstance(exc.code, int) else 1
+        except Exception as exc:
+            print(exc)
+            returncode = 1
+
+    return {
+        "returncode": returncode,
+        "output": out.getvalue().strip("\n"),
+        "err_msg": err.getvalue().strip("\n"),
+    }
+
+
+def serve(get_cli, requests, responses) -> None:
+    """Answer commands read one JSON line at a time until the input closes
+
+    Args:
+        get_cli (callable): The CLI factory
+        requests (file): Stream of commands, each a JSON list of arguments
+        responses (file): Stream to write each result to as a JSON line
+    """
+    for line in requests:
+        result = invoke(get_cli, json.loads(line))
+        responses.write(json.dumps(result) + "\n")
+        responses.flush()
+
+
+class AzWorkerPool:
+    """Pool of long-lived worker processes that run Azure CLI commands
+
+    Starting `az` imports the whole of azure-cli, which takes far longer
+    than most commands. Each worker imports it once and then runs the
+    commands sent to it in-process, so a call costs milliseconds instead of
+    seconds. Workers need azure-cli installed in the same Python environment
+    as this package.
+
+    Args:
+        size (int, optional): Number of workers. Defaults to 4.
+        cli (str, optional): The CLI factory the workers use, as
+                             "module:function". Defaults to DEFAULT_CLI.
+        env (dict, optional): Environment variables for the workers.
+                              Defaults to the current environment.
+    """
+
+    def __init__(
+        self, size: int = 4, cli: str = DEFAULT_CLI, env: Optional[dict] = None
+    ) -> None:
+        # Run this file as a script so workers don't import the package
+        self.command = [sys.executable, os.path.abspath(__file__), cli]
+        self.env = env
+        self.workers = []
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+        for _ in range(size):
+            self._idle.put(self._start())
+
+    def _start(self) -> subprocess.Popen:
+        worker = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=self.env,
+            universal_newlines=True,
+            bufsize=1,
+        )
+        with self._lock:
+            self.workers.append(worker)
+
+        return worker
+
+    def _replace(self, worker: subprocess.Popen) -> subprocess.Popen:
+        worker.kill()
+        worker.wait()
+        with self._lock:
+            self.workers.remove(worker)
+
+        return self._start()
+
+    def run(self, cmd: list, timeout: Optional[float] = None) -> dict:
+        """Run an az command on the next idle worker
+
+        Args:
+            cmd (list): The command, starting with "az"
+            timeout (float, optional): Seconds to wait for the command
+                                       before killing its worker and
+                                       starting another. Defaults to no
+                                       limit.
+
+        Returns:
+            dict: The returncode, output and err_msg of the command, like
+                  `run_cmd`
+        """
+        worker = self._idle.get()
+        timer = None
+        timed_out = threading.Event()
+
+        if timeout is not None:
+
+            def kill():
+                timed_out.set()
+                worker.kill()
+
+            timer = threading.Timer(timeout, kill)
+            timer.daemon = True
+            timer.start()
+
+        try:
+            worker.stdin.write(json.dumps(cmd[1:]) + "\n")
+            worker.stdin.flush()
+            line = worker.stdout.readline()
+        except (OSError, ValueError):
+            line = ""
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        if line and not timed_out.is_set():
+            result = json.loads(line)
+        else:
+            if timed_out.is_set():
+                err_msg = "%s timed out after %ss" % (" ".join(cmd), timeout)
+                logger.error(
+                    "az worker %d timed out, restarting it" % worker.pid
+                )
+            else:
+                err_msg = "az worker exited while running: %s" % " ".join(cmd)
+                logger.error("az worker %d exited, restarting it" % worker.pid)
+            worker = self._replace(worker)
+            result = {"returncode": 1, "output": "", "err_msg": err_msg}
+
+        self._idle.put(worker)
+        return result
+
+    def close(self) -> None:
+        """Stop all the workers"""
+        with self._lock:
+            workers, self.workers = self.workers, []
+
+        for worker in workers:
+            worker.stdin.close()
+        for worker in workers:
+            try:
+                worker.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+                worker.wait()
+            worker.stdout.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run Azure CLI commands read from stdin in one process"
+    )
+    parser.add_argument(
+        "cli",
+        nargs="?",
+        default=DEFAULT_CLI,
+        help="The CLI factory to use as module:function",
+    )
+    args = parser.parse_args()
+
+    # Running as a script puts the package directory first on the path,
+    # where its modules could shadow the ones the CLI imports
+    if sys.path[0] == os.path.dirname(os.path.abspath(__file__)):
+        del sys.path[0]
+
+    get_cli = load_cli_factory(args.cli)
+
+    # Keep the real stdout for responses, so nothing the CLI prints by
+    # accident can end up in the middle of one
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    serve(get_cli, sys.stdin, responses)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+import json
+import sqlite3
+import logging
+import threading
+from typing import Optional
+from itertools import islice
+
+logger = logging.getLogger()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS repos (
+    repo TEXT PRIMARY KEY,
+    last_update TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS manifests (
+    repo TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    image_size INTEGER,
+    tags TEXT,
+    PRIMARY KEY (repo, digest)
+);
+CREATE TABLE IF NOT EXISTS bodies (
+    digest TEXT PRIMARY KEY,
+    body TEXT NOT NULL
+);
+"""
+
+
+class ManifestCache:
+    """On-disk SQLite cache of the manifests stored in each repository
+
+    Each repository is stored alongside the lastUpdateTime the registry
+    reported when its manifests were listed. Cached manifests are only
+    returned while that time is unchanged.
+
+    Manifest bodies are stored by digest. A digest always names the same
+    body, so they never go stale.
+
+    Args:
+        path (str): Path to the SQLite database file
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+
+    def last_update(self, repo: str) -> Optional[str]:
+        """Return the lastUpdateTime a repository was cached at
+
+        Args:
+            repo (str): Name of the repository
+
+        Returns:
+            str: The lastUpdateTime, or None if the repository isn't cached
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT last_update FROM repos WHERE repo = ?", (repo,)
+            ).fetchone()
+
+        return None if row is None else row[0]
+
+    def get(self, repo: str, last_update: str) -> Optional[list]:
+        """Return the cached manifests for a repository
+
+        Args:
+            repo (str): Name of the repository
+            last_update (str): The current lastUpdateTime of the repository
+
+        Returns:
+            list: The cached manifests, or None if the repository isn't
+                  cached or has been updated since it was cached
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT last_update FROM repos WHERE repo = ?", (repo,)
+            ).fetchone()
+
+            if row is None or row[0] != last_update:
+                return None
+
+            rows = self._conn.execute(
+                "SELECT digest, timestamp, image_size, tags FROM manifests "
+                "WHERE repo = ?",
+                (repo,),
+            ).fetchall()
+
+        return [
+            {
+                "digest": digest,
+                "tags": json.loads(tags) if tags else [],
+                "timestamp": timestamp,
+                "imageSize": image_size,
+                "repo": repo,
+            }
+            for digest, timestamp, image_size, tags in rows
+        ]
+
+    def put(self, repo: str, last_update: str, manifests: list) -> None:
+        """Replace the cached manifests for a repository
+
+        Args:
+            repo (str): Name of the repository
+            last_update (str): The lastUpdateTime of the repository
+            manifests (list): The image manifests
+        """
+        self.start(repo)
+        self.add(repo, manifests)
+        self.finish(repo, last_update)
+
+    def start(self, repo: str) -> None:
+        """Forget a repository so that its manifests can be added in batches
+
+        The repository reads as uncached until `finish` is called, so an
+        interrupted listing is never mistaken for a complete one.
+
+        Args:
+            repo (str): Name of the repository
+        """
+        self.evict_repo(repo)
+
+    def add(self, repo: str, manifests: list) -> None:
+        """Add a batch of manifests to a repository started with `start`
+
+        Args:
+            repo (str): Name of the repository
+            manifests (list): The image manifests
+        """
+        rows = [
+            (
+                repo,
+                manifest["digest"],
+                manifest["timestamp"],
+                manifest.get("imageSize"),
+                json.dumps(manifest.get("tags") or []),
+            )
+            for manifest in manifests
+        ]
+
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO manifests VALUES (?, ?, ?, ?, ?)", rows
+            )
+
+    def finish(self, repo: str, last_update: str) -> None:
+        """Mark a repository as completely cached
+
+        Args:
+            repo (str): Name of the repository
+            last_update (str): The lastUpdateTime of the repository
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO repos VALUES (?, ?)",
+                (repo, last_update),
+            )
+
+    def get_body(self, digest: str) -> Optional[dict]:
+        """Return the cached body of an image manifest
+
+        Args:
+            digest (str): Digest of the manifest
+
+        Returns:
+            dict: The image manifest, or None if it isn't cached
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT body FROM bodies WHERE digest = ?", (digest,)
+            ).fetchone()
+
+        return None if row is None else json.loads(row[0])
+
+    def put_body(self, digest: str, body: dict) -> None:
+        """Cache the body of an image manifest
+
+        Args:
+            digest (str): Digest of the manifest
+            body (dict): The image manifest
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO bodies VALUES (?, ?)",
+                (digest, json.dumps(body)),
+            )
+
+    def evict_image(self, image_name: str) -> None:
+        """Remove a deleted image from the cache
+
+        Args:
+            image_name (str): The deleted image -> repo@digest
+        """
+        repo, digest = image_name.split("@", 1)
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM manifests WHERE repo = ? AND digest = ?",
+                (repo, digest),
+            )
+
+    def evict_repo(self, repo: str) -> None:
+        """Remove a deleted repository from the cache
+
+        Args:
+            repo (str): Name of the deleted repository
+        """
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM manifests WHERE repo = ?", (repo,))
+            self._conn.execute("DELETE FROM repos WHERE repo = ?", (repo,))
+
+    def prune(self, repos: list) -> None:
+        """Remove every repository that is no longer in the registry
+
+        Args:
+            repos (list): The repositories currently stored in the registry
+        """
+        with self._lock:
+            cached = [
+                row[0] for row in self._conn.execute("SELECT repo FROM repos")
+            ]
+
+        for repo in set(cached) - set(repos):
+            self.evict_repo(repo)
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+class CachingBackend:
+    """Wrap a registry backend so manifests are read from a ManifestCache
+
+    Listing a repository costs one metadata call instead of listing all of
+    its manifests whenever the repository hasn't changed since the last run.
+    A repository that isn't cached yet is listed in full without that call,
+    and its metadata is only read once the listing is complete, to cache it
+    with. Ordered listings are served from the cache too, so the first
+    ordered listing of a repository reads all of its manifests.
+
+    Deleted images and repositories are evicted from the cache. All other
+    calls go straight to the wrapped backend.
+
+    Args:
+        registry (AzCliBackend): The registry backend to wrap
+        cache (ManifestCache): The cache to read and update
+    """
+
+    def __init__(self, registry, cache: ManifestCache) -> None:
+        self.registry = registry
+        self.cache = cache
+
+    def __getattr__(self, name: str):
+        return getattr(self.registry, name)
+
+    def pull_repos(self) -> list:
+        repos = self.registry.pull_repos()
+        self.cache.prune(repos)
+        return repos
+
+    def _cached(self, repo: str) -> Optional[list]:
+        if self.cache.last_update(repo) is None:
+            return None
+
+        metadata = self.registry.pull_repo_metadata(repo)
+        manifests = self.cache.get(repo, metadata["lastUpdateTime"])
+        if manifests is None:
+            return None
+
+        # Images deleted by something else don't always change the time
+        count = metadata.get("manifestCount")
+        if count is not None and count != len(manifests):
+            return None
+
+        logger.info(
+            "Using %d cached manifests for: %s" % (len(manifests), repo)
+        )
+        return manifests
+
+    def _finish(self, repo: str, count: int) -> None:
+        metadata = self.registry.pull_repo_metadata(repo)
+
+        # Images pushed or deleted while the repository was listed would
+        # be missing from, or left in, the cache
+        if metadata.get("manifestCount", count) != count:
+            logger.info(
+                "%s changed while it was listed, not caching it" % repo
+            )
+            return
+
+        self.cache.finish(repo, metadata["lastUpdateTime"])
+
+    def _list(self, repo: str, page_size: int):
+        self.cache.start(repo)
+        pages = self.registry.iter_manifests(repo, page_size=page_size)
+        count = 0
+
+        for page in iter(lambda: list(islice(pages, page_size)), []):
+            self.cache.add(repo, page)
+            count += len(page)
+            yield from page
+
+        self._finish(repo, count)
+
+    def pull_manifests(self, repo: str) -> list:
+        manifests = self._cached(repo)
+
+        if manifests is None:
+            manifests = self.registry.pull_manifests(repo)
+            self.cache.start(repo)
+            self.cache.add(repo, manifests)
+            self._finish(repo, len(manifests))
+
+        return manifests
+
+    def iter_manifests(
+        self, repo: str, page_size: int = 1000, oldest_first: bool = False
+    ):
+        manifests = self._cached(repo)
+
+        if manifests is None:
+            if not oldest_first:
+                yield from self._list(repo, page_size)
+                return
+
+            # Ordered listings are usually cut short by the caller, so the
+            # whole listing is cached before any of it is handed out
+            manifests = list(self._list(repo, page_size))
+
+        if oldest_first:
+            manifests.sort(key=lambda manifest: manifest["timestamp"])
+        yield from manifests
+
+    def pull_manifest_body(self, image_name: str) -> dict:
+        digest = image_name.split("@", 1)[1]
+        body = self.cache.get_body(digest)
+
+        if body is None:
+            body = self.registry.pull_manifest_body(image_name)
+            self.cache.put_body(digest, body)
+
+        return body
+
+    def delete_image(self, image_name: str) -> None:
+        self.registry.delete_image(image_name)
+        self.cache.evict_image(image_name)
+
+    def delete_repo(self, repo: str) -> None:
+        self.registry.delete_repo(repo)
+        self.cache.evict_repo(repo)
+
+    def close(self) -> None:
+        self.registry.close()
+        self.cache.close()
@@ -1,8 +1,10 @@
 import sys
+import json
 import logging
 import argparse
-from .app import run
-from multiprocessing import cpu_count
+from .defaults import AGE_MODES, DELETE_THREADS, LIST_THREADS, REGISTRY_THREADS
+from .metrics import collect_metrics
+from .sharding import merge_reports, parse_shard, write_shard_report
 
 
 def logging_config(verbose: bool = False) -> None:
@@ -26,7 +28,21 @@ def parse_args(args):
     DESCRIPTION = "Script to clean old Docker images out of an Azure Container Registry (ACR)"
     parser = argparse.ArgumentParser(description=DESCRIPTION)
 
-    parser.add_argument("name", type=str, help="Name of ACR to clean")
+    parser.add_argument(
+        "name", type=str, nargs="*", help="Names of the ACRs to clean"
+    )
+    parser.add_argument(
+        "--config",
+        type=str,
+        default=None,
+        help="Path to a JSON file listing more ACRs to clean, each optionally with its own max_age and limit.",
+    )
+    parser.add_argument(
+        "--registries",
+        type=int,
+        default=REGISTRY_THREADS,
+        help=f"Number of ACRs to clean at once when cleaning several. They share the registry calls allowed by the thread options. Default: {REGISTRY_THREADS}.",
+    )
 
     parser.add_argument(
         "-a",
@@ -42,12 +58,143 @@ def parse_args(args):
         default=2.0,
         help="Maximum size in TB the ACR is allowed to grow to. Default: 2 TB.",
     )
+    parser.add_argument(
+        "--to-limit",
+        action="store_true",
+        help="Only delete as many of the oldest images as are needed to bring the ACR under the size limit, instead of every image older than --max-age.",
+    )
+    parser.add_argument(
+        "--layers",
+        action="store_true",
+        help="With --to-limit, fetch every image's manifest and count the layers images share to pick the images that free the most space.",
+    )
+    parser.add_argument(
+        "--stop-under-limit",
+        action="store_true",
+        help="Stop deleting images as soon as the ACR is under --limit, leaving the rest for a later run. The size is estimated from the images deleted and only read from Azure again once the estimate is under the limit.",
+    )
+    parser.add_argument(
+        "--policy",
+        type=str,
+        default=None,
+        help="Path to a JSON retention policy of rules, each with a 'repos' glob and its own 'max_age', 'keep_last' newest images and 'protect' tag globs, deciding which images to delete instead of --max-age alone.",
+    )
+    parser.add_argument(
+        "--policy-report",
+        type=str,
+        default=None,
+        help="With --policy, path to write a CSV of the rule and reason for keeping or deleting every image to.",
+    )
     parser.add_argument(
         "-t",
         "--threads",
         type=int,
-        default=1,
-        help="Number of threads to parallelise over",
+        default=None,
+        help="Number of registry calls to run at once in every stage. Overridden by --list-threads and --delete-threads.",
+    )
+    parser.add_argument(
+        "--list-threads",
+        type=int,
+        default=None,
+        help=f"Number of repositories to list at once. Default: {LIST_THREADS}.",
+    )
+    parser.add_argument(
+        "--delete-threads",
+        type=int,
+        default=None,
+        help=f"Number of images to delete at once. Default: {DELETE_THREADS}.",
+    )
+    parser.add_argument(
+        "--age-mode",
+        type=str,
+        choices=AGE_MODES,
+        default="batch",
+        help="'batch' ages every image at once after listing, keeping memory low. 'per-repo' ages each repository as soon as it is listed. Default: batch.",
+    )
+
+    parser.add_argument(
+        "-b",
+        "--backend",
+        type=str,
+        choices=["az", "http"],
+        default="az",
+        help="How to talk to the ACR: 'az' runs the Azure CLI for every call, 'http' calls the registry API directly over pooled connections. Default: az.",
+    )
+
+    parser.add_argument(
+        "--az-workers",
+        type=int,
+        default=0,
+        help="Keep this many Azure CLI processes running and send az commands to them instead of starting az for every call. Needs azure-cli installed in the same Python environment. Default: 0 (off).",
+    )
+
+    parser.add_argument(
+        "--token-cache",
+        type=str,
+        default=None,
+        help="Path to a file, only readable by you, to keep registry tokens in between runs. With the http backend, runs skip logging in while the cached token is valid.",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        default=None,
+        help="Path to a manifest cache database. Repositories that haven't changed since the last run are read from the cache instead of being listed again.",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Stream repositories, manifests and deletions through a pipeline so deleting starts while repositories are still being listed",
+    )
+
+    parser.add_argument(
+        "--journal",
+        type=str,
+        default=None,
+        help="Path to a journal of the planned and completed deletions, so that an interrupted run can be continued with --resume.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the deletions remaining in --journal without listing the ACR again.",
+    )
+    parser.add_argument(
+        "--time-limit",
+        type=float,
+        default=None,
+        help="Stop starting new deletions after this many minutes, leaving the rest in --journal for a later run with --resume.",
+    )
+
+    parser.add_argument(
+        "--shard",
+        type=str,
+        default=None,
+        help="Only clean shard i of N of the ACR's repositories, given as i/N counting from 0. Run one worker for each shard to spread a clean up over several processes or hosts.",
+    )
+    parser.add_argument(
+        "--report",
+        type=str,
+        default=None,
+        help="Path to write a JSON report of the size of the ACR and the images deleted to. With several ACRs, the status of each is written here instead. With --merge-reports, the merged report is written here.",
+    )
+    parser.add_argument(
+        "--merge-reports",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Combine the --report files of the shards of an ACR into one report and print it, instead of cleaning an ACR.",
+    )
+
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        default=None,
+        help="Path to write call counts, latencies, errors and bytes reclaimed to in the Prometheus text format, for the node exporter's textfile collector or a Pushgateway.",
+    )
+    parser.add_argument(
+        "--summary",
+        type=str,
+        default=None,
+        help="Path to write a JSON summary of the time spent in each stage of the run to.",
     )
 
     parser.add_argument(
@@ -66,25 +213,113 @@ def parse_args(args):
         help="Purge all repositories within the ACR",
     )
     parser.add_argument(
-        "-v", "--verbose", action="store_true", help="Output logs to console",
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Output logs to console",
     )
 
     return parser.parse_args()
 
 
 def check_parser(args):
+    names = getattr(args, "name", None)
+    if getattr(args, "merge_reports", None):
+        if names or getattr(args, "config", None):
+            raise ValueError(
+                "merge-reports doesn't clean an ACR, give no names or config"
+            )
+        return
+
+    if (
+        isinstance(names, list)
+        and not names
+        and not getattr(args, "config", None)
+    ):
+        raise ValueError("give the name of at least one ACR or a config file")
+
+    if is_multi(args):
+        if getattr(args, "pipeline", False):
+            raise ValueError("pipeline can only clean one ACR at a time")
+        if getattr(args, "journal", None):
+            raise ValueError("journal can only be used with one ACR")
+        if getattr(args, "shard", None):
+            raise ValueError("shard can only be used with one ACR")
+
     if args.dry_run and args.purge:
         raise ValueError("purge and dry-run options cannot be used together")
 
-    if args.threads != 1:
-        cpus = cpu_count()
-        if args.threads > cpus:
+    check_pipeline(args)
+
+    if getattr(args, "layers", False) and not getattr(args, "to_limit", False):
+        raise ValueError("layers can only be used with to-limit")
+
+    if (
+        getattr(args, "resume", False)
+        and getattr(args, "journal", None) is None
+    ):
+        raise ValueError("resume needs a journal to continue from")
+
+    if getattr(args, "shard", None):
+        parse_shard(args.shard)
+        if getattr(args, "pipeline", False):
+            raise ValueError("shard cannot be used with pipeline")
+        if getattr(args, "to_limit", False):
+            raise ValueError(
+                "to-limit plans deletions for the whole ACR and cannot be used with shard"
+            )
+
+    check_policy(args)
+
+    for option in ["threads", "list_threads", "delete_threads", "registries"]:
+        value = getattr(args, option, None)
+        if value is not None and value < 1:
             raise ValueError(
-                "You have requested more threads than are available cores on this machine.\n"
-                f"This machine has {cpus} CPUs available.\n"
-                "Please adjust the value of --threads accordingly."
+                "--%s must be at least 1" % option.replace("_", "-")
             )
 
+    time_limit = getattr(args, "time_limit", None)
+    if time_limit is not None and time_limit < 0:
+        raise ValueError("--time-limit cannot be negative")
+
+
+def check_pipeline(args):
+    if not getattr(args, "pipeline", False):
+        return
+
+    if getattr(args, "to_limit", False):
+        raise ValueError(
+            "to-limit needs every image listed before deleting and cannot be used with pipeline"
+        )
+    for option in ["journal", "time_limit", "stop_under_limit"]:
+        value = getattr(args, option, None)
+        # A time limit of 0 minutes is still a time limit
+        if value is not None and value is not False:
+            raise ValueError(
+                "%s cannot be used with pipeline" % option.replace("_", "-")
+            )
+
+
+def check_policy(args):
+    if not getattr(args, "policy", None):
+        if getattr(args, "policy_report", None):
+            raise ValueError("policy-report can only be used with policy")
+        return
+
+    if is_multi(args):
+        raise ValueError("policy can only be used with one ACR")
+    if getattr(args, "to_limit", False):
+        raise ValueError("policy and to-limit options cannot be used together")
+    if getattr(args, "pipeline", False):
+        raise ValueError("policy cannot be used with pipeline")
+
+
+def is_multi(args):
+    names = getattr(args, "name", None)
+    return getattr(args, "config", None) is not None or (
+        isinstance(names, list) and len(names) > 1
+    )
+
 
 def main():
     """Main function"""
@@ -93,15 +328,126 @@ def main():
 
     logging_config(args.verbose)
 
-    run(
-        args.name,
-        args.max_age,
-        args.limit,
-        args.threads,
-        dry_run=args.dry_run,
-        purge=args.purge,
-        identity=args.identity,
-    )
+    if args.merge_reports:
+        report = merge_reports(args.merge_reports)
+        if args.report is not None:
+            with open(args.report, "w") as f:
+                json.dump(report, f)
+        print(json.dumps(report, indent=2))
+        return
+
+    shard = parse_shard(args.shard) if args.shard else None
+
+    # The stages import pandas, so they are only loaded once the arguments
+    # have been checked
+    with collect_metrics(args.metrics, args.summary):
+        if args.pipeline:
+            import asyncio
+            from .pipeline import run_async
+
+            asyncio.run(
+                run_async(
+                    args.name[0],
+                    args.max_age,
+                    args.limit,
+                    list_workers=args.list_threads
+                    or args.threads
+                    or LIST_THREADS,
+                    delete_workers=args.delete_threads
+                    or args.threads
+                    or DELETE_THREADS,
+                    dry_run=args.dry_run,
+                    purge=args.purge,
+                    identity=args.identity,
+                    backend=args.backend,
+                    cache=args.cache,
+                    az_workers=args.az_workers,
+                    token_cache=args.token_cache,
+                )
+            )
+        elif is_multi(args):
+            from .multi import load_registries, run_many
+
+            registries = [
+                {"name": name, "max_age": args.max_age, "limit": args.limit}
+                for name in args.name
+            ]
+            if args.config is not None:
+                registries.extend(
+                    load_registries(args.config, args.max_age, args.limit)
+                )
+
+            results, failed = run_many(
+                registries,
+                workers=args.registries,
+                threads=args.threads,
+                list_threads=args.list_threads,
+                delete_threads=args.delete_threads,
+                identity=args.identity,
+                az_workers=args.az_workers,
+                dry_run=args.dry_run,
+                purge=args.purge,
+                backend=args.backend,
+                cache=args.cache,
+                to_limit=args.to_limit,
+                layers=args.layers,
+                age_mode=args.age_mode,
+                time_limit=(
+                    args.time_limit * 60
+                    if args.time_limit is not None
+                    else None
+                ),
+                token_cache=args.token_cache,
+                stop_under_limit=args.stop_under_limit,
+            )
+
+            if args.report is not None:
+                with open(args.report, "w") as f:
+                    json.dump(results, f)
+            if failed:
+                sys.exit(1)
+        else:
+            from .app import run
+            from .policy import load_policy
+
+            policy = None
+            if args.policy is not None:
+                policy = load_policy(args.policy, args.max_age)
+
+            result = run(
+                args.name[0],
+                args.max_age,
+                args.limit,
+                args.threads,
+                dry_run=args.dry_run,
+                purge=args.purge,
+                identity=args.identity,
+                backend=args.backend,
+                cache=args.cache,
+                to_limit=args.to_limit,
+                layers=args.layers,
+                list_threads=args.list_threads,
+                delete_threads=args.delete_threads,
+                age_mode=args.age_mode,
+                az_workers=args.az_workers,
+                journal=args.journal,
+                resume=args.resume,
+                time_limit=(
+                    args.time_limit * 60
+                    if args.time_limit is not None
+                    else None
+                ),
+                token_cache=args.token_cache,
+                shard=shard,
+                policy=policy,
+                policy_report=args.policy_report,
+                stop_under_limit=args.stop_under_limit,
+            )
+
+            if args.report is not None:
+                write_shard_report(
+                    args.report, args.name[0], shard or (0, 1), result
+                )
 
 
 if __name__ == "__main__":
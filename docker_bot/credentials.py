@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import base64
+import logging
+import threading
+from typing import Optional
+
+logger = logging.getLogger()
+
+# Lifetimes ACR gives its tokens, used when a token doesn't say when it
+# expires
+REFRESH_TOKEN_TTL = 3 * 60 * 60
+ACCESS_TOKEN_TTL = 60 * 60
+
+# A cached refresh token must last at least this long to be used, so it
+# can't expire part way through a run
+REFRESH_TOKEN_MARGIN = 30 * 60
+
+# Access tokens this close to expiry are refreshed before they are needed
+ACCESS_TOKEN_MARGIN = 5 * 60
+
+
+def token_expiry(token: str, ttl: float) -> float:
+    """When a token expires, in seconds since the epoch
+
+    ACR tokens are JWTs carrying their expiry in the "exp" claim. The claim
+    is read without verifying the token, which only the registry can do.
+
+    Args:
+        token (str): The token
+        ttl (float): Seconds the token is assumed to last if it has no
+                     readable expiry
+
+    Returns:
+        float: The expiry time
+    """
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time() + ttl
+
+
+class TokenCache:
+    """Tokens kept on disk between runs, each with its expiry
+
+    The file is only readable by its owner and is always replaced whole, so
+    a reader never sees it half written. Concurrent runs sharing the file
+    merge their tokens into it instead of overwriting each other's.
+
+    Args:
+        path (str): Path to the cache file
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = os.path.expanduser(path)
+        self._lock = threading.Lock()
+        self._tokens = self._load()
+
+    def _load(self) -> dict:
+        try:
+            if os.stat(self.path).st_mode & 0o077:
+                logger.warning(
+                    "Ignoring token cache %s, it can be read by other users"
+                    % self.path
+                )
+                return {}
+            with open(self.path) as f:
+                tokens = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logger.warning("Ignoring unreadable token cache: %s" % self.path)
+            return {}
+
+        now = time.time()
+        return {
+            key: entry
+            for key, entry in tokens.items()
+            if isinstance(entry, dict) and entry.get("expires", 0) > now
+        }
+
+    def get(self, key: str, margin: float = 0.0) -> Optional[dict]:
+        """Return a cached token that is valid for at least `margin` seconds
+
+        Args:
+            key (str): What the token is for
+            margin (float, optional): Seconds the token must still be valid
+                                      for. Defaults to 0.
+
+        Returns:
+            dict: The token under "token", its "expires" time and any other
+                  values stored with it, or None
+        """
+        with self._lock:
+            entry = self._tokens.get(key)
+
+        if entry is None or entry["expires"] - margin <= time.time():
+            return None
+        return entry
+
+    def put(self, key: str, token: str, expires: float, **extra) -> None:
+        """Cache a token until it expires
+
+        Args:
+            key (str): What the token is for
+            token (str): The token
+            expires (float): When it expires, in seconds since the epoch
+            **extra: Other values to store with the token
+        """
+        with self._lock:
+            self._tokens[key] = dict(extra, token=token, expires=expires)
+
+    def save(self) -> None:
+        """Write the unexpired tokens to disk, merged with the file's"""
+        with self._lock:
+            merged = self._load()
+            for key, entry in self._tokens.items():
+                if entry["expires"] > merged.get(key, {}).get("expires", 0):
+                    merged[key] = entry
+            self._tokens = merged
+
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, mode=0o700, exist_ok=True)
+
+            tmp = "%s.%d.tmp" % (self.path, os.getpid())
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(merged, f)
+            os.replace(tmp, self.path)
@@ -0,0 +1,13 @@
+# Defaults shared by the CLI and the clean up stages. They live apart from
+# the stages so that parsing arguments doesn't import pandas.
+
+# Registry calls spend nearly all their time waiting on the network, so
+# each stage runs far more of them at once than there are CPUs. Deletions
+# are throttled by ACR sooner than listings.
+LIST_THREADS = 16
+DELETE_THREADS = 8
+
+# Number of registries cleaned at once
+REGISTRY_THREADS = 4
+
+AGE_MODES = ["batch", "per-repo"]
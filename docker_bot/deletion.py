@@ -0,0 +1,329 @@
+import re
+import time
+import logging
+from typing import Iterable, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .journal import DeletionJournal
+from .throttle import ConcurrencyController, is_throttled
+from .usage import UsageMonitor
+
+logger = logging.getLogger()
+
+# Errors the Azure CLI and the registry API give when asked to delete an
+# image or repository that is already gone. Only the registry's own codes
+# are matched, since a missing registry or az also reports "not found".
+ALREADY_DELETED = re.compile(
+    r"\bManifestUnknown\b|\bMANIFEST_UNKNOWN\b|\bNAME_UNKNOWN\b"
+    r"|manifest \S+ (?:is )?not found in repository"
+)
+
+
+def plan_deletions(images: Iterable[str], repo_counts: Optional[dict] = None):
+    """Group images to be deleted into as few registry calls as possible
+
+    When every image in a repository has been selected for deletion, the
+    whole repository is deleted in one call instead of one call per image.
+
+    Args:
+        images (Iterable[str]): Images to delete -> repo@digest
+        repo_counts (dict, optional): Number of images stored in each
+                                      repository. Without it, every image is
+                                      deleted on its own.
+
+    Returns:
+        list: (kind, name, count) tuples where kind is "image" or "repo"
+              and count is the number of images the call deletes
+    """
+    if repo_counts is None:
+        return [("image", image_name, 1) for image_name in images]
+
+    selected = {}
+    for image_name in images:
+        repo = image_name.split("@", 1)[0]
+        selected.setdefault(repo, []).append(image_name)
+
+    tasks = []
+    for repo, image_names in selected.items():
+        if len(image_names) == repo_counts.get(repo):
+            tasks.append(("repo", repo, len(image_names)))
+        else:
+            tasks.extend(
+                ("image", image_name, 1) for image_name in image_names
+            )
+
+    return tasks
+
+
+def _delete_with_retry(
+    registry,
+    kind: str,
+    name: str,
+    retries: int,
+    backoff: float,
+    controller: Optional[ConcurrencyController] = None,
+) -> int:
+    """Run one deletion, retrying failed attempts with exponential backoff
+
+    Returns:
+        int: The number of registry calls made
+    """
+    delete = registry.delete_repo if kind == "repo" else registry.delete_image
+
+    for attempt in range(retries + 1):
+        try:
+            if controller is None:
+                delete(name)
+            else:
+                controller.call(delete, name)
+            return attempt + 1
+        except (RuntimeError, OSError) as err:
+            # Resumed runs repeat deletions that finished just before a crash
+            if ALREADY_DELETED.search(str(err)):
+                logger.info("%s has already been deleted" % name)
+                return attempt + 1
+            # The controller has already retried throttled calls itself
+            if attempt == retries or (
+                controller is not None and is_throttled(err)
+            ):
+                raise
+            logger.info(
+                "Deleting %s failed, retrying in %.1fs: %s"
+                % (name, backoff * 2**attempt, err)
+            )
+            time.sleep(backoff * 2**attempt)
+
+
+def bulk_delete(
+    registry,
+    images: Iterable[str],
+    workers: int = 1,
+    retries: int = 2,
+    backoff: float = 0.5,
+    repo_counts: Optional[dict] = None,
+    controller: Optional[ConcurrencyController] = None,
+    journal: Optional[DeletionJournal] = None,
+    acr_name: Optional[str] = None,
+    time_limit: Optional[float] = None,
+    sizes: Optional[Iterable[int]] = None,
+    monitor: Optional[UsageMonitor] = None,
+) -> dict:
+    """Delete many images from a registry concurrently
+
+    Failed deletions are retried and then recorded in the report rather than
+    stopping the other deletions. Repositories are deleted in one call when
+    all of their images are selected, according to `repo_counts`, which
+    should come from the same listing as `images`.
+
+    Args:
+        registry (AzCliBackend): The registry backend to delete images with
+        images (Iterable[str]): Images to delete -> repo@digest
+        workers (int, optional): Number of deletions to run at once.
+                                 Defaults to 1.
+        retries (int, optional): Number of times to retry a failed deletion.
+                                 Defaults to 2.
+        backoff (float, optional): Seconds to wait before the first retry,
+                                   doubling for each retry. Defaults to 0.5.
+        repo_counts (dict, optional): Number of images stored in each
+                                      repository. Defaults to None.
+        controller (ConcurrencyController, optional): Adapts the number of
+                                                      deletions in flight
+                                                      to the registry, up
+                                                      to workers. Defaults
+                                                      to None.
+        journal (DeletionJournal, optional): Journal to write the planned
+                                             deletions and each completed
+                                             one to, so that an interrupted
+                                             run can be resumed. Defaults to
+                                             None.
+        acr_name (str, optional): The name of the ACR, recorded in the
+                                  journal. Defaults to None.
+        time_limit (float, optional): Seconds after which no more deletions
+                                      are started. Defaults to no limit.
+        sizes (Iterable[int], optional): Size of each image in bytes, in
+                                         the same order as `images`, for
+                                         the monitor to estimate the size
+                                         of the registry with. Defaults to
+                                         None.
+        monitor (UsageMonitor, optional): Counts the bytes deleted, and may
+                                          stop deletions being started once
+                                          the registry is under its size
+                                          limit. Defaults to None.
+
+    Returns:
+        dict: The number of images deleted and registry calls made, the
+              failures keyed by image or repository name, the number of
+              images skipped by the time limit, the elapsed time in seconds
+              and the number of images deleted per second
+    """
+    images = list(images)
+    tasks = plan_deletions(images, repo_counts)
+
+    if journal is not None:
+        repos = {name for kind, name, _ in tasks if kind == "repo"}
+        covered = {repo: [] for repo in repos}
+        for image_name in images:
+            repo = image_name.split("@", 1)[0]
+            if repo in covered:
+                covered[repo].append(image_name)
+        journal.write_plan(acr_name, tasks, covered)
+
+    # The bytes each deletion frees, whether of one image or a repository
+    task_sizes = None
+    if sizes is not None:
+        repos = {name for kind, name, _ in tasks if kind == "repo"}
+        task_sizes = {}
+        for image_name, size in zip(images, sizes):
+            repo = image_name.split("@", 1)[0]
+            name = repo if repo in repos else image_name
+            task_sizes[name] = task_sizes.get(name, 0) + int(size)
+
+    return run_deletions(
+        registry,
+        tasks,
+        workers=workers,
+        retries=retries,
+        backoff=backoff,
+        controller=controller,
+        journal=journal,
+        time_limit=time_limit,
+        monitor=monitor,
+        task_sizes=task_sizes,
+    )
+
+
+def run_deletions(
+    registry,
+    tasks: list,
+    workers: int = 1,
+    retries: int = 2,
+    backoff: float = 0.5,
+    controller: Optional[ConcurrencyController] = None,
+    journal: Optional[DeletionJournal] = None,
+    time_limit: Optional[float] = None,
+    monitor: Optional[UsageMonitor] = None,
+    task_sizes: Optional[dict] = None,
+) -> dict:
+    """Run planned deletions concurrently
+
+    Args:
+        registry (AzCliBackend): The registry backend to delete images with
+        tasks (list): (kind, name, count) tuples from `plan_deletions` or
+                      `DeletionJournal.remaining`
+        workers (int, optional): Number of deletions to run at once.
+                                 Defaults to 1.
+        retries (int, optional): Number of times to retry a failed deletion.
+                                 Defaults to 2.
+        backoff (float, optional): Seconds to wait before the first retry,
+                                   doubling for each retry. Defaults to 0.5.
+        controller (ConcurrencyController, optional): Adapts the number of
+                                                      deletions in flight
+                                                      to the registry.
+                                                      Defaults to None.
+        journal (DeletionJournal, optional): Journal to record each
+                                             completed deletion in.
+                                             Defaults to None.
+        time_limit (float, optional): Seconds after which no more deletions
+                                      are started. Defaults to no limit.
+        monitor (UsageMonitor, optional): Counts the bytes deleted, and may
+                                          stop deletions being started once
+                                          the registry is under its size
+                                          limit. Defaults to None.
+        task_sizes (dict, optional): Bytes freed by each deletion, keyed by
+                                     image or repository name. Defaults to
+                                     None.
+
+    Returns:
+        dict: The report described in `bulk_delete`
+    """
+    report = {"deleted": 0, "calls": 0, "failed": {}, "skipped": 0}
+    start = time.perf_counter()
+    deadline = None if time_limit is None else start + time_limit
+
+    task_sizes = task_sizes or {}
+
+    def task(kind, name, count):
+        # Deletions still queued at the deadline are left for a resumed run
+        if deadline is not None and time.perf_counter() >= deadline:
+            return None
+        # As are those still queued once enough space has been freed
+        if (
+            monitor is not None
+            and monitor.stop_under_limit
+            and monitor.under_limit()
+        ):
+            return None
+
+        calls = _delete_with_retry(
+            registry, kind, name, retries, backoff, controller
+        )
+        # Counted here so the next deletion started sees the space freed
+        if monitor is not None:
+            monitor.record_deleted(count, task_sizes.get(name, 0))
+        return calls
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(task, kind, name, count): (name, count)
+            for kind, name, count in tasks
+        }
+
+        for future in as_completed(futures):
+            name, count = futures[future]
+            try:
+                calls = future.result()
+            except (RuntimeError, OSError) as err:
+                report["calls"] += retries + 1
+                report["failed"][name] = str(err)
+                continue
+
+            if calls is None:
+                report["skipped"] += count
+                continue
+
+            report["calls"] += calls
+            report["deleted"] += count
+            if journal is not None:
+                journal.record_done(name)
+
+    if journal is not None:
+        journal.close()
+
+    report["elapsed"] = time.perf_counter() - start
+    if controller is not None:
+        report["concurrency"] = controller.snapshot()
+    report["rate"] = (
+        report["deleted"] / report["elapsed"] if report["elapsed"] else 0.0
+    )
+
+    logger.info(
+        "Deleted %d images with %d calls in %.1fs (%.1f images/s), %d failed"
+        % (
+            report["deleted"],
+            report["calls"],
+            report["elapsed"],
+            report["rate"],
+            len(report["failed"]),
+        )
+    )
+    if report["skipped"] and monitor is not None and monitor.under:
+        logger.info(
+            "Registry is under its size limit, %d images were not deleted"
+            % report["skipped"]
+        )
+    elif report["skipped"]:
+        logger.info(
+            "Time limit reached, %d images left to delete with --resume"
+            % report["skipped"]
+        )
+    if controller is not None:
+        logger.info(
+            "%d registry calls were throttled, ending with %d in flight at once"
+            % (
+                report["concurrency"]["throttled"],
+                report["concurrency"]["limit"],
+            )
+        )
+    for name, err in report["failed"].items():
+        logger.error("Could not delete %s: %s" % (name, err))
+
+    return report
@@ -1,26 +1,208 @@
+import io
+import re
+import json
+import codecs
+import tempfile
+import threading
 import subprocess
 
+# When set, az commands are sent to this pool of warm Azure CLI workers
+# instead of starting a new az process for each one
+AZ_POOL = None
 
-def run_cmd(cmd):
+# Bytes read from a command's output at a time when streaming it
+CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = re.compile(r"\s*")
+
+
+def set_az_pool(pool):
+    """Send az commands run with run_cmd to a pool of warm workers
+
+    Parameters
+    ----------
+    pool: AzWorkerPool, or None to start a new az process for every command
+    """
+    global AZ_POOL
+    AZ_POOL = pool
+
+
+def _use_az_pool(cmd):
+    # Interactive logins need a terminal, so they always get their own az
+    return AZ_POOL is not None and cmd[0] == "az" and cmd[1:2] != ["login"]
+
+
+def run_cmd(cmd, timeout=None):
     """Use Popen to run a subprocess command
 
     Parameters
     ----------
     cmd: List of strings.
+    timeout: Seconds to wait before killing the command. Default: no limit.
 
     Returns
     -------
     result: Dictionary
     """
+    if _use_az_pool(cmd):
+        return AZ_POOL.run(cmd, timeout=timeout)
+
     result = {}
 
     proc = subprocess.Popen(
         cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
     )
-    output = proc.communicate()
+    try:
+        output = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        return {
+            "returncode": proc.returncode,
+            "output": "",
+            "err_msg": "%s timed out after %ss" % (" ".join(cmd), timeout),
+        }
 
     result["returncode"] = proc.returncode
     result["output"] = output[0].decode(encoding="utf-8").strip("\n")
     result["err_msg"] = output[1].decode(encoding="utf-8").strip("\n")
 
     return result
+
+
+def iter_json_items(stream, chunk_size=CHUNK_SIZE):
+    """Yield the items of a JSON array as they are read from a stream
+
+    Only the bytes of the items not yet parsed are held in memory, so a
+    large array is never read in full before its first items are used.
+
+    Parameters
+    ----------
+    stream: Buffered binary file object containing a JSON array.
+    chunk_size: Number of bytes to read at a time.
+
+    Yields
+    ------
+    item: Each item of the array, decoded.
+    """
+    decoder = json.JSONDecoder()
+    # Chunks can end part way through a multi-byte character
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    pos = 0
+    started = False
+    eof = False
+
+    while True:
+        pos = WHITESPACE.match(buffer, pos).end()
+
+        if not started and pos < len(buffer):
+            if buffer[pos] != "[":
+                raise ValueError("Expected a JSON array")
+            pos = WHITESPACE.match(buffer, pos + 1).end()
+            started = True
+
+        if started and buffer.startswith(",", pos):
+            pos = WHITESPACE.match(buffer, pos + 1).end()
+
+        if started and buffer.startswith("]", pos):
+            return
+
+        if started and pos < len(buffer):
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # A number at the end of the buffer may be cut short
+                if end < len(buffer) or eof:
+                    yield item
+                    pos = end
+                    continue
+
+        if eof:
+            if started:
+                raise ValueError("Unterminated JSON array")
+            return
+
+        # read1 returns whatever has arrived instead of waiting for a full
+        # chunk
+        chunk = stream.read1(chunk_size)
+        buffer = buffer[pos:] + text.decode(chunk, final=not chunk)
+        pos = 0
+        eof = not chunk
+
+
+def stream_cmd(cmd, timeout=None):
+    """Run a command that prints a JSON array and yield its items as they
+    arrive
+
+    The command is killed if it runs for longer than the timeout, or if the
+    caller stops iterating before the end of the array.
+
+    Parameters
+    ----------
+    cmd: List of strings.
+    timeout: Seconds to wait before killing the command. Default: no limit.
+
+    Yields
+    ------
+    item: Each item of the array printed by the command.
+    """
+    if _use_az_pool(cmd):
+        # Workers send the output back in one piece once the command is
+        # done, but its items are still only decoded as they are used
+        result = AZ_POOL.run(cmd, timeout=timeout)
+        if result["returncode"] != 0:
+            raise RuntimeError(result["err_msg"])
+        yield from iter_json_items(
+            io.BytesIO(result["output"].encode("utf-8") or b"[]")
+        )
+        return
+
+    # stderr goes to a file so a chatty command can't fill its pipe and
+    # stall while we are reading stdout
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+        timer = None
+        timed_out = threading.Event()
+
+        if timeout is not None:
+
+            def kill():
+                timed_out.set()
+                proc.kill()
+
+            timer = threading.Timer(timeout, kill)
+            timer.daemon = True
+            timer.start()
+
+        try:
+            try:
+                yield from iter_json_items(proc.stdout)
+            except ValueError:
+                # Killed or failed commands leave their output cut short,
+                # which is reported below instead
+                if proc.wait() == 0 and not timed_out.is_set():
+                    raise
+
+            proc.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+
+        if timed_out.is_set():
+            raise RuntimeError(
+                "%s timed out after %ss" % (" ".join(cmd), timeout)
+            )
+
+        if proc.returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError(
+                stderr.read().decode(encoding="utf-8").strip("\n")
+            )
@@ -0,0 +1,260 @@
+from array import array
+from itertools import repeat
+from typing import Optional
+from .table import ImageTable
+
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:
+    np = pd = None
+
+COLUMNS = [
+    "image_name",
+    "repo",
+    "digest",
+    "age_days",
+    "image_size",
+    "tags",
+    "timestamp",
+]
+
+# The inventory is a pandas DataFrame when pandas is installed, and an
+# ImageTable of plain lists and arrays ("array") when it isn't
+INVENTORY_BACKEND = "array" if pd is None else "pandas"
+
+
+def use_pandas() -> bool:
+    """Whether inventories are built as pandas DataFrames"""
+    return pd is not None and INVENTORY_BACKEND == "pandas"
+
+
+def require_pandas(feature: str) -> None:
+    """Raise an error if a feature that needs pandas can't use it
+
+    Args:
+        feature (str): What needs pandas, for the error message
+    """
+    if not use_pandas():
+        raise RuntimeError(
+            "%s needs pandas, install it with: pip install pandas" % feature
+        )
+
+
+def make_inventory(
+    repo, digest, age_days, image_size=None, tags=None, timestamp=None
+):
+    """Assemble an image inventory from its columns
+
+    Args:
+        repo (array-like): Repository of each image, a pd.Categorical for a
+                           DataFrame
+        digest (array-like): Manifest digest of each image
+        age_days (array-like): Age of each image in days
+        image_size (array-like, optional): Size of each image in bytes.
+                                           Defaults to 0 if unknown.
+        tags (array-like, optional): Tags of each image joined by commas.
+                                     Defaults to no tags.
+        timestamp (array-like, optional): Time each image was last updated,
+                                          which orders images of the same
+                                          age. Defaults to unknown.
+
+    Returns:
+        pd.DataFrame or ImageTable: One row per image with columns
+                                    image_name (repo@digest), repo
+                                    (categorical), digest (string),
+                                    age_days (int32), image_size (int64),
+                                    tags (string) and timestamp (string)
+    """
+    if not use_pandas():
+        return ImageTable.from_columns(
+            repo, digest, age_days, image_size, tags, timestamp
+        )
+
+    if image_size is None:
+        image_size = np.zeros(len(repo), dtype=np.int64)
+    if tags is None:
+        tags = [""] * len(repo)
+    if timestamp is None:
+        timestamp = [""] * len(repo)
+
+    digest = pd.array(digest, dtype="string")
+    image_name = (
+        pd.Series(repo, dtype="string") + "@" + pd.Series(digest)
+    ).array
+
+    return pd.DataFrame(
+        {
+            "image_name": image_name,
+            "repo": repo,
+            "digest": digest,
+            "age_days": np.asarray(age_days, dtype=np.int32),
+            "image_size": np.asarray(image_size, dtype=np.int64),
+            "tags": pd.array(tags, dtype="string"),
+            "timestamp": pd.array(timestamp, dtype="string"),
+        },
+        columns=COLUMNS,
+    )
+
+
+class ImageRecord:
+    """An image manifest reduced to the fields docker_bot uses
+
+    Args:
+        repo (str): Name of the repository the image is stored in
+        digest (str): Digest of the image manifest
+        timestamp (str): Time the image was last updated
+        size (int, optional): Size of the image in bytes. Defaults to 0.
+        tags (str, optional): The image's tags joined by commas, which tags
+                              can't contain. Defaults to no tags.
+    """
+
+    __slots__ = ("repo", "digest", "timestamp", "size", "tags")
+
+    def __init__(
+        self,
+        repo: str,
+        digest: str,
+        timestamp: str,
+        size: int = 0,
+        tags: str = "",
+    ) -> None:
+        self.repo = repo
+        self.digest = digest
+        self.timestamp = timestamp
+        self.size = size
+        self.tags = tags
+
+    @classmethod
+    def from_manifest(cls, manifest: dict) -> "ImageRecord":
+        """Create a record from a manifest returned by a registry backend"""
+        return cls(
+            manifest["repo"],
+            manifest["digest"],
+            manifest["timestamp"],
+            manifest.get("imageSize") or 0,
+            ",".join(manifest.get("tags") or ()),
+        )
+
+    @property
+    def image_name(self) -> str:
+        return f"{self.repo}@{self.digest}"
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, ImageRecord):
+            return NotImplemented
+        return all(
+            getattr(self, name) == getattr(other, name)
+            for name in self.__slots__
+        )
+
+    def __repr__(self) -> str:
+        return "ImageRecord(%r, %r, %r, %r, %r)" % (
+            self.repo,
+            self.digest,
+            self.timestamp,
+            self.size,
+            self.tags,
+        )
+
+
+class ImageInventory:
+    """Array-backed store of image records
+
+    Repository names are interned in a table and each image keeps only the
+    index of its repository, its digest, timestamp and size, so a manifest
+    costs a few hundred bytes instead of a whole dict. Tags are only kept
+    when asked for, since only retention policies protecting tags use them.
+
+    Args:
+        keep_tags (bool, optional): Keep the tags of each image. Defaults to
+                                    False, leaving every image untagged.
+    """
+
+    def __init__(self, keep_tags: bool = False) -> None:
+        self.keep_tags = keep_tags
+        self.repos = []
+        self._repo_ids = {}
+        self._repo_codes = array("i")
+        self._digests = []
+        self._timestamps = []
+        self._sizes = array("q")
+        self._tags = []
+
+    @classmethod
+    def from_manifests(
+        cls, manifests, keep_tags: bool = False
+    ) -> "ImageInventory":
+        inventory = cls(keep_tags)
+        inventory.extend(manifests)
+        return inventory
+
+    def __len__(self) -> int:
+        return len(self._digests)
+
+    def __iter__(self):
+        for code, digest, timestamp, size, tags in zip(
+            self._repo_codes,
+            self._digests,
+            self._timestamps,
+            self._sizes,
+            self._tags if self.keep_tags else repeat(""),
+        ):
+            yield ImageRecord(self.repos[code], digest, timestamp, size, tags)
+
+    def repo_id(self, repo: str) -> int:
+        """Return the index of a repository in the table, adding it if new"""
+        code = self._repo_ids.get(repo)
+        if code is None:
+            code = self._repo_ids[repo] = len(self.repos)
+            self.repos.append(repo)
+        return code
+
+    def add(self, record: ImageRecord) -> None:
+        """Add an image record to the inventory"""
+        self._repo_codes.append(self.repo_id(record.repo))
+        self._digests.append(record.digest)
+        self._timestamps.append(record.timestamp)
+        self._sizes.append(record.size)
+        if self.keep_tags:
+            self._tags.append(record.tags)
+
+    def extend(self, manifests) -> None:
+        """Add image manifests, or records, to the inventory
+
+        Args:
+            manifests (Iterable): Manifests as returned by a registry
+                                  backend, or ImageRecords
+        """
+        for manifest in manifests:
+            if not isinstance(manifest, ImageRecord):
+                manifest = ImageRecord.from_manifest(manifest)
+            self.add(manifest)
+
+    @property
+    def repo(self):
+        if not use_pandas():
+            return [self.repos[code] for code in self._repo_codes]
+
+        codes = np.frombuffer(self._repo_codes, dtype=np.intc)
+        return pd.Categorical.from_codes(
+            codes.astype(np.int32), categories=list(self.repos)
+        )
+
+    @property
+    def digests(self) -> list:
+        return self._digests
+
+    @property
+    def timestamps(self) -> list:
+        return self._timestamps
+
+    @property
+    def tags(self) -> Optional[list]:
+        return self._tags if self.keep_tags else None
+
+    @property
+    def sizes(self):
+        if not use_pandas():
+            return self._sizes
+        return np.frombuffer(self._sizes, dtype=np.int64)
@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import logging
+import threading
+from typing import Optional
+
+logger = logging.getLogger()
+
+# Completed deletions are synced to disk after this many are recorded
+SYNC_EVERY = 100
+
+
+class DeletionJournal:
+    """Append-only JSON lines journal of a run's planned and completed
+    deletions
+
+    The plan is written and synced before the first deletion starts, and
+    each completed deletion is appended as it finishes. Completions are
+    synced to disk in batches of `sync_every`, so a crash can lose at most
+    the last batch. Those deletions are simply run again on resume, where
+    they find the image already gone.
+
+    Repository deletions are journalled with the images they were planned to
+    cover. Images may have been pushed to the repository since, so one that
+    hasn't completed is resumed by deleting those images one at a time
+    rather than the whole repository.
+
+    Args:
+        path (str): Path to the journal file
+        sync_every (int, optional): Number of completions to record between
+                                    syncs. Defaults to SYNC_EVERY.
+    """
+
+    def __init__(self, path: str, sync_every: int = SYNC_EVERY) -> None:
+        self.path = path
+        self.sync_every = sync_every
+        self._file = None
+        self._unsynced = 0
+        self._lock = threading.Lock()
+
+    def _sync(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def write_plan(
+        self, acr_name: str, tasks: list, covered: Optional[dict] = None
+    ) -> None:
+        """Start a new journal with the deletions planned for an ACR
+
+        Any previous journal at the same path is replaced.
+
+        Args:
+            acr_name (str): The name of the ACR being cleaned
+            tasks (list): (kind, name, count) tuples from `plan_deletions`
+            covered (dict, optional): The images -> repo@digest each
+                                      repository deletion in `tasks` was
+                                      planned to delete, keyed by
+                                      repository. Needed if there are any.
+        """
+        covered = covered or {}
+        missing = [
+            name
+            for kind, name, _ in tasks
+            if kind == "repo" and name not in covered
+        ]
+        if missing:
+            raise ValueError(
+                "Journalling a repository deletion needs its images: %s"
+                % ", ".join(missing)
+            )
+
+        self.close()
+        tmp = "%s.tmp" % self.path
+
+        with open(tmp, "w") as f:
+            f.write(
+                json.dumps(
+                    {
+                        "acr": acr_name,
+                        "created": time.time(),
+                        "tasks": len(tasks),
+                    }
+                )
+                + "\n"
+            )
+            for kind, name, count in tasks:
+                record = {"plan": [kind, name, count]}
+                if kind == "repo":
+                    record["images"] = list(covered[name])
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        # Only a fully written plan ever replaces the old journal
+        os.replace(tmp, self.path)
+        self._file = open(self.path, "a")
+        logger.info(
+            "Journalled %d planned deletions to: %s" % (len(tasks), self.path)
+        )
+
+    def record_done(self, name: str) -> None:
+        """Record that a planned deletion has completed
+
+        Args:
+            name (str): The image or repository that was deleted
+        """
+        with self._lock:
+            self._file.write(json.dumps({"done": name}) + "\n")
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every:
+                self._sync()
+
+    def remaining(self, acr_name: str) -> list:
+        """Read back the planned deletions that haven't completed yet
+
+        Repository deletions that haven't completed are replaced with the
+        deletions of the images they covered, leaving any pushed since. The
+        journal is then reopened so that further completions are appended to
+        it.
+
+        Args:
+            acr_name (str): The name of the ACR being cleaned, which must be
+                            the one the plan was made for
+
+        Returns:
+            list: (kind, name, count) tuples of the remaining deletions
+        """
+        self.close()
+
+        if not os.path.exists(self.path):
+            raise RuntimeError("No deletion journal found at: %s" % self.path)
+
+        tasks = []
+        covered = {}
+        done = set()
+
+        with open(self.path) as f:
+            line = f.readline()
+            header = json.loads(line or "{}")
+            if header.get("acr") != acr_name:
+                raise RuntimeError(
+                    "%s holds deletions for ACR %s, not %s"
+                    % (self.path, header.get("acr"), acr_name)
+                )
+
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A crash can cut the last line short
+                    continue
+                if "plan" in record:
+                    tasks.append(tuple(record["plan"]))
+                    if "images" in record:
+                        covered[record["plan"][1]] = record["images"]
+                elif "done" in record:
+                    done.add(record["done"])
+
+        self._file = open(self.path, "a")
+        if line and not line.endswith("\n"):
+            self._file.write("\n")
+        remaining = []
+        for kind, name, count in tasks:
+            if name in done:
+                continue
+            if kind != "repo":
+                remaining.append((kind, name, count))
+                continue
+
+            # An earlier resume may have deleted some of its images already
+            logger.info(
+                "Resuming the deletion of repository %s one image at a time"
+                % name
+            )
+            remaining.extend(
+                ("image", image_name, 1)
+                for image_name in covered.get(name, [])
+                if image_name not in done
+            )
+        logger.info(
+            "%d of %d journalled deletions remaining"
+            % (len(remaining), len(tasks))
+        )
+
+        return remaining
+
+    def close(self) -> None:
+        """Sync any unsynced completions and close the journal"""
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
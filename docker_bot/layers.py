@@ -0,0 +1,152 @@
+import logging
+from functools import partial
+from typing import Iterable, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .throttle import ConcurrencyController
+
+logger = logging.getLogger()
+
+
+def manifest_blobs(body: dict) -> dict:
+    """Return the blobs an image manifest references
+
+    Manifest lists and OCI indexes only point at other manifests, which are
+    stored as images in their own right, so they reference no blobs.
+
+    Args:
+        body (dict): The image manifest
+
+    Returns:
+        dict: The size in bytes of each blob, keyed by its digest
+    """
+    blobs = {}
+
+    for blob in [body.get("config")] + list(body.get("layers") or []):
+        if blob:
+            blobs[blob["digest"]] = int(blob.get("size") or 0)
+
+    return blobs
+
+
+class LayerIndex:
+    """Index of the layer and config blobs referenced by each image
+
+    A registry stores each blob once however many images reference it, so
+    deleting an image only frees the blobs no other image still references.
+    """
+
+    def __init__(self) -> None:
+        self.blob_sizes = {}
+        self.image_blobs = {}
+        self.refs = {}
+
+    def __len__(self) -> int:
+        return len(self.image_blobs)
+
+    def __contains__(self, image_name: str) -> bool:
+        return image_name in self.image_blobs
+
+    def add(self, image_name: str, body: dict) -> None:
+        """Add an image to the index
+
+        Args:
+            image_name (str): The image -> repo@digest
+            body (dict): The image manifest
+        """
+        if image_name in self.image_blobs:
+            return
+
+        blobs = manifest_blobs(body)
+        self.blob_sizes.update(blobs)
+        self.image_blobs[image_name] = tuple(blobs)
+
+        for blob in blobs:
+            self.refs.setdefault(blob, set()).add(image_name)
+
+    def total_bytes(self) -> int:
+        """Return the bytes stored by all the unique blobs in the index"""
+        return sum(self.blob_sizes.values())
+
+    def reclaimed_in_order(self, image_names: Iterable[str]) -> list:
+        """Return the bytes freed by deleting each image in turn
+
+        A blob is freed by deleting the last image that references it.
+        Images missing from the index free nothing.
+
+        Args:
+            image_names (Iterable[str]): Images to delete, in order
+
+        Returns:
+            list: The bytes freed by deleting each image
+        """
+        remaining = {}
+        freed = []
+
+        for image_name in image_names:
+            nbytes = 0
+
+            for blob in self.image_blobs.get(image_name, ()):
+                count = remaining.get(blob, len(self.refs[blob])) - 1
+                remaining[blob] = count
+                if count == 0:
+                    nbytes += self.blob_sizes[blob]
+
+            freed.append(nbytes)
+
+        return freed
+
+    def reclaimable_bytes(self, image_names: Iterable[str]) -> int:
+        """Return the bytes freed by deleting a set of images
+
+        Args:
+            image_names (Iterable[str]): Images to delete
+
+        Returns:
+            int: The bytes freed
+        """
+        return sum(self.reclaimed_in_order(set(image_names)))
+
+
+def build_layer_index(
+    registry,
+    image_names: Iterable[str],
+    workers: int = 1,
+    controller: Optional[ConcurrencyController] = None,
+) -> LayerIndex:
+    """Fetch the manifest of every image concurrently and index its blobs
+
+    Args:
+        registry (AzCliBackend): The registry backend to fetch manifests with
+        image_names (Iterable[str]): Images to index -> repo@digest
+        workers (int, optional): Number of manifests to fetch at once.
+                                 Defaults to 1.
+        controller (ConcurrencyController, optional): Adapts the number of
+                                                      fetches in flight to
+                                                      the registry, up to
+                                                      workers. Defaults to
+                                                      None.
+
+    Returns:
+        LayerIndex: The index of the blobs referenced by each image
+    """
+    index = LayerIndex()
+    fetch = registry.pull_manifest_body
+
+    if controller is not None:
+        fetch = partial(controller.call, registry.pull_manifest_body)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(fetch, image_name): image_name
+            for image_name in image_names
+        }
+
+        for future in as_completed(futures):
+            index.add(futures.pop(future), future.result())
+
+    logger.info(
+        "Indexed %d blobs (%.2f GB) referenced by %d images"
+        % (len(index.blob_sizes), index.total_bytes() * 1.0e-9, len(index))
+    )
+
+    return index
@@ -0,0 +1,369 @@
+import os
+import json
+import time
+import logging
+import inspect
+import datetime
+import functools
+import threading
+from typing import Optional
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+
+# When set, instrumented calls are recorded here. While it is None an
+# instrumented call costs one global lookup.
+METRICS = None
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+PREFIX = "docker_bot"
+
+
+class RunMetrics:
+    """Call counts, latencies and errors of each stage of a run
+
+    Every stage gets a latency histogram with the same BUCKETS, so the
+    metrics can be aggregated across runs by Prometheus.
+    """
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.reclaimed_bytes = 0
+        self._stages = {}
+        self._controllers = []
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float, error: bool = False) -> None:
+        """Record one call of a stage
+
+        Args:
+            stage (str): Name of the stage
+            seconds (float): How long the call took
+            error (bool, optional): Whether the call raised an error.
+                                    Defaults to False.
+        """
+        with self._lock:
+            stats = self._stages.get(stage)
+            if stats is None:
+                stats = self._stages[stage] = {
+                    "calls": 0,
+                    "errors": 0,
+                    "seconds": 0.0,
+                    "max_seconds": 0.0,
+                    "buckets": [0] * len(BUCKETS),
+                }
+
+            stats["calls"] += 1
+            stats["errors"] += error
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    stats["buckets"][i] += 1
+                    break
+
+    def add_reclaimed(self, n_bytes: float) -> None:
+        with self._lock:
+            self.reclaimed_bytes += n_bytes
+
+    def watch(self, controller) -> None:
+        """Report the concurrency limit and throttled calls of a
+        ConcurrencyController with the metrics
+        """
+        with self._lock:
+            if not any(c is controller for c in self._controllers):
+                self._controllers.append(controller)
+
+    def concurrency(self) -> Optional[dict]:
+        """The current concurrency limit and the calls throttled so far,
+        over all the controllers watched, or None if there are none
+        """
+        with self._lock:
+            controllers = list(self._controllers)
+        if not controllers:
+            return None
+
+        snapshots = [controller.snapshot() for controller in controllers]
+        return {
+            "limit": sum(snapshot["limit"] for snapshot in snapshots),
+            "throttled": sum(snapshot["throttled"] for snapshot in snapshots),
+        }
+
+    def summary(self) -> dict:
+        """The metrics of the run so far as a JSON serialisable dict"""
+        with self._lock:
+            stages = {
+                stage: {
+                    "calls": stats["calls"],
+                    "errors": stats["errors"],
+                    "seconds": stats["seconds"],
+                    "mean_seconds": stats["seconds"] / stats["calls"],
+                    "max_seconds": stats["max_seconds"],
+                }
+                for stage, stats in sorted(self._stages.items())
+            }
+
+        summary = {
+            "started": datetime.datetime.utcfromtimestamp(
+                self.started
+            ).isoformat()
+            + "Z",
+            "duration_seconds": time.time() - self.started,
+            "reclaimed_bytes": self.reclaimed_bytes,
+            "stages": stages,
+        }
+
+        concurrency = self.concurrency()
+        if concurrency is not None:
+            summary["concurrency"] = concurrency
+
+        return summary
+
+    def to_prometheus(self) -> str:
+        """The metrics of the run so far in the Prometheus text format
+
+        The output can be read by the node exporter's textfile collector or
+        pushed to a Pushgateway as is.
+        """
+        with self._lock:
+            stages = {
+                stage: dict(stats, buckets=list(stats["buckets"]))
+                for stage, stats in sorted(self._stages.items())
+            }
+
+        lines = [
+            "# HELP %s_calls_total Calls made in each stage of the run"
+            % PREFIX,
+            "# TYPE %s_calls_total counter" % PREFIX,
+        ]
+        lines.extend(
+            '%s_calls_total{stage="%s"} %d' % (PREFIX, stage, stats["calls"])
+            for stage, stats in stages.items()
+        )
+
+        lines.extend(
+            [
+                "# HELP %s_errors_total Calls that raised an error in each "
+                "stage of the run" % PREFIX,
+                "# TYPE %s_errors_total counter" % PREFIX,
+            ]
+        )
+        lines.extend(
+            '%s_errors_total{stage="%s"} %d' % (PREFIX, stage, stats["errors"])
+            for stage, stats in stages.items()
+        )
+
+        name = "%s_call_duration_seconds" % PREFIX
+        lines.extend(
+            [
+                "# HELP %s Latency of the calls in each stage of the run"
+                % name,
+                "# TYPE %s histogram" % name,
+            ]
+        )
+        for stage, stats in stages.items():
+            cumulative = 0
+            for bound, count in zip(BUCKETS, stats["buckets"]):
+                cumulative += count
+                lines.append(
+                    '%s_bucket{stage="%s",le="%s"} %d'
+                    % (name, stage, bound, cumulative)
+                )
+            lines.append(
+                '%s_bucket{stage="%s",le="+Inf"} %d'
+                % (name, stage, stats["calls"])
+            )
+            lines.append(
+                '%s_sum{stage="%s"} %r' % (name, stage, stats["seconds"])
+            )
+            lines.append(
+                '%s_count{stage="%s"} %d' % (name, stage, stats["calls"])
+            )
+
+        summary = self.summary()
+        gauges = [
+            (
+                "reclaimed_bytes",
+                "gauge",
+                "Bytes freed in the ACR by the run",
+                summary["reclaimed_bytes"],
+            ),
+            (
+                "run_duration_seconds",
+                "gauge",
+                "How long the run took",
+                summary["duration_seconds"],
+            ),
+            (
+                "run_start_timestamp_seconds",
+                "gauge",
+                "When the run started, in seconds since the epoch",
+                self.started,
+            ),
+        ]
+        if "concurrency" in summary:
+            gauges.extend(
+                [
+                    (
+                        "concurrency_limit",
+                        "gauge",
+                        "Registry calls allowed in flight at the end of the "
+                        "run",
+                        summary["concurrency"]["limit"],
+                    ),
+                    (
+                        "throttled_calls_total",
+                        "counter",
+                        "Registry calls throttled by the registry",
+                        summary["concurrency"]["throttled"],
+                    ),
+                ]
+            )
+
+        for metric, kind, help_text, value in gauges:
+            lines.extend(
+                [
+                    "# HELP %s_%s %s" % (PREFIX, metric, help_text),
+                    "# TYPE %s_%s %s" % (PREFIX, metric, kind),
+                    "%s_%s %r" % (PREFIX, metric, float(value)),
+                ]
+            )
+
+        return "\n".join(lines) + "\n"
+
+
+def set_metrics(metrics: Optional[RunMetrics]) -> None:
+    """Record instrumented calls in metrics, or stop recording if None"""
+    global METRICS
+    METRICS = metrics
+
+
+def _instrument_generator(stage: str, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        metrics = METRICS
+        if metrics is None:
+            return (yield from func(*args, **kwargs))
+
+        items = func(*args, **kwargs)
+        seconds = 0.0
+        error = False
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration as stop:
+                    return stop.value
+                except BaseException:
+                    error = True
+                    raise
+                finally:
+                    seconds += time.perf_counter() - start
+                yield item
+        finally:
+            items.close()
+            metrics.observe(stage, seconds, error)
+
+    return wrapper
+
+
+def instrument(stage: str):
+    """Decorate a function to record its calls as a stage of the run
+
+    A generator's call is recorded once it is exhausted or closed, and only
+    counts the time spent producing its items, not the time its caller
+    spends between them.
+
+    Args:
+        stage (str): Name of the stage the function's calls count towards
+    """
+
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            return _instrument_generator(stage, func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            metrics = METRICS
+            if metrics is None:
+                return func(*args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                metrics.observe(stage, time.perf_counter() - start, True)
+                raise
+            metrics.observe(stage, time.perf_counter() - start)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def record_reclaimed(n_bytes: float) -> None:
+    """Add to the bytes reclaimed by the run, if metrics are being recorded"""
+    metrics = METRICS
+    if metrics is not None:
+        metrics.add_reclaimed(n_bytes)
+
+
+def watch_controller(controller) -> None:
+    """Report a ConcurrencyController with the run's metrics, if metrics are
+    being recorded
+    """
+    metrics = METRICS
+    if metrics is not None:
+        metrics.watch(controller)
+
+
+def _write_atomic(path: str, text: str) -> None:
+    # Collectors must never read a half written file
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+@contextmanager
+def collect_metrics(
+    prometheus: Optional[str] = None, summary: Optional[str] = None
+):
+    """Record the metrics of a run and write them out when it ends
+
+    The files are written however the run ends, including when it fails or
+    exits early. Nothing is recorded if neither path is given.
+
+    Args:
+        prometheus (str, optional): Path to write the metrics to in the
+                                    Prometheus text format. Defaults to None.
+        summary (str, optional): Path to write a JSON summary of the run to.
+                                 Defaults to None.
+
+    Yields:
+        RunMetrics: The metrics being recorded, or None
+    """
+    if prometheus is None and summary is None:
+        yield None
+        return
+
+    metrics = RunMetrics()
+    set_metrics(metrics)
+
+    try:
+        yield metrics
+    finally:
+        set_metrics(None)
+
+        if prometheus is not None:
+            _write_atomic(prometheus, metrics.to_prometheus())
+            logger.info("Wrote metrics to: %s" % prometheus)
+        if summary is not None:
+            _write_atomic(
+                summary, json.dumps(metrics.summary(), indent=2) + "\n"
+            )
+            logger.info("Wrote run summary to: %s" % summary)
@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import logging
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from .app import azure_login, run
+from .azpool import AzWorkerPool
+from .defaults import DELETE_THREADS, LIST_THREADS, REGISTRY_THREADS
+from .helper_functions import set_az_pool
+from .throttle import ConcurrencyController
+
+logger = logging.getLogger()
+
+
+def load_registries(path: str, max_age: int, limit: float) -> list:
+    """Read the registries to clean from a JSON config file
+
+    The file holds a list of registries, or an object with the list under
+    "registries". Each registry is either its name or an object with a
+    "name" and, optionally, its own "max_age" and "limit".
+
+    Args:
+        path (str): Path to the config file
+        max_age (int): The maximum image age in days for registries that
+                       don't set their own
+        limit (float): The maximum size in TB for registries that don't set
+                       their own
+
+    Returns:
+        list: A dict with the name, max_age and limit of each registry
+    """
+    with open(path) as f:
+        config = json.load(f)
+
+    if isinstance(config, dict):
+        config = config.get("registries", [])
+
+    registries = []
+    for entry in config:
+        if isinstance(entry, str):
+            entry = {"name": entry}
+        if "name" not in entry:
+            raise ValueError("Every registry in %s needs a name" % path)
+
+        registries.append(
+            {
+                "name": entry["name"],
+                "max_age": entry.get("max_age", max_age),
+                "limit": entry.get("limit", limit),
+            }
+        )
+
+    return registries
+
+
+def registry_cache(cache: Optional[str], acr_name: str) -> Optional[str]:
+    """The path of an ACR's own manifest cache, next to the given path"""
+    if cache is None:
+        return None
+    root, ext = os.path.splitext(cache)
+    return "%s-%s%s" % (root, acr_name, ext)
+
+
+def run_many(
+    registries: list,
+    workers: int = REGISTRY_THREADS,
+    threads: Optional[int] = None,
+    list_threads: Optional[int] = None,
+    delete_threads: Optional[int] = None,
+    identity: bool = False,
+    az_workers: int = 0,
+    cache: Optional[str] = None,
+    **kwargs,
+) -> dict:
+    """Clean several ACRs at once in one process
+
+    Azure is logged into once for all the registries, and they share one
+    pool of az workers and one ConcurrencyController. The larger of
+    list_threads and delete_threads is the budget of registry calls in
+    flight across all the registries, not for each one.
+
+    Args:
+        registries (list): A dict with the name, max_age and limit of each
+                           registry, as returned by `load_registries`
+        workers (int, optional): Number of registries to clean at once.
+                                 Defaults to REGISTRY_THREADS.
+        threads (int, optional): The number of registry calls each stage
+                                 runs at once, unless set per stage.
+                                 Defaults to None.
+        list_threads (int, optional): Number of repositories to list at
+                                      once in each registry. Defaults to
+                                      threads, or LIST_THREADS.
+        delete_threads (int, optional): Number of deletions to run at once
+                                        in each registry. Defaults to
+                                        threads, or DELETE_THREADS.
+        identity (bool, optional): Login to Azure with a Managed Identity.
+                                   Defaults to False.
+        az_workers (int, optional): Number of warm Azure CLI workers shared
+                                    by all the registries. Defaults to 0.
+        cache (str, optional): Path to a manifest cache database. Each
+                               registry gets its own, named after it, since
+                               different registries can hold repositories
+                               with the same name. Defaults to None.
+        **kwargs: Passed on to `run` for every registry
+
+    Returns:
+        report (dict): For each registry, its status ("ok" or "failed"),
+                       final size in GB, number of images deleted, the error
+                       if it failed, and the seconds it took
+        failed (list): The names of the registries that failed
+    """
+    list_threads = list_threads or threads or LIST_THREADS
+    delete_threads = delete_threads or threads or DELETE_THREADS
+    controller = ConcurrencyController(
+        initial=min(list_threads, delete_threads),
+        maximum=max(list_threads, delete_threads),
+    )
+
+    azure_login(identity=identity)
+
+    pool = None
+    if az_workers:
+        logger.info("Starting %d az workers" % az_workers)
+        pool = AzWorkerPool(az_workers)
+        set_az_pool(pool)
+
+    def clean(registry: dict) -> dict:
+        result = {"status": "ok", "size": None, "deleted": 0, "error": None}
+        start = time.perf_counter()
+
+        try:
+            result.update(
+                run(
+                    registry["name"],
+                    registry["max_age"],
+                    registry["limit"],
+                    list_threads=list_threads,
+                    delete_threads=delete_threads,
+                    identity=identity,
+                    controller=controller,
+                    logged_in=True,
+                    cache=registry_cache(cache, registry["name"]),
+                    **kwargs,
+                )
+            )
+        except Exception as err:
+            logger.error("Cleaning %s failed: %s" % (registry["name"], err))
+            result["status"] = "failed"
+            result["error"] = str(err)
+
+        result["elapsed"] = time.perf_counter() - start
+        return result
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(clean, registries)
+            report = {
+                registry["name"]: result
+                for registry, result in zip(registries, results)
+            }
+    finally:
+        if pool is not None:
+            set_az_pool(None)
+            pool.close()
+
+    for name, result in report.items():
+        logger.info(
+            "%s: %s, %d images deleted in %.1fs%s"
+            % (
+                name,
+                result["status"],
+                result["deleted"],
+                result["elapsed"],
+                (
+                    ""
+                    if result["size"] is None
+                    else ", %.2f GB remaining" % result["size"]
+                ),
+            )
+        )
+
+    failed = [name for name, result in report.items() if result["error"]]
+    if failed:
+        logger.error(
+            "Could not clean %d of %d registries: %s"
+            % (len(failed), len(report), ", ".join(failed))
+        )
+
+    return report, failed
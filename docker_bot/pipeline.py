@@ -0,0 +1,352 @@
+import asyncio
+import logging
+from typing import Optional
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from .app import compute_image_ages, get_backend
+from .metrics import instrument, record_reclaimed, watch_controller
+from .throttle import ConcurrencyController
+
+logger = logging.getLogger()
+
+# Marks the end of a queue for the workers consuming from it
+DONE = object()
+
+
+@instrument("pull_manifest_page")
+def next_page(iterator, page_size: int) -> list:
+    """Take up to page_size items from an iterator"""
+    return list(islice(iterator, page_size))
+
+
+class _PageReader:
+    """Read a repository's manifests a page at a time
+
+    A listing that fails part way is started again on the next read,
+    skipping the manifests already read, so a throttled page can be
+    retried.
+    """
+
+    def __init__(self, registry, repo: str, page_size: int):
+        self.registry = registry
+        self.repo = repo
+        self.page_size = page_size
+        self.read = 0
+        self.manifests = None
+
+    def __call__(self) -> list:
+        if self.manifests is None:
+            self.manifests = islice(
+                self.registry.iter_manifests(
+                    self.repo, page_size=self.page_size
+                ),
+                self.read,
+                None,
+            )
+
+        try:
+            page = next_page(self.manifests, self.page_size)
+        except Exception:
+            self.manifests = None
+            raise
+
+        self.read += len(page)
+        return page
+
+
+async def _produce_repos(
+    loop, executor, registry, repo_queue, list_workers, stats
+):
+    repos = await loop.run_in_executor(executor, registry.pull_repos)
+    stats["repos"] = len(repos)
+
+    for repo in repos:
+        await repo_queue.put(repo)
+
+    for _ in range(list_workers):
+        await repo_queue.put(DONE)
+
+
+async def _list_worker(
+    loop,
+    executor,
+    registry,
+    repo_queue,
+    delete_queue,
+    max_age,
+    page_size,
+    stats,
+    state,
+    controller,
+):
+    while True:
+        repo = await repo_queue.get()
+        if repo is DONE:
+            # The last lister to finish tells the deleters to stop
+            state["listers"] -= 1
+            if state["listers"] == 0:
+                for _ in range(state["deleters"]):
+                    await delete_queue.put(DONE)
+            return
+
+        # Age and queue each page of manifests as soon as it arrives
+        read_page = _PageReader(registry, repo, page_size)
+
+        while True:
+            if controller is None:
+                page = await loop.run_in_executor(executor, read_page)
+            else:
+                page = await loop.run_in_executor(
+                    executor, controller.call, read_page
+                )
+            if not page:
+                break
+
+            stats["manifests"] += len(page)
+            image_df = compute_image_ages(page, keep_tags=False)
+            if max_age is not None:
+                image_df = image_df.loc[image_df["age_days"] >= max_age]
+
+            stats["eligible"] += len(image_df)
+            for image_name in image_df["image_name"]:
+                await delete_queue.put(image_name)
+
+
+async def _delete_worker(
+    loop, executor, registry, delete_queue, dry_run, stats, controller
+):
+    while True:
+        image_name = await delete_queue.get()
+        if image_name is DONE:
+            return
+
+        if dry_run:
+            continue
+
+        if controller is None:
+            await loop.run_in_executor(
+                executor, registry.delete_image, image_name
+            )
+        else:
+            await loop.run_in_executor(
+                executor, controller.call, registry.delete_image, image_name
+            )
+        stats["deleted"] += 1
+
+
+async def _gather_or_cancel(tasks: list) -> list:
+    """Wait for all tasks, cancelling the rest as soon as one fails"""
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def stream_cleanup(
+    registry,
+    max_age: int,
+    list_workers: int = 4,
+    delete_workers: int = 4,
+    queue_size: int = 1000,
+    page_size: int = 1000,
+    dry_run: bool = False,
+    controller: Optional[ConcurrencyController] = None,
+) -> dict:
+    """Stream repositories, manifests and deletions through bounded queues
+
+    Each page of a repository's manifests is aged and its old images queued
+    for deletion as soon as it arrives, so deletions start while
+    repositories are still being listed. Each stage has its own number
+    of workers, and the blocking registry calls run on one shared thread
+    pool for the lifetime of the pipeline.
+
+    Args:
+        registry (AzCliBackend): The registry backend to talk to the ACR with
+        max_age (int): The maximum image age in days. If None, every image
+                       is deleted.
+        list_workers (int, optional): Number of repositories to list at once.
+                                      Defaults to 4.
+        delete_workers (int, optional): Number of images to delete at once.
+                                        Defaults to 4.
+        queue_size (int, optional): Maximum number of items waiting between
+                                    stages. Defaults to 1000.
+        page_size (int, optional): Number of manifests to list and age at a
+                                   time. Defaults to 1000.
+        dry_run (bool, optional): Don't delete any images from the ACR.
+                                  Defaults to False.
+        controller (ConcurrencyController, optional): Limits the listings
+                                                      and deletions in
+                                                      flight together, and
+                                                      backs both off when
+                                                      the registry throttles
+                                                      either. Defaults to
+                                                      None.
+
+    Returns:
+        dict: Counts of repos, manifests, eligible and deleted images
+    """
+    loop = asyncio.get_running_loop()
+    repo_queue = asyncio.Queue(maxsize=queue_size)
+    delete_queue = asyncio.Queue(maxsize=queue_size)
+    stats = {"repos": 0, "manifests": 0, "eligible": 0, "deleted": 0}
+    state = {"listers": list_workers, "deleters": delete_workers}
+
+    with ThreadPoolExecutor(
+        max_workers=list_workers + delete_workers + 1
+    ) as executor:
+        deleters = [
+            loop.create_task(
+                _delete_worker(
+                    loop,
+                    executor,
+                    registry,
+                    delete_queue,
+                    dry_run,
+                    stats,
+                    controller,
+                )
+            )
+            for _ in range(delete_workers)
+        ]
+        listers = [
+            loop.create_task(
+                _list_worker(
+                    loop,
+                    executor,
+                    registry,
+                    repo_queue,
+                    delete_queue,
+                    max_age,
+                    page_size,
+                    stats,
+                    state,
+                    controller,
+                )
+            )
+            for _ in range(list_workers)
+        ]
+        producer = loop.create_task(
+            _produce_repos(
+                loop, executor, registry, repo_queue, list_workers, stats
+            )
+        )
+
+        await _gather_or_cancel([producer] + listers + deleters)
+
+    return stats
+
+
+async def run_async(
+    acr_name: str,
+    max_age: int,
+    limit: float,
+    list_workers: int = 4,
+    delete_workers: int = 4,
+    dry_run: bool = False,
+    purge: bool = False,
+    identity: bool = False,
+    backend: str = "az",
+    cache: Optional[str] = None,
+    az_workers: int = 0,
+    token_cache: Optional[str] = None,
+) -> dict:
+    """Run the Docker Clean Up process as a streaming pipeline
+
+    Args:
+        acr_name (str): The name of the ACR to clean
+        max_age (int): The maximum image age in days
+        limit (float): The maximum size limit of the ACR in TB
+        list_workers (int, optional): Number of repositories to list at once.
+                                      Defaults to 4.
+        delete_workers (int, optional): Number of images to delete at once.
+                                        Defaults to 4.
+        dry_run (bool, optional): Don't delete any images from the ACR.
+                                  Defaults to False.
+        purge (bool, optional): Delete all images from the ACR.
+                                Defaults to False.
+        identity (bool, optional): Login to Azure with a Managed Identity.
+                                   Defaults to False.
+        backend (str, optional): How to talk to the ACR, "az" or "http".
+                                 Defaults to "az".
+        cache (str, optional): Path to a manifest cache database so that
+                               unchanged repositories aren't listed again.
+                               Defaults to None.
+        az_workers (int, optional): Number of warm Azure CLI workers to run
+                                    az commands on. Defaults to 0.
+        token_cache (str, optional): Path to a file to keep registry tokens
+                                     in between runs, used by the "http"
+                                     backend. Defaults to None.
+
+    Returns:
+        dict: Counts of repos, manifests, eligible and deleted images
+    """
+    registry = get_backend(
+        backend,
+        acr_name,
+        cache=cache,
+        identity=identity,
+        pool_size=list_workers + delete_workers,
+        az_workers=az_workers,
+        token_cache=token_cache,
+    )
+    stats = {"repos": 0, "manifests": 0, "eligible": 0, "deleted": 0}
+
+    if dry_run:
+        logger.info("THIS IS A DRY RUN. NO IMAGES WILL BE DELETED.")
+    if purge:
+        logger.info("ALL IMAGES WILL BE DELETED!")
+
+    registry.login()
+    size, proceed = registry.check_size(limit)
+
+    if not proceed and not purge:
+        logger.info("Nothing to do. PROGRAM EXITING.")
+        registry.close()
+        return stats
+
+    # Listers and deleters share one limit so that throttling in either
+    # stage backs off both. Start at the larger stage size and let the
+    # registry decide whether both stages can run at full size together.
+    controller = ConcurrencyController(
+        initial=max(list_workers, delete_workers),
+        maximum=list_workers + delete_workers,
+    )
+    watch_controller(controller)
+
+    try:
+        # Purging is the same pipeline without an age limit
+        stats = await stream_cleanup(
+            registry,
+            None if purge else max_age,
+            list_workers=list_workers,
+            delete_workers=delete_workers,
+            dry_run=dry_run,
+            controller=controller,
+        )
+        logger.info(
+            "Listed %d manifests in %d repositories, %d eligible for deletion, %d deleted"
+            % (
+                stats["manifests"],
+                stats["repos"],
+                stats["eligible"],
+                stats["deleted"],
+            )
+        )
+
+        if not purge:
+            start_size = size
+            size, proceed = registry.check_size(limit)
+            record_reclaimed(max(start_size - size, 0) * 1.0e9)
+
+            if proceed:
+                logger.info(
+                    "Size of %s still LARGER THAN %s TB. Please re-run and optionally set the --purge flag."
+                    % (acr_name, limit)
+                )
+    finally:
+        registry.close()
+
+    return stats
@@ -0,0 +1,165 @@
+import logging
+import numpy as np
+import pandas as pd
+from .layers import LayerIndex
+
+logger = logging.getLogger()
+
+
+def estimate_reclaimed_bytes(
+    image_df: pd.DataFrame, candidates: pd.DataFrame
+) -> pd.Series:
+    """Estimate the bytes freed by deleting each candidate image in turn
+
+    Images in the same repository usually share their base layers, so the
+    smallest image in each repository is assumed to be made up entirely of
+    shared layers. Deleting an image frees its size minus that shared base,
+    and deleting the last image in a repository frees the base as well.
+
+    Args:
+        image_df (pd.DataFrame): All the images stored in the ACR
+        candidates (pd.DataFrame): Rows of image_df in the order they would
+                                   be deleted
+
+    Returns:
+        pd.Series: The bytes freed by deleting each candidate, indexed like
+                   candidates
+    """
+    by_repo = image_df.groupby("repo", observed=True)["image_size"]
+    base = by_repo.transform("min").loc[candidates.index]
+    total = by_repo.transform("size").loc[candidates.index]
+
+    # How many of the repository's images are gone once this one is deleted
+    deleted = candidates.groupby("repo", observed=True).cumcount() + 1
+    last_in_repo = deleted == total
+
+    return candidates["image_size"] - base + base * last_in_repo
+
+
+def plan_to_limit(
+    image_df: pd.DataFrame, size: float, limit: float, max_age: int
+) -> pd.DataFrame:
+    """Select the oldest images that need deleting to bring an ACR under its
+    size limit
+
+    Args:
+        image_df (pd.DataFrame): All the images stored in the ACR, with
+                                 age_days and image_size columns
+        size (float): The current size of the ACR in GB
+        limit (float): The maximum size limit of the ACR in TB
+        max_age (int): Only images at least this many days old are deleted
+
+    Returns:
+        pd.DataFrame: The images to delete, oldest first, with the estimated
+                      bytes freed by each in a reclaimed_bytes column
+    """
+    candidates = image_df.loc[image_df["age_days"] >= max_age]
+    candidates = candidates.sort_values(
+        "age_days", ascending=False, kind="stable"
+    )
+    excess = (size - limit * 1.0e3) * 1.0e9
+
+    if excess <= 0:
+        return candidates.iloc[:0].reset_index(drop=True)
+
+    if not image_df["image_size"].any():
+        logger.info(
+            "Image sizes are unknown. Selecting all %d images older than %d days."
+            % (len(candidates), max_age)
+        )
+        return candidates.reset_index(drop=True)
+
+    reclaimed = estimate_reclaimed_bytes(image_df, candidates)
+    count = int(np.searchsorted(reclaimed.cumsum().values, excess)) + 1
+
+    selected = candidates.iloc[:count].copy()
+    selected["reclaimed_bytes"] = reclaimed.iloc[:count]
+
+    logger.info(
+        "Selected %d of %d images older than %d days to free an estimated %.2f GB of %.2f GB over the limit"
+        % (
+            len(selected),
+            len(candidates),
+            max_age,
+            selected["reclaimed_bytes"].sum() * 1.0e-9,
+            excess * 1.0e-9,
+        )
+    )
+
+    return selected.reset_index(drop=True)
+
+
+def plan_with_layers(
+    image_df: pd.DataFrame,
+    index: LayerIndex,
+    size: float,
+    limit: float,
+    max_age: int,
+) -> pd.DataFrame:
+    """Select the images that free the most bytes per registry call until an
+    ACR is under its size limit
+
+    Candidates are grouped into deletions as `bulk_delete` would make them:
+    a repository whose images are all candidates is deleted in one call,
+    every other image takes a call of its own. Deletions are ranked by the
+    bytes each frees on its own, counted exactly from the layer index, and
+    taken until the bytes freed by all of them together cover the excess.
+
+    Args:
+        image_df (pd.DataFrame): All the images stored in the ACR, with
+                                 repo and age_days columns
+        index (LayerIndex): The blobs referenced by each image
+        size (float): The current size of the ACR in GB
+        limit (float): The maximum size limit of the ACR in TB
+        max_age (int): Only images at least this many days old are deleted
+
+    Returns:
+        pd.DataFrame: The images to delete, in the order they were selected,
+                      with the exact bytes freed by each in a
+                      reclaimed_bytes column
+    """
+    candidates = image_df.loc[image_df["age_days"] >= max_age]
+    candidates = candidates.sort_values(
+        "age_days", ascending=False, kind="stable"
+    )
+    excess = (size - limit * 1.0e3) * 1.0e9
+
+    if excess <= 0 or candidates.empty:
+        return candidates.iloc[:0].reset_index(drop=True)
+
+    repo_counts = image_df["repo"].value_counts()
+    deletions = []
+    for repo, group in candidates.groupby("repo", observed=True, sort=False):
+        if len(group) == repo_counts[repo]:
+            deletions.append(list(group.index))
+        else:
+            deletions.extend([row] for row in group.index)
+
+    names = candidates["image_name"]
+    deletions.sort(
+        key=lambda rows: index.reclaimable_bytes(names[rows]), reverse=True
+    )
+
+    order = [row for rows in deletions for row in rows]
+    reclaimed = np.array(index.reclaimed_in_order(names[order]), dtype=int)
+
+    # Only stop once a whole deletion has been made
+    ends = np.cumsum([len(rows) for rows in deletions])
+    freed = reclaimed.cumsum()[ends - 1]
+    count = ends[min(np.searchsorted(freed, excess), len(ends) - 1)]
+
+    selected = candidates.loc[order[:count]].copy()
+    selected["reclaimed_bytes"] = reclaimed[:count]
+
+    logger.info(
+        "Selected %d of %d images older than %d days to free %.2f GB of %.2f GB over the limit"
+        % (
+            len(selected),
+            len(candidates),
+            max_age,
+            selected["reclaimed_bytes"].sum() * 1.0e-9,
+            excess * 1.0e-9,
+        )
+    )
+
+    return selected.reset_index(drop=True)
@@ -0,0 +1,369 @@
+import re
+import csv
+import json
+import fnmatch
+import logging
+from typing import Optional
+from collections import Counter
+from .inventory import use_pandas
+
+try:
+    import numpy as np
+    import pandas as pd
+except ImportError:
+    np = pd = None
+
+logger = logging.getLogger()
+
+# Why an image is kept or deleted, from the first of these that applies
+PROTECTED = "protected"
+KEEP_LAST = "keep-last"
+TOO_YOUNG = "too-young"
+EXPIRED = "expired"
+REASONS = [PROTECTED, KEEP_LAST, TOO_YOUNG, EXPIRED]
+
+
+def _tag_glob(pattern: str) -> str:
+    """Translate a tag glob to a regex that stays within one of the
+    comma-joined tags of an image
+    """
+    return "".join(
+        "[^,]*" if char == "*" else "[^,]" if char == "?" else re.escape(char)
+        for char in pattern
+    )
+
+
+class RetentionRule:
+    """How long to keep the images in the repositories matching a pattern
+
+    Args:
+        name (str): Name of the rule, reported with the images it decides
+        repos (str, optional): Glob of the repositories the rule applies to.
+                               Defaults to all of them.
+        max_age (int, optional): Images at least this many days old are
+                                 deleted. Defaults to the policy's max_age.
+        keep_last (int, optional): Number of the newest images in each
+                                   repository to keep whatever their age.
+                                   Defaults to 0.
+        protect (list, optional): Globs of tags, such as "latest" or "v*",
+                                  whose images are always kept. Defaults to
+                                  none.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        repos: str = "*",
+        max_age: Optional[int] = None,
+        keep_last: int = 0,
+        protect: list = (),
+    ) -> None:
+        self.name = name
+        self.repos = repos
+        self.max_age = max_age
+        self.keep_last = keep_last
+        self.protect = list(protect)
+
+        self.repo_pattern = re.compile(fnmatch.translate(repos))
+        self.tag_pattern = None
+        if self.protect:
+            self.tag_pattern = re.compile(
+                "(?:^|,)(?:%s)(?:,|$)"
+                % "|".join(_tag_glob(pattern) for pattern in self.protect)
+            )
+
+    def __repr__(self) -> str:
+        return (
+            "RetentionRule(%r, %r, max_age=%r, keep_last=%r, protect=%r)"
+            % (
+                self.name,
+                self.repos,
+                self.max_age,
+                self.keep_last,
+                self.protect,
+            )
+        )
+
+
+class RetentionPolicy:
+    """Rules deciding which images in an ACR to delete
+
+    Each repository follows the first rule whose pattern matches its name,
+    or the default rule if none do. In that rule's repositories an image is
+    kept if one of its tags is protected, or if it is one of the keep_last
+    newest images of its repository, or if it is younger than max_age.
+    Otherwise it is deleted.
+
+    The patterns are compiled once, when the policy is made, and each
+    repository is matched against them only the first time it is seen. The
+    rules are then applied to a whole inventory in one pass.
+
+    Args:
+        max_age (int): The maximum image age in days of the default rule,
+                       and of rules without their own
+        rules (list, optional): RetentionRules in order of precedence.
+                                Defaults to none.
+        keep_last (int, optional): The default rule's keep_last. Defaults to
+                                   0.
+        protect (list, optional): The default rule's protected tag globs.
+                                  Defaults to none.
+    """
+
+    def __init__(
+        self,
+        max_age: int,
+        rules: list = (),
+        keep_last: int = 0,
+        protect: list = (),
+    ) -> None:
+        default = RetentionRule(
+            "default", max_age=max_age, keep_last=keep_last, protect=protect
+        )
+        self.rules = list(rules) + [default]
+
+        names = Counter(rule.name for rule in self.rules)
+        duplicates = [name for name, count in names.items() if count > 1]
+        if duplicates:
+            raise ValueError(
+                "Retention rules need different names: %s"
+                % ", ".join(duplicates)
+            )
+
+        for rule in self.rules:
+            if rule.max_age is None:
+                rule.max_age = max_age
+
+        self._rule_of = {}
+
+    @classmethod
+    def from_config(cls, config: dict, max_age: int) -> "RetentionPolicy":
+        """Create a policy from its configuration
+
+        Args:
+            config (dict): Optionally the default rule's "max_age",
+                           "keep_last" and "protect", and a list of "rules"
+                           each with a "repos" glob and, optionally, a
+                           "name", "max_age", "keep_last" and "protect"
+            max_age (int): The maximum image age in days if the config
+                           doesn't set one
+
+        Returns:
+            RetentionPolicy: The policy
+        """
+        rules = []
+        for entry in config.get("rules", []):
+            if "repos" not in entry:
+                raise ValueError("Every retention rule needs a repos glob")
+            rules.append(
+                RetentionRule(
+                    entry.get("name", entry["repos"]),
+                    entry["repos"],
+                    max_age=entry.get("max_age"),
+                    keep_last=entry.get("keep_last", 0),
+                    protect=entry.get("protect", []),
+                )
+            )
+
+        return cls(
+            config.get("max_age", max_age),
+            rules,
+            keep_last=config.get("keep_last", 0),
+            protect=config.get("protect", []),
+        )
+
+    def rule_index(self, repo: str) -> int:
+        """The index of the rule a repository follows"""
+        index = self._rule_of.get(repo)
+        if index is None:
+            index = next(
+                i
+                for i, rule in enumerate(self.rules)
+                if rule.repo_pattern.match(repo)
+            )
+            self._rule_of[repo] = index
+        return index
+
+    def protects_tags(self) -> bool:
+        """Whether any rule keeps images for their tags, which then need
+        listing with them
+        """
+        return any(rule.protect for rule in self.rules)
+
+    def listing_max_age(self) -> Optional[int]:
+        """The youngest age at which any image can be deleted
+
+        Returns:
+            int: The smallest max_age of the rules, or None if a rule keeps
+                 the newest images of each repository, which can only be
+                 found by listing all of them
+        """
+        if any(rule.keep_last for rule in self.rules):
+            return None
+        return min(rule.max_age for rule in self.rules)
+
+    def evaluate(self, image_df):
+        """Decide which images to delete
+
+        Args:
+            image_df (pd.DataFrame or ImageTable): The image inventory,
+                                                   with repo, age_days,
+                                                   tags and timestamp
+                                                   columns
+
+        Returns:
+            pd.DataFrame or ImageTable: The inventory with the name of the
+                                        rule each image follows, the reason
+                                        it is kept or deleted (one of
+                                        REASONS) and whether to delete it
+                                        in rule, reason and delete columns
+        """
+        if use_pandas():
+            return self._evaluate_frame(image_df)
+        return self._evaluate_table(image_df)
+
+    def _evaluate_frame(self, image_df):
+        repo = image_df["repo"]
+        if not isinstance(repo.dtype, pd.CategoricalDtype):
+            repo = repo.astype("category")
+        codes = repo.cat.codes.to_numpy()
+
+        # Rules are looked up per repository, then spread to their images
+        rule_of_repo = np.array(
+            [self.rule_index(name) for name in repo.cat.categories],
+            dtype=np.intp,
+        )
+        rule = rule_of_repo[codes]
+        max_age = np.array([r.max_age for r in self.rules])[rule]
+        keep_last = np.array([r.keep_last for r in self.rules])[rule]
+        age_days = image_df["age_days"].to_numpy()
+
+        protected = np.zeros(len(image_df), dtype=bool)
+        for i, r in enumerate(self.rules):
+            rows = np.flatnonzero(rule == i)
+            if r.tag_pattern is None or not len(rows):
+                continue
+            tags = image_df["tags"].iloc[rows]
+            protected[rows] = tags.str.contains(r.tag_pattern, na=False)
+
+        # 1 for the newest image of each repository, 2 for the next...
+        # Images of the same age in days are ordered by their timestamps
+        order = (
+            pd.DataFrame(
+                {
+                    "age_days": age_days,
+                    "timestamp": image_df["timestamp"].to_numpy(dtype=object),
+                }
+            )
+            .sort_values(["age_days", "timestamp"], ascending=[True, False])
+            .index.to_numpy()
+        )
+        newest = np.empty(len(image_df), dtype=np.int64)
+        newest[order] = (
+            pd.Series(codes[order]).groupby(codes[order]).cumcount()
+        )
+        newest += 1
+
+        reason = np.select(
+            [protected, newest <= keep_last, age_days < max_age],
+            [PROTECTED, KEEP_LAST, TOO_YOUNG],
+            EXPIRED,
+        )
+
+        return image_df.assign(
+            rule=pd.Categorical.from_codes(
+                rule, categories=[r.name for r in self.rules]
+            ),
+            reason=pd.Categorical(reason, categories=REASONS),
+            delete=reason == EXPIRED,
+        )
+
+    def _evaluate_table(self, image_df):
+        repos = image_df["repo"]
+        ages = image_df["age_days"]
+        tags = image_df["tags"]
+        timestamps = image_df["timestamp"]
+        rules = [self.rules[self.rule_index(repo)] for repo in repos]
+
+        # 1 for the newest image of each repository, 2 for the next...
+        # Images of the same age in days are ordered by their timestamps
+        order = sorted(
+            range(len(ages)), key=timestamps.__getitem__, reverse=True
+        )
+        order.sort(key=ages.__getitem__)
+        newest = [0] * len(repos)
+        seen = Counter()
+        for i in order:
+            seen[repos[i]] += 1
+            newest[i] = seen[repos[i]]
+
+        reasons = []
+        for rule, age, image_tags, rank in zip(rules, ages, tags, newest):
+            if rule.tag_pattern is not None and rule.tag_pattern.search(
+                image_tags
+            ):
+                reasons.append(PROTECTED)
+            elif rank <= rule.keep_last:
+                reasons.append(KEEP_LAST)
+            elif age < rule.max_age:
+                reasons.append(TOO_YOUNG)
+            else:
+                reasons.append(EXPIRED)
+
+        return image_df.assign(
+            rule=[rule.name for rule in rules],
+            reason=reasons,
+            delete=[reason == EXPIRED for reason in reasons],
+        )
+
+
+def load_policy(path: str, max_age: int) -> RetentionPolicy:
+    """Read a retention policy from a JSON file
+
+    Args:
+        path (str): Path to the policy file
+        max_age (int): The maximum image age in days if the file doesn't
+                       set one
+
+    Returns:
+        RetentionPolicy: The policy
+    """
+    with open(path) as f:
+        return RetentionPolicy.from_config(json.load(f), max_age)
+
+
+def apply_policy(
+    policy: RetentionPolicy, image_df, report: Optional[str] = None
+):
+    """Select the images a retention policy deletes
+
+    Args:
+        policy (RetentionPolicy): The policy
+        image_df (pd.DataFrame or ImageTable): The image inventory
+        report (str, optional): Path to a CSV file to write the rule and
+                                reason for keeping or deleting each image
+                                to. Defaults to None.
+
+    Returns:
+        pd.DataFrame or ImageTable: The images to delete, with the rule that
+                                    selected each
+    """
+    decisions = policy.evaluate(image_df)
+
+    counts = Counter(zip(decisions["rule"], decisions["reason"]))
+    for (rule, reason), count in sorted(counts.items()):
+        logger.info("Rule %s: %d images %s" % (rule, count, reason))
+
+    if report is not None:
+        with open(report, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["image_name", "rule", "reason", "delete"])
+            writer.writerows(
+                zip(
+                    decisions["image_name"],
+                    decisions["rule"],
+                    decisions["reason"],
+                    decisions["delete"],
+                )
+            )
+
+    return decisions.loc[decisions["delete"]].reset_index(drop=True)
@@ -0,0 +1,430 @@
+import re
+import time
+import logging
+import requests
+import threading
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from .credentials import (
+    ACCESS_TOKEN_MARGIN,
+    ACCESS_TOKEN_TTL,
+    TokenCache,
+    token_expiry,
+)
+from .throttle import ThrottledError, parse_retry_after
+
+logger = logging.getLogger()
+
+# Accept headers for manifest requests so the registry doesn't try to
+# down-convert OCI or manifest-list images
+MANIFEST_MEDIA_TYPES = [
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.oci.image.index.v1+json",
+]
+
+CHALLENGE_PARAM = re.compile(r'(\w+)="([^"]*)"')
+
+
+def parse_challenge(header: str) -> dict:
+    """Parse a WWW-Authenticate header returned by a registry
+
+    Args:
+        header (str): The value of the WWW-Authenticate header, e.g.
+                      'Bearer realm="https://x/oauth2/token",service="x"'
+
+    Returns:
+        dict: The authentication scheme under the "scheme" key, plus any
+              parameters of the challenge (realm, service, scope)
+    """
+    scheme, _, params = header.partition(" ")
+    challenge = dict(CHALLENGE_PARAM.findall(params))
+    challenge["scheme"] = scheme.lower()
+
+    return challenge
+
+
+class RegistryClient:
+    """In-process client for the Docker Registry v2 and ACR data-plane APIs.
+
+    A single requests.Session is shared between all calls so that
+    connections to the registry are pooled and kept alive. Bearer tokens
+    are requested from the realm advertised by the registry the first time
+    a scope is challenged and reused for all later requests in that scope
+    until they expire. A token used when it is close to expiring is
+    refreshed in the background, so requests don't wait for a new one.
+
+    Args:
+        login_server (str): Hostname of the registry, e.g. myacr.azurecr.io
+        username (str, optional): Username for basic authentication against
+                                  the registry or its token realm
+        password (str, optional): Password for basic authentication
+        refresh_token (str, optional): An ACR refresh token, as returned by
+                                       `az acr login --expose-token`. Takes
+                                       precedence over username/password.
+        pool_size (int, optional): Maximum number of pooled connections.
+                                   Defaults to 10.
+        timeout (float, optional): Timeout in seconds for each request.
+                                   Defaults to 30.0.
+        scheme (str, optional): URL scheme of the registry. Defaults to https.
+        token_cache (TokenCache, optional): Where to find tokens from
+                                            earlier runs and keep new ones.
+                                            Defaults to None.
+    """
+
+    def __init__(
+        self,
+        login_server: str,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        refresh_token: Optional[str] = None,
+        pool_size: int = 10,
+        timeout: float = 30.0,
+        scheme: str = "https",
+        token_cache: Optional[TokenCache] = None,
+    ) -> None:
+        self.login_server = login_server
+        self.base_url = f"{scheme}://{login_server}"
+        self.username = username
+        self.password = password
+        self.refresh_token = refresh_token
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount(f"{scheme}://", adapter)
+
+        self.token_cache = token_cache
+        self._tokens = {}
+        self._challenges = {}
+        self._refreshing = set()
+        self._refresher = None
+        self._lock = threading.Lock()
+
+    def _fetch_token(self, challenge: dict, scope: str) -> str:
+        """Request a bearer token from the realm of an auth challenge"""
+        realm = challenge["realm"]
+        params = {
+            "service": challenge.get("service", self.login_server),
+            "scope": challenge.get("scope", scope),
+        }
+
+        if self.refresh_token is not None:
+            params["grant_type"] = "refresh_token"
+            params["refresh_token"] = self.refresh_token
+            resp = self.session.post(realm, data=params, timeout=self.timeout)
+        elif self.username is not None:
+            resp = self.session.get(
+                realm,
+                params=params,
+                auth=(self.username, self.password),
+                timeout=self.timeout,
+            )
+        else:
+            resp = self.session.get(realm, params=params, timeout=self.timeout)
+
+        if resp.status_code != 200:
+            logger.error(resp.text)
+            raise RuntimeError(
+                "Could not obtain a token for scope %s: %s"
+                % (params["scope"], resp.text)
+            )
+
+        body = resp.json()
+        token = body.get("access_token", body.get("token"))
+
+        if body.get("expires_in"):
+            expires = time.time() + float(body["expires_in"])
+        else:
+            expires = token_expiry(token, ACCESS_TOKEN_TTL)
+
+        self._tokens[scope] = (token, expires)
+        self._challenges[scope] = challenge
+        if self.token_cache is not None:
+            self.token_cache.put(self._cache_key(scope), token, expires)
+
+        return token
+
+    def _cache_key(self, scope: str) -> str:
+        return "access:%s:%s" % (self.login_server, scope)
+
+    def _refresh(self, scope: str) -> None:
+        try:
+            self._fetch_token(self._challenges[scope], scope)
+        except (RuntimeError, requests.RequestException) as err:
+            # The request that finds the token expired will try again
+            logger.info("Could not refresh token for %s: %s" % (scope, err))
+        finally:
+            with self._lock:
+                self._refreshing.discard(scope)
+
+    def _token(self, scope: str) -> Optional[str]:
+        """The token to send for a scope, if there is one still valid
+
+        Tokens close to expiring are refreshed in the background while they
+        are still used.
+        """
+        token, expires = self._tokens.get(scope, (None, 0))
+
+        if token is None and self.token_cache is not None:
+            entry = self.token_cache.get(self._cache_key(scope))
+            if entry is not None:
+                token, expires = entry["token"], entry["expires"]
+                self._tokens[scope] = (token, expires)
+
+        now = time.time()
+        if token is None or expires <= now:
+            return None
+
+        if expires - ACCESS_TOKEN_MARGIN <= now and scope in self._challenges:
+            with self._lock:
+                if scope not in self._refreshing:
+                    self._refreshing.add(scope)
+                    if self._refresher is None:
+                        self._refresher = ThreadPoolExecutor(max_workers=1)
+                    self._refresher.submit(self._refresh, scope)
+
+        return token
+
+    def _request(
+        self, method: str, url: str, scope: str, **kwargs
+    ) -> requests.Response:
+        """Send an authenticated request to the registry.
+
+        The request is sent with the cached token for `scope` if one exists.
+        A 401 response triggers a single token refresh and retry.
+        """
+        if not url.startswith("http"):
+            url = self.base_url + url
+        headers = kwargs.pop("headers", {})
+
+        token = self._token(scope)
+        if token is not None:
+            headers["Authorization"] = f"Bearer {token}"
+
+        resp = self.session.request(
+            method, url, headers=headers, timeout=self.timeout, **kwargs
+        )
+
+        if resp.status_code == 401:
+            challenge = parse_challenge(
+                resp.headers.get("WWW-Authenticate", "")
+            )
+
+            if challenge["scheme"] == "bearer":
+                token = self._fetch_token(challenge, scope)
+                headers["Authorization"] = f"Bearer {token}"
+                auth = None
+            else:
+                auth = (self.username, self.password)
+
+            resp = self.session.request(
+                method,
+                url,
+                headers=headers,
+                auth=auth,
+                timeout=self.timeout,
+                **kwargs,
+            )
+
+        return resp
+
+    def _check(self, resp: requests.Response) -> None:
+        if resp.status_code < 400:
+            return
+
+        logger.error(resp.text)
+        message = "%s %s returned %d: %s" % (
+            resp.request.method,
+            resp.request.url,
+            resp.status_code,
+            resp.text,
+        )
+
+        if resp.status_code == 429 or resp.status_code >= 500:
+            raise ThrottledError(
+                message,
+                retry_after=parse_retry_after(resp.headers.get("Retry-After")),
+            )
+
+        raise RuntimeError(message)
+
+    def _paginate(
+        self,
+        url: str,
+        scope: str,
+        key: str,
+        page_size: int,
+        extra: Optional[dict] = None,
+    ):
+        """Yield the items under `key` from every page of a listing"""
+        extra = extra or {}
+        params = dict(extra, n=page_size)
+
+        while url is not None:
+            resp = self._request("GET", url, scope, params=params)
+            self._check(resp)
+
+            for item in resp.json().get(key) or []:
+                yield item
+
+            # The Link header already carries the n/last continuation, but
+            # not always the other parameters of the listing
+            url = resp.links.get("next", {}).get("url")
+            params = {
+                name: value
+                for name, value in extra.items()
+                if url is not None and "%s=" % name not in url
+            }
+
+    def list_repos(self, page_size: int = 1000) -> list:
+        """List the repositories stored in the registry
+
+        Args:
+            page_size (int, optional): Number of repositories to request per
+                                       page. Defaults to 1000.
+
+        Returns:
+            list: All the repositories stored in the registry
+        """
+        return list(
+            self._paginate(
+                "/v2/_catalog", "registry:catalog:*", "repositories", page_size
+            )
+        )
+
+    def iter_manifests(
+        self, repo: str, page_size: int = 1000, oldest_first: bool = False
+    ):
+        """Yield the image manifests for a repository in an ACR page by page
+
+        Only one page of the listing is held in memory at a time, and no
+        more pages are requested once the caller stops iterating. Records
+        have the same keys as the output of
+        `az acr repository show-manifests`, plus the repository name and
+        image size.
+
+        Args:
+            repo (str): Name of the repository
+            page_size (int, optional): Number of manifests to request per
+                                       page. Defaults to 1000.
+            oldest_first (bool, optional): Have the registry order the
+                                           manifests by time, oldest first.
+                                           Defaults to False.
+
+        Yields:
+            dict: An image manifest
+        """
+        for manifest in self._paginate(
+            f"/acr/v1/{repo}/_manifests",
+            f"repository:{repo}:metadata_read",
+            "manifests",
+            page_size,
+            {"orderby": "timeasc"} if oldest_first else None,
+        ):
+            yield {
+                "digest": manifest["digest"],
+                "tags": manifest.get("tags", []),
+                "timestamp": manifest.get(
+                    "lastUpdateTime", manifest.get("createdTime")
+                ),
+                "imageSize": manifest.get("imageSize", 0),
+                "repo": repo,
+            }
+
+    def list_manifests(self, repo: str, page_size: int = 1000) -> list:
+        """List the image manifests for a repository in an ACR
+
+        Args:
+            repo (str): Name of the repository
+            page_size (int, optional): Number of manifests to request per
+                                       page. Defaults to 1000.
+
+        Returns:
+            list: The image manifests
+        """
+        return list(self.iter_manifests(repo, page_size=page_size))
+
+    def get_repo(self, repo: str) -> dict:
+        """Return the attributes of a repository in an ACR
+
+        Args:
+            repo (str): Name of the repository
+
+        Returns:
+            dict: The repository attributes, including lastUpdateTime and
+                  manifestCount
+        """
+        resp = self._request(
+            "GET", f"/acr/v1/{repo}", f"repository:{repo}:metadata_read"
+        )
+        self._check(resp)
+
+        return resp.json()
+
+    def get_manifest(self, repo: str, digest: str) -> dict:
+        """Return the body of an image manifest, listing its config and
+        layer blobs
+
+        Args:
+            repo (str): Name of the repository
+            digest (str): Digest of the manifest
+
+        Returns:
+            dict: The image manifest
+        """
+        resp = self._request(
+            "GET",
+            f"/v2/{repo}/manifests/{digest}",
+            f"repository:{repo}:pull",
+            headers={"Accept": ", ".join(MANIFEST_MEDIA_TYPES)},
+        )
+        self._check(resp)
+
+        return resp.json()
+
+    def delete_manifest(self, repo: str, digest: str) -> None:
+        """Delete an image manifest, and all the tags that point to it
+
+        Args:
+            repo (str): Name of the repository
+            digest (str): Digest of the manifest to delete
+        """
+        resp = self._request(
+            "DELETE",
+            f"/v2/{repo}/manifests/{digest}",
+            f"repository:{repo}:delete",
+            headers={"Accept": ", ".join(MANIFEST_MEDIA_TYPES)},
+        )
+
+        if resp.status_code == 404:
+            logger.info("%s@%s has already been deleted" % (repo, digest))
+            return
+
+        self._check(resp)
+
+    def delete_repo(self, repo: str) -> None:
+        """Delete a repository and all the images in it from an ACR
+
+        Args:
+            repo (str): Name of the repository
+        """
+        resp = self._request(
+            "DELETE", f"/acr/v1/{repo}", f"repository:{repo}:delete"
+        )
+
+        if resp.status_code == 404:
+            logger.info("%s has already been deleted" % repo)
+            return
+
+        self._check(resp)
+
+    def close(self) -> None:
+        """Close all pooled connections and keep the tokens for later runs"""
+        if self._refresher is not None:
+            self._refresher.shutdown(wait=True)
+        if self.token_cache is not None:
+            self.token_cache.save()
+        self.session.close()
@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import zlib
+import logging
+from typing import Tuple
+
+logger = logging.getLogger()
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parse a shard given as "i/N", the i-th of N shards counting from 0
+
+    Args:
+        value (str): The shard, e.g. "0/4"
+
+    Returns:
+        index (int): The index of the shard
+        count (int): The number of shards
+    """
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise ValueError("shard must look like i/N, not: %s" % value)
+
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(
+            "shard %s is out of range, i must be from 0 to N-1" % value
+        )
+
+    return index, count
+
+
+def shard_of(repo: str, count: int) -> int:
+    """The shard a repository belongs to
+
+    The name is hashed with CRC-32 rather than `hash`, which is salted per
+    process, so every worker on every host agrees on the shards.
+
+    Args:
+        repo (str): Name of the repository
+        count (int): The number of shards
+
+    Returns:
+        int: The index of the repository's shard
+    """
+    return zlib.crc32(repo.encode("utf-8")) % count
+
+
+def shard_repos(repos: list, index: int, count: int) -> list:
+    """The repositories in one shard of an ACR
+
+    Args:
+        repos (list): All the repositories in the ACR
+        index (int): The index of the shard
+        count (int): The number of shards
+
+    Returns:
+        list: The repositories in the shard, in their original order
+    """
+    share = [repo for repo in repos if shard_of(repo, count) == index]
+    logger.info(
+        "Shard %d/%d has %d of %d repositories"
+        % (index, count, len(share), len(repos))
+    )
+    return share
+
+
+def write_shard_report(
+    path: str, acr_name: str, shard: Tuple[int, int], result: dict
+) -> None:
+    """Write the result of cleaning one shard of an ACR to a JSON file
+
+    Args:
+        path (str): Path to write the report to
+        acr_name (str): The name of the ACR
+        shard (tuple): The index and count of the shard
+        result (dict): The size and number of images deleted returned by
+                       `run`
+    """
+    report = dict(
+        result, acr=acr_name, shard=list(shard), finished=time.time()
+    )
+
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(report, f)
+    os.replace(tmp, path)
+
+
+def merge_reports(paths: list) -> dict:
+    """Combine the reports of the shards of an ACR into one
+
+    Args:
+        paths (list): Paths to the reports written by `write_shard_report`
+
+    Returns:
+        dict: The ACR, number of shards, the indexes of any shards without a
+              report, the total number of images deleted, and the size of
+              the ACR reported by the shard that finished last
+    """
+    reports = {}
+    for path in paths:
+        with open(path) as f:
+            report = json.load(f)
+
+        index, count = report["shard"]
+        latest = reports.get(index)
+        if latest is None or report["finished"] > latest["finished"]:
+            reports[index] = report
+
+    acrs = sorted({report["acr"] for report in reports.values()})
+    counts = sorted({report["shard"][1] for report in reports.values()})
+    if len(acrs) != 1 or len(counts) != 1:
+        raise ValueError(
+            "Reports are for different ACRs or numbers of shards: %s"
+            % ", ".join(paths)
+        )
+
+    count = counts[0]
+    missing = [index for index in range(count) if index not in reports]
+    if missing:
+        logger.warning(
+            "No report for shards: %s" % ", ".join(map(str, missing))
+        )
+
+    last = max(reports.values(), key=lambda report: report["finished"])
+
+    return {
+        "acr": acrs[0],
+        "shards": count,
+        "missing": missing,
+        "deleted": sum(report["deleted"] for report in reports.values()),
+        "size": last["size"],
+    }
@@ -0,0 +1,231 @@
+from array import array
+from itertools import compress
+from typing import Optional
+
+
+def _select(values, indices):
+    """The values at some positions of a list or array, in the same type"""
+    if isinstance(values, array):
+        return array(values.typecode, (values[i] for i in indices))
+    return [values[i] for i in indices]
+
+
+def _filter(values, mask):
+    """The values where a boolean mask is true, in the same type"""
+    if isinstance(values, array):
+        return array(values.typecode, compress(values, mask))
+    return list(compress(values, mask))
+
+
+class Column:
+    """A column of an ImageTable
+
+    Comparing a column with a value gives a boolean mask to select rows of
+    the table with, as comparing a pandas Series does.
+
+    Args:
+        values (list or array): The values of the column
+    """
+
+    __slots__ = ("values",)
+
+    def __init__(self, values) -> None:
+        self.values = values
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __getitem__(self, i):
+        return self.values[i]
+
+    def __ge__(self, other) -> list:
+        return [value >= other for value in self.values]
+
+    def __gt__(self, other) -> list:
+        return [value > other for value in self.values]
+
+    def __le__(self, other) -> list:
+        return [value <= other for value in self.values]
+
+    def __lt__(self, other) -> list:
+        return [value < other for value in self.values]
+
+    def tolist(self) -> list:
+        return list(self.values)
+
+
+class _RowSelector:
+    def __init__(self, table: "ImageTable") -> None:
+        self.table = table
+
+    def __getitem__(self, mask) -> "ImageTable":
+        return self.table.filter(mask)
+
+
+class ImageTable:
+    """An image inventory held in plain lists and arrays
+
+    Stands in for the inventory DataFrame when pandas isn't installed. It
+    supports the few DataFrame operations docker_bot needs: selecting
+    columns, filtering rows with `loc` and a mask, sorting, and setting or
+    dropping the index. Ages and sizes are kept in typed arrays, and the
+    string columns share their repository names.
+
+    Args:
+        columns (dict): The values of each column, in order
+        index (list, optional): Row labels. Defaults to the row numbers.
+        index_name (str, optional): Name of the column the row labels came
+                                    from. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        columns: dict,
+        index: Optional[list] = None,
+        index_name: Optional[str] = None,
+    ) -> None:
+        self._columns = columns
+        self._index = index
+        self._index_name = index_name
+
+    @classmethod
+    def from_columns(
+        cls,
+        repo,
+        digest,
+        age_days,
+        image_size=None,
+        tags=None,
+        timestamp=None,
+    ) -> "ImageTable":
+        """Assemble an image inventory table from its columns
+
+        Args:
+            repo (list): Repository of each image
+            digest (list): Manifest digest of each image
+            age_days (Iterable): Age of each image in days
+            image_size (Iterable, optional): Size of each image in bytes.
+                                             Defaults to 0 if unknown.
+            tags (Iterable, optional): Tags of each image joined by commas.
+                                       Defaults to no tags.
+            timestamp (Iterable, optional): Time each image was last
+                                            updated. Defaults to unknown.
+
+        Returns:
+            ImageTable: One row per image with columns image_name
+                        (repo@digest), repo, digest, age_days, image_size,
+                        tags and timestamp
+        """
+        repo = list(repo)
+        digest = list(digest)
+        if image_size is None:
+            image_size = array("q", bytes(8 * len(repo)))
+        if tags is None:
+            tags = [""] * len(repo)
+        if timestamp is None:
+            timestamp = [""] * len(repo)
+
+        return cls(
+            {
+                "image_name": [f"{r}@{d}" for r, d in zip(repo, digest)],
+                "repo": repo,
+                "digest": digest,
+                "age_days": array("i", age_days),
+                "image_size": array("q", image_size),
+                "tags": list(tags),
+                "timestamp": list(timestamp),
+            }
+        )
+
+    @classmethod
+    def concat(cls, tables: list) -> "ImageTable":
+        """Join tables with the same columns one after the other"""
+        columns = {}
+        for table in tables:
+            for name, values in table._columns.items():
+                if name in columns:
+                    columns[name].extend(values)
+                else:
+                    columns[name] = values[:]
+        return cls(columns)
+
+    def __len__(self) -> int:
+        return len(next(iter(self._columns.values()), ()))
+
+    def __getitem__(self, name: str) -> Column:
+        return Column(self._columns[name])
+
+    @property
+    def columns(self) -> list:
+        return list(self._columns)
+
+    @property
+    def empty(self) -> bool:
+        return len(self) == 0
+
+    @property
+    def index(self) -> Column:
+        if self._index is None:
+            return Column(range(len(self)))
+        return Column(self._index)
+
+    @property
+    def loc(self) -> _RowSelector:
+        return _RowSelector(self)
+
+    def filter(self, mask) -> "ImageTable":
+        """The rows where a boolean mask is true"""
+        mask = list(mask)
+        return ImageTable(
+            {
+                name: _filter(values, mask)
+                for name, values in self._columns.items()
+            },
+            None if self._index is None else _filter(self._index, mask),
+            self._index_name,
+        )
+
+    def take(self, indices) -> "ImageTable":
+        """The rows at some positions, in the order given"""
+        indices = list(indices)
+        return ImageTable(
+            {
+                name: _select(values, indices)
+                for name, values in self._columns.items()
+            },
+            None if self._index is None else _select(self._index, indices),
+            self._index_name,
+        )
+
+    def sort_values(
+        self, by: str, ascending: bool = True, kind: Optional[str] = None
+    ) -> "ImageTable":
+        """The rows sorted by a column, keeping the order of equal rows"""
+        values = self._columns[by]
+        order = sorted(
+            range(len(values)), key=values.__getitem__, reverse=not ascending
+        )
+        return self.take(order)
+
+    def assign(self, **columns) -> "ImageTable":
+        """A copy of the table with more columns, or some replaced"""
+        return ImageTable(
+            dict(self._columns, **columns), self._index, self._index_name
+        )
+
+    def set_index(self, name: str) -> "ImageTable":
+        """Use a column as the row labels, removing it from the columns"""
+        columns = dict(self._columns)
+        return ImageTable(columns, columns.pop(name), name)
+
+    def reset_index(self, drop: bool = False) -> "ImageTable":
+        """Go back to numbering the rows, keeping the labels as a column
+        unless `drop` is set
+        """
+        columns = dict(self._columns)
+        if not drop and self._index is not None:
+            columns = {self._index_name or "index": self._index, **columns}
+        return ImageTable(columns)
@@ -0,0 +1,212 @@
+import re
+import time
+import random
+import logging
+import threading
+from typing import Optional
+from email.utils import parsedate_to_datetime
+
+logger = logging.getLogger()
+
+# How throttling and transient server errors show up in the error messages
+# of the Azure CLI and the registry API. Status codes only count where a
+# status is reported, not anywhere in a message, such as a repository name.
+THROTTLED = re.compile(
+    r"(?:returned(?: status)?|status(?: code)?:?|HTTP(?:/[\d.]+)?)"
+    r" (?:429|500|502|503|504)\b|\((?:429|500|502|503|504)\)"
+    r"|too ?many ?requests|throttl|service ?unavailable|server ?busy",
+    re.IGNORECASE,
+)
+
+
+class ThrottledError(RuntimeError):
+    """Raised when the registry rejects a call because it is overloaded
+
+    Args:
+        message (str): Description of the error
+        retry_after (float, optional): Seconds the registry asked us to wait
+                                       before trying again
+    """
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header, given in seconds or as an HTTP date
+
+    Args:
+        value (str): The value of the Retry-After header
+
+    Returns:
+        float: Seconds to wait, or None if the header is missing or invalid
+    """
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    return max(retry_at.timestamp() - time.time(), 0.0)
+
+
+def is_throttled(err: Exception) -> bool:
+    """Whether an error means the registry wants us to slow down"""
+    return isinstance(err, ThrottledError) or bool(THROTTLED.search(str(err)))
+
+
+class ConcurrencyController:
+    """Limit the number of registry calls in flight, adapting to the registry
+
+    The limit grows by one for each window of calls that complete within
+    `target_latency` and shrinks by a quarter when calls get slower. When a
+    call is throttled or hits a transient server error, the limit is halved
+    and the call retried after the Retry-After the registry asked for, or a
+    jittered exponential backoff.
+
+    Run the calls through `call` from as many threads as `maximum`; the
+    controller holds back any beyond the current limit.
+
+    Args:
+        initial (int, optional): Number of calls allowed in flight at first.
+                                 Defaults to 4.
+        minimum (int, optional): Fewest calls allowed in flight.
+                                 Defaults to 1.
+        maximum (int, optional): Most calls allowed in flight. Defaults to
+                                 initial.
+        target_latency (float, optional): Seconds a call may take before the
+                                          registry is considered busy.
+                                          Defaults to 5.0.
+        retries (int, optional): Number of times to retry a throttled call.
+                                 Defaults to 5.
+        backoff (float, optional): Seconds to wait before the first retry,
+                                   doubling for each retry. Defaults to 1.0.
+        max_backoff (float, optional): Longest wait between retries in
+                                       seconds. Defaults to 60.0.
+    """
+
+    def __init__(
+        self,
+        initial: int = 4,
+        minimum: int = 1,
+        maximum: Optional[int] = None,
+        target_latency: float = 5.0,
+        retries: int = 5,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+    ) -> None:
+        self.minimum = minimum
+        self.maximum = max(maximum or initial, initial)
+        self.target_latency = target_latency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.limit = float(initial)
+        self.in_flight = 0
+        self.calls = 0
+        self.throttled = 0
+
+        self._cond = threading.Condition()
+        self._last_decrease = 0.0
+
+    @property
+    def current(self) -> int:
+        """The number of calls currently allowed in flight"""
+        return int(self.limit)
+
+    def snapshot(self) -> dict:
+        """Return the current limit and call counts"""
+        with self._cond:
+            return {
+                "limit": self.current,
+                "in_flight": self.in_flight,
+                "calls": self.calls,
+                "throttled": self.throttled,
+            }
+
+    def _set_limit(self, limit: float) -> None:
+        limit = min(max(limit, self.minimum), self.maximum)
+        if int(limit) != int(self.limit):
+            logger.info("Concurrency limit now %d" % int(limit))
+        self.limit = limit
+        self._cond.notify_all()
+
+    def _acquire(self) -> None:
+        with self._cond:
+            while self.in_flight >= self.current:
+                self._cond.wait()
+            self.in_flight += 1
+
+    def _release(self, latency: Optional[float]) -> None:
+        with self._cond:
+            self.in_flight -= 1
+            self.calls += 1
+
+            if latency is None:
+                self.throttled += 1
+                # Calls already in flight when the registry pushed back
+                # don't halve the limit again
+                now = time.monotonic()
+                if now - self._last_decrease >= self.backoff:
+                    self._last_decrease = now
+                    self._set_limit(self.limit / 2)
+            elif latency > self.target_latency:
+                self._set_limit(self.limit * 0.75)
+            else:
+                self._set_limit(self.limit + 1 / self.limit)
+
+            self._cond.notify_all()
+
+    def _delay(self, err: Exception, attempt: int) -> float:
+        delay = random.uniform(
+            0, min(self.max_backoff, self.backoff * 2**attempt)
+        )
+        retry_after = getattr(err, "retry_after", None)
+
+        return delay if retry_after is None else max(retry_after, delay)
+
+    def call(self, func, *args, **kwargs):
+        """Run a registry call once there is room for it, retrying it if the
+        registry throttles it
+
+        Args:
+            func (callable): The registry call
+            *args, **kwargs: Arguments to pass to func
+
+        Returns:
+            The return value of func
+        """
+        for attempt in range(self.retries + 1):
+            self._acquire()
+            start = time.perf_counter()
+
+            try:
+                result = func(*args, **kwargs)
+            except (RuntimeError, OSError) as err:
+                if not is_throttled(err):
+                    self._release(time.perf_counter() - start)
+                    raise
+
+                self._release(None)
+                if attempt == self.retries:
+                    raise
+
+                delay = self._delay(err, attempt)
+                logger.info(
+                    "Registry is throttling calls, retrying in %.1fs with concurrency %d: %s"
+                    % (delay, self.current, err)
+                )
+                time.sleep(delay)
+                continue
+
+            self._release(time.perf_counter() - start)
+            return result
@@ -0,0 +1,149 @@
+import time
+import logging
+import threading
+from typing import Optional, Tuple
+
+logger = logging.getLogger()
+
+# Seconds a size reading is reused for while nothing has been deleted
+USAGE_TTL = 300.0
+
+# Times to read the size again, and the seconds to wait before the first,
+# when Azure's reported usage hasn't caught up with the deletions yet
+USAGE_POLLS = 3
+USAGE_BACKOFF = 10.0
+
+
+class UsageMonitor:
+    """Keeps track of the size of an ACR while images are deleted from it
+
+    Reading the size of an ACR runs `az acr show-usage`, and the usage Azure
+    reports only catches up with deletions some time after they are made.
+    The monitor keeps the last reading, and estimates the size since from
+    the bytes of the images deleted. The size is only read again when the
+    estimate says the ACR may be under its limit, polling with backoff while
+    the reported usage hasn't moved.
+
+    The estimate assumes deleting an image frees all of its bytes, which is
+    too much when its layers are shared, so it is only used to decide when
+    to read the size again.
+
+    Args:
+        registry (AzCliBackend): The registry backend to read the size with
+        limit (float): The maximum size limit of the ACR in TB
+        ttl (float, optional): Seconds a reading is reused for while nothing
+                               has been deleted. Defaults to USAGE_TTL.
+        polls (int, optional): Times to read the size again while it hasn't
+                               caught up with the deletions. Defaults to
+                               USAGE_POLLS.
+        backoff (float, optional): Seconds to wait before reading the size
+                                   again, doubling for each poll. Defaults
+                                   to USAGE_BACKOFF.
+        stop_under_limit (bool, optional): Deletions should stop being
+                                           started once the ACR is under its
+                                           limit. Defaults to False.
+    """
+
+    def __init__(
+        self,
+        registry,
+        limit: float,
+        ttl: float = USAGE_TTL,
+        polls: int = USAGE_POLLS,
+        backoff: float = USAGE_BACKOFF,
+        stop_under_limit: bool = False,
+    ) -> None:
+        self.registry = registry
+        self.limit = limit
+        self.ttl = ttl
+        self.polls = polls
+        self.backoff = backoff
+        self.stop_under_limit = stop_under_limit
+
+        self.size: Optional[float] = None
+        self.read_at: Optional[float] = None
+        self.under = False
+        self._deleted = 0
+        self._deleted_bytes = 0.0
+
+        # Readings are made one at a time, without holding up deletions
+        # being recorded meanwhile
+        self._read_lock = threading.Lock()
+        self._count_lock = threading.Lock()
+
+    def _read(self) -> Tuple[float, bool]:
+        size, proceed = self.registry.check_size(self.limit)
+        with self._count_lock:
+            self.size = size
+            self.read_at = time.monotonic()
+            self.under = not proceed
+            self._deleted = 0
+            self._deleted_bytes = 0.0
+        return size, proceed
+
+    def read(self) -> Tuple[float, bool]:
+        """Read the size of the ACR
+
+        The last reading is reused if it is less than `ttl` seconds old and
+        nothing has been deleted since, or it was already under the limit.
+
+        Returns:
+            size (float): The size of the ACR in GB
+            proceed (bool): The ACR is over its size limit
+        """
+        with self._read_lock:
+            fresh = (
+                self.read_at is not None
+                and time.monotonic() - self.read_at < self.ttl
+            )
+            if fresh and (self.under or not self._deleted):
+                return self.size, not self.under
+            return self._read()
+
+    def record_deleted(self, n_images: int, n_bytes: float) -> None:
+        """Count images deleted since the last reading"""
+        with self._count_lock:
+            self._deleted += n_images
+            self._deleted_bytes += n_bytes
+
+    def estimate(self) -> float:
+        """The size of the ACR in GB less the bytes deleted since it was
+        last read
+        """
+        with self._count_lock:
+            return max(self.size - self._deleted_bytes * 1.0e-9, 0.0)
+
+    def under_limit(self) -> bool:
+        """Whether the ACR is known to be under its size limit
+
+        Nothing is read while the estimated size is still over the limit.
+        Once it isn't, the size is read until Azure reports it under the
+        limit, or reports a smaller size that is still over it, or the polls
+        run out.
+
+        Returns:
+            bool: No more images need deleting to bring the ACR under its
+                  limit
+        """
+        if self.under or self.estimate() >= self.limit * 1.0e3:
+            return self.under
+
+        with self._read_lock:
+            # Another deletion may have read the size while this one waited
+            if self.under or self.estimate() >= self.limit * 1.0e3:
+                return self.under
+
+            previous = self.size
+            for attempt in range(self.polls + 1):
+                size, proceed = self._read()
+                if not proceed or size < previous or attempt == self.polls:
+                    break
+
+                wait = self.backoff * 2**attempt
+                logger.info(
+                    "Reported size of %.2f GB hasn't changed since deleting images, reading it again in %.0fs"
+                    % (size, wait)
+                )
+                time.sleep(wait)
+
+        return self.under
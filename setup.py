@@ -16,11 +16,16 @@ VERSION = None
 
 # What packages are required for this module to be executed?
 REQUIRED = [
+    "numpy",
     "pandas",
+    "requests",
 ]
 
 # What packages are optional?
-EXTRAS = {}
+EXTRAS = {
+    # In-process Azure CLI for --az-workers
+    "az-workers": ["azure-cli"],
+}
 
 # The rest you shouldn't have to touch too much :)
 # ------------------------------------------------
@@ -0,0 +1,255 @@
+import re
+import json
+import pytest
+import threading
+from urllib.parse import parse_qs, urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeRegistry:
+    """A minimal in-memory Docker Registry v2 / ACR data-plane server
+
+    Args:
+        repos (dict): Maps repository names to lists of manifests. Each
+                      manifest needs at least a "digest" key.
+        token (str, optional): If set, every registry request needs this
+                               bearer token, handed out by /oauth2/token
+                               in exchange for the same refresh token.
+    """
+
+    def __init__(self, repos: dict, token: str = None):
+        self.repos = repos
+        self.token = token
+        self.requests = []
+        self.token_requests = []
+        self.deleted = []
+
+        self.server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), FakeRegistryHandler
+        )
+        self.server.registry = self
+        self.login_server = "127.0.0.1:%d" % self.server.server_port
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, args=(0.01,), daemon=True
+        )
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def paginate(items: list, query: dict, path: str):
+    """Slice a listing with the registry's n/last parameters"""
+    n = int(query.get("n", [len(items) or 1])[0])
+    last = query.get("last", [None])[0]
+    start = 0 if last is None else items.index(last) + 1
+    page = items[start : start + n]
+
+    link = None
+    if start + n < len(items):
+        link = '<%s?last=%s&n=%d>; rel="next"' % (path, page[-1], n)
+
+    return page, link
+
+
+class FakeRegistryHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def registry(self) -> FakeRegistry:
+        return self.server.registry
+
+    def send_json(self, code: int, body, headers: dict = None):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def authorised(self, scope: str) -> bool:
+        if self.registry.token is None:
+            return True
+        if self.headers.get("Authorization") == (
+            "Bearer %s" % self.registry.token
+        ):
+            return True
+
+        challenge = (
+            'Bearer realm="http://%s/oauth2/token",service="%s",scope="%s"'
+            % (self.registry.login_server, self.registry.login_server, scope)
+        )
+        self.send_json(
+            401,
+            {"errors": [{"code": "UNAUTHORIZED"}]},
+            {"WWW-Authenticate": challenge},
+        )
+        return False
+
+    def get_catalog(self, path: str, query: dict):
+        if not self.authorised("registry:catalog:*"):
+            return
+        page, link = paginate(sorted(self.registry.repos), query, path)
+        headers = {"Link": link} if link else {}
+        self.send_json(200, {"repositories": page}, headers)
+
+    def get_manifests(self, path: str, query: dict, repo: str):
+        if not self.authorised("repository:%s:metadata_read" % repo):
+            return
+        if repo not in self.registry.repos:
+            self.send_json(404, {"errors": [{"code": "NAME_UNKNOWN"}]})
+            return
+        manifests = {m["digest"]: m for m in self.registry.repos[repo]}
+        digests = list(manifests)
+        if query.get("orderby") == ["timeasc"]:
+            digests.sort(key=lambda d: manifests[d].get("lastUpdateTime", ""))
+        page, link = paginate(digests, query, path)
+        headers = {"Link": link} if link else {}
+        self.send_json(
+            200,
+            {"imageName": repo, "manifests": [manifests[d] for d in page]},
+            headers,
+        )
+
+    def get_repo(self, repo: str):
+        if not self.authorised("repository:%s:metadata_read" % repo):
+            return
+        if repo not in self.registry.repos:
+            self.send_json(404, {"errors": [{"code": "NAME_UNKNOWN"}]})
+            return
+        manifests = self.registry.repos[repo]
+        self.send_json(
+            200,
+            {
+                "imageName": repo,
+                "manifestCount": len(manifests),
+                "lastUpdateTime": max(
+                    (m.get("lastUpdateTime", "") for m in manifests),
+                    default="",
+                ),
+            },
+        )
+
+    def get_manifest(self, repo: str, digest: str):
+        if not self.authorised("repository:%s:pull" % repo):
+            return
+        for manifest in self.registry.repos.get(repo, []):
+            if manifest["digest"] == digest:
+                body = {"schemaVersion": 2, "layers": manifest.get("layers")}
+                if "config" in manifest:
+                    body["config"] = manifest["config"]
+                self.send_json(200, body)
+                return
+        self.send_json(404, {"errors": [{"code": "MANIFEST_UNKNOWN"}]})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        self.registry.requests.append(("GET", url.path))
+
+        manifests = re.match(r"^/acr/v1/(.+)/_manifests$", url.path)
+        manifest = re.match(r"^/v2/(.+)/manifests/(.+)$", url.path)
+        repo = re.match(r"^/acr/v1/(.+)$", url.path)
+        if url.path == "/v2/_catalog":
+            self.get_catalog(url.path, query)
+        elif manifest:
+            self.get_manifest(*manifest.groups())
+        elif manifests:
+            self.get_manifests(url.path, query, manifests.group(1))
+        elif repo:
+            self.get_repo(repo.group(1))
+        else:
+            self.send_json(404, {"errors": [{"code": "NOT_FOUND"}]})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        self.registry.requests.append(("POST", url.path))
+
+        if url.path != "/oauth2/token":
+            self.send_json(404, {"errors": [{"code": "NOT_FOUND"}]})
+            return
+
+        self.registry.token_requests.append(form)
+        if form.get("refresh_token") != [self.registry.token]:
+            self.send_json(401, {"errors": [{"code": "DENIED"}]})
+            return
+        self.send_json(200, {"access_token": self.registry.token})
+
+    def delete_repo(self, repo: str):
+        if not self.authorised("repository:%s:delete" % repo):
+            return
+        if repo not in self.registry.repos:
+            self.send_json(404, {"errors": [{"code": "NAME_UNKNOWN"}]})
+            return
+        for manifest in self.registry.repos.pop(repo):
+            self.registry.deleted.append("%s@%s" % (repo, manifest["digest"]))
+        self.send_json(202, {"manifestsDeleted": [], "tagsDeleted": []})
+
+    def delete_manifest(self, repo: str, digest: str):
+        if not self.authorised("repository:%s:delete" % repo):
+            return
+        manifests = self.registry.repos.get(repo, [])
+        remaining = [m for m in manifests if m["digest"] != digest]
+        if len(remaining) == len(manifests):
+            self.send_json(404, {"errors": [{"code": "MANIFEST_UNKNOWN"}]})
+            return
+        self.registry.repos[repo] = remaining
+        self.registry.deleted.append("%s@%s" % (repo, digest))
+        self.send_response(202)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_DELETE(self):
+        url = urlparse(self.path)
+        self.registry.requests.append(("DELETE", url.path))
+
+        manifest = re.match(r"^/v2/(.+)/manifests/(.+)$", url.path)
+        repo = re.match(r"^/acr/v1/(.+)$", url.path)
+        if manifest:
+            self.delete_manifest(*manifest.groups())
+        elif repo:
+            self.delete_repo(repo.group(1))
+        else:
+            self.send_json(404, {"errors": [{"code": "NOT_FOUND"}]})
+
+
+@pytest.fixture
+def fake_registry():
+    repos = {
+        "binder/image-a": [
+            {
+                "digest": "sha256:a1",
+                "tags": ["latest"],
+                "lastUpdateTime": "2020-07-30T19:56:00.0000000Z",
+                "imageSize": 1000,
+            },
+            {
+                "digest": "sha256:a2",
+                "tags": [],
+                "lastUpdateTime": "2020-05-01T10:00:00.0000000Z",
+                "imageSize": 2000,
+            },
+        ],
+        "binder/image-b": [
+            {
+                "digest": "sha256:b1",
+                "tags": ["v1"],
+                "lastUpdateTime": "2020-04-01T10:00:00.0000000Z",
+                "imageSize": 3000,
+            }
+        ],
+    }
+
+    with FakeRegistry(repos, token="secret-token") as registry:
+        yield registry
@@ -0,0 +1,29 @@
+"""A stand-in for azure.cli.core used to test AzWorkerPool"""
+
+import os
+import sys
+import json
+import time
+
+
+class FakeCli:
+    def invoke(self, args, out_file=None):
+        if args == ["crash"]:
+            os._exit(1)
+        if args[:1] == ["sleep"]:
+            time.sleep(float(args[1]))
+        if args[:1] == ["items"]:
+            out_file.write(json.dumps(args[1:]))
+            return 0
+        if args == ["fail"]:
+            print("ERROR: command failed", file=sys.stderr)
+            return 1
+
+        # Stray prints must not get mixed up with responses
+        print("warming up")
+        out_file.write(json.dumps({"args": args, "pid": os.getpid()}))
+        return 0
+
+
+def get_default_cli():
+    return FakeCli()
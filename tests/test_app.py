@@ -1,18 +1,42 @@
+import json
 import pytest
+import datetime
+import numpy as np
 import pandas as pd
 from freezegun import freeze_time
-from unittest.mock import call, patch
+from unittest.mock import MagicMock, call, patch
 from pandas._testing import assert_frame_equal
 
+from docker_bot import helper_functions
+from docker_bot.journal import DeletionJournal
+from docker_bot.metrics import collect_metrics
+from docker_bot.registry import RegistryClient
+from docker_bot.inventory import ImageInventory
+from docker_bot.table import ImageTable
+from docker_bot.policy import RetentionPolicy
 from docker_bot.app import (
+    AZ_TIMEOUT,
+    LIST_TIMEOUT,
+    AzCliBackend,
+    RegistryBackend,
+    age_cutoff,
     check_acr_size,
+    compute_image_ages,
     delete_image,
+    delete_repo,
+    get_backend,
+    iter_manifests,
+    list_images,
     login,
+    pull_manifest_body,
     pull_manifests,
+    pull_repo_metadata,
     pull_image_age,
     pull_repos,
     purge_all,
+    run,
     sort_image_df,
+    take_older,
 )
 
 
@@ -38,7 +62,8 @@ def test_check_acr_size_smaller_than(mock_args):
             "{}".format("value[?name=='Size'].currentValue"),
             "-o",
             "tsv",
-        ]
+        ],
+        timeout=AZ_TIMEOUT,
     )
     assert mock_args.return_value == {"returncode": 0, "output": 1000000000.0}
     assert out[0] == 1.0
@@ -67,7 +92,8 @@ def test_check_acr_size_greater_than(mock_args):
             "{}".format("value[?name=='Size'].currentValue"),
             "-o",
             "tsv",
-        ]
+        ],
+        timeout=AZ_TIMEOUT,
     )
     assert mock_args.return_value == {
         "returncode": 0,
@@ -137,7 +163,8 @@ def test_pull_manifests(mock_args):
             acr_name,
             "--repository",
             repo,
-        ]
+        ],
+        timeout=LIST_TIMEOUT,
     )
     assert mock_args.return_value["returncode"] == 0
     assert (
@@ -209,7 +236,8 @@ def test_pull_image_age():
 def test_pull_repos(mock_args):
     acr_name = "test_acr"
     expected_call = call(
-        ["az", "acr", "repository", "list", "-n", acr_name, "-o", "tsv"]
+        ["az", "acr", "repository", "list", "-n", acr_name, "-o", "tsv"],
+        timeout=LIST_TIMEOUT,
     )
 
     out = pull_repos(acr_name)
@@ -312,7 +340,8 @@ def test_delete_image(mock_args):
             "--image",
             image_name,
             "--yes",
-        ]
+        ],
+        timeout=AZ_TIMEOUT,
     )
 
     delete_image(acr_name, image_name)
@@ -363,8 +392,8 @@ def test_login_basic(mock_args):
         {"returncode": 0, "output": "login succeeded"},
     ]
     expected_calls = [
-        call(["az", "login"]),
-        call(["az", "acr", "login", "-n", acr_name]),
+        call(["az", "login"], timeout=None),
+        call(["az", "acr", "login", "-n", acr_name], timeout=AZ_TIMEOUT),
     ]
 
     login(acr_name)
@@ -382,8 +411,8 @@ def test_login_identity(mock_args):
         {"returncode": 0, "output": "login succeeded"},
     ]
     expected_calls = [
-        call(["az", "login", "--identity"]),
-        call(["az", "acr", "login", "-n", acr_name]),
+        call(["az", "login", "--identity"], timeout=AZ_TIMEOUT),
+        call(["az", "acr", "login", "-n", acr_name], timeout=AZ_TIMEOUT),
     ]
 
     login(acr_name, identity=True)
@@ -431,7 +460,8 @@ def test_purge_all(mock_args):
                 "--image",
                 "image1",
                 "--yes",
-            ]
+            ],
+            timeout=AZ_TIMEOUT,
         ),
         call(
             [
@@ -444,7 +474,8 @@ def test_purge_all(mock_args):
                 "--image",
                 "image2",
                 "--yes",
-            ]
+            ],
+            timeout=AZ_TIMEOUT,
         ),
     ]
 
@@ -456,11 +487,12 @@ def test_purge_all(mock_args):
     assert mock_args.call_args_list == expected_calls
 
 
+@patch("docker_bot.deletion.time.sleep")
 @patch(
     "docker_bot.app.run_cmd",
     return_value={"returncode": 1, "err_msg": "Could not run command"},
 )
-def test_purge_all_exception(mock_args):
+def test_purge_all_exception(mock_args, mock_sleep):
     acr_name = "test_acr"
     test_df = pd.DataFrame(
         {"image_name": ["image1", "image2"], "age_days": [67, 53]}
@@ -485,3 +517,1000 @@ def test_purge_all_exception(mock_args):
 
         assert mock.call_count == 1
         assert mock.call_args == expected_call
+
+
+@patch("docker_bot.app.run_cmd")
+def test_login_expose_token(mock_args):
+    acr_name = "test_acr"
+
+    mock_args.side_effect = [
+        {"returncode": 0},
+        {
+            "returncode": 0,
+            "output": '{"accessToken": "token", "loginServer": "test_acr.azurecr.io"}',
+        },
+    ]
+    expected_calls = [
+        call(["az", "login"], timeout=None),
+        call(
+            [
+                "az",
+                "acr",
+                "login",
+                "-n",
+                acr_name,
+                "--expose-token",
+                "-o",
+                "json",
+            ],
+            timeout=AZ_TIMEOUT,
+        ),
+    ]
+
+    out = login(acr_name, expose_token=True)
+
+    assert mock_args.call_args_list == expected_calls
+    assert out == {
+        "accessToken": "token",
+        "loginServer": "test_acr.azurecr.io",
+    }
+
+
+def test_get_backend():
+    assert isinstance(get_backend("az", "test_acr"), AzCliBackend)
+    assert isinstance(get_backend("http", "test_acr"), RegistryBackend)
+
+    with pytest.raises(ValueError):
+        get_backend("not-a-backend", "test_acr")
+
+
+@patch("docker_bot.app.run_cmd")
+def test_registry_backend_token_cache(mock_args, tmp_path):
+    mock_args.side_effect = [
+        {"returncode": 0},
+        {
+            "returncode": 0,
+            "output": '{"accessToken": "secret-token", "loginServer": "x.io"}',
+        },
+    ]
+    path = str(tmp_path / "tokens.json")
+
+    with patch("docker_bot.app.RegistryClient"):
+        RegistryBackend("test_acr", token_cache=path).login()
+        registry = RegistryBackend("test_acr", token_cache=path)
+        registry.login()
+
+    # The second login reuses the cached refresh token
+    assert mock_args.call_count == 2
+    assert registry.client is not None
+
+
+@pytest.mark.parametrize(
+    "err_msg, logs_in",
+    [
+        ("ERROR: Please run 'az login' to setup account.", True),
+        ("ERROR: AADSTS700082: The refresh token has expired", True),
+        ("ERROR: Operation returned an invalid status 'Forbidden'", True),
+        ("ERROR: The resource 'test_acr' could not be found", False),
+        ("az acr show-usage -n test_acr timed out after 120s", False),
+    ],
+)
+def test_registry_backend_check_size_login(err_msg, logs_in):
+    registry = RegistryBackend("test_acr")
+
+    with patch(
+        "docker_bot.app.check_acr_size",
+        side_effect=[RuntimeError(err_msg), (1000.0, False)],
+    ), patch("docker_bot.app.azure_login") as mock_login:
+        if logs_in:
+            assert registry.check_size(2.0) == (1000.0, False)
+        else:
+            with pytest.raises(RuntimeError, match=err_msg):
+                registry.check_size(2.0)
+
+    # Only a missing or expired Azure login is worth logging in again for
+    assert mock_login.called == logs_in
+    assert registry.logged_in == logs_in
+
+
+@patch("docker_bot.app.run_cmd")
+def test_registry_backend(mock_args, fake_registry):
+    mock_args.side_effect = [
+        {"returncode": 0},
+        {
+            "returncode": 0,
+            "output": '{"accessToken": "secret-token", "loginServer": "%s"}'
+            % fake_registry.login_server,
+        },
+    ]
+    registry = RegistryBackend("test_acr")
+
+    with patch("docker_bot.app.RegistryClient") as mock_client:
+        registry.login()
+
+    assert mock_client.call_args == call(
+        fake_registry.login_server,
+        refresh_token="secret-token",
+        pool_size=10,
+        token_cache=None,
+    )
+
+    registry.client = RegistryClient(
+        fake_registry.login_server, refresh_token="secret-token", scheme="http"
+    )
+
+    assert registry.pull_repos() == ["binder/image-a", "binder/image-b"]
+    assert len(registry.pull_manifests("binder/image-a")) == 2
+
+    registry.delete_image("binder/image-a@sha256:a2")
+    registry.close()
+
+    assert fake_registry.deleted == ["binder/image-a@sha256:a2"]
+
+
+def test_run_cache_warms_up(fake_registry, tmp_path):
+    cache = str(tmp_path / "cache.db")
+
+    def login(self):
+        self.client = RegistryClient(
+            fake_registry.login_server,
+            refresh_token="secret-token",
+            scheme="http",
+        )
+
+    with patch.object(RegistryBackend, "login", login), patch.object(
+        RegistryBackend, "check_size", return_value=(5000.0, True)
+    ), freeze_time("2020-08-01T09:30:00.0000000Z"):
+        run("test_acr", 90, 2.0, backend="http", cache=cache, dry_run=True)
+        listed = [path for _, path in fake_registry.requests]
+        fake_registry.requests.clear()
+        run("test_acr", 90, 2.0, backend="http", cache=cache, dry_run=True)
+
+    # The first run lists each repository before reading its metadata
+    assert "/acr/v1/binder/image-a/_manifests" in listed
+    assert listed.index("/acr/v1/binder/image-a/_manifests") < listed.index(
+        "/acr/v1/binder/image-a"
+    )
+    # The second only reads the metadata
+    paths = [path for _, path in fake_registry.requests]
+    assert not [path for path in paths if path.endswith("/_manifests")]
+    assert "/acr/v1/binder/image-b" in paths
+
+
+def make_registry(size: float, manifests: list) -> MagicMock:
+    registry = MagicMock()
+    registry.check_size.return_value = (size, size >= 2000.0)
+    registry.pull_repos.return_value = ["test_repo"]
+    registry.pull_manifests.return_value = manifests
+    registry.iter_manifests.side_effect = lambda repo, **kwargs: iter(
+        sorted(manifests, key=lambda manifest: manifest["timestamp"])
+    )
+    return registry
+
+
+def test_run_deletes_old_images():
+    registry = make_registry(
+        5000.0,
+        [
+            {
+                "timestamp": "2020-07-30T21:12:00.0000000Z",
+                "digest": "digest_image1",
+                "repo": "test_repo",
+            },
+            {
+                "timestamp": "2020-04-30T21:12:00.0000000Z",
+                "digest": "digest_image2",
+                "repo": "test_repo",
+            },
+        ],
+    )
+
+    with patch(
+        "docker_bot.app.get_backend", return_value=registry
+    ), freeze_time("2020-08-01T09:30:00.0000000Z"):
+        run("test_acr", 90, 2.0, 2)
+
+    registry.login.assert_called_once()
+    assert registry.check_size.call_args_list == [call(2.0), call(2.0)]
+    registry.delete_image.assert_called_once_with("test_repo@digest_image2")
+
+
+@patch("docker_bot.inventory.INVENTORY_BACKEND", "array")
+def test_run_without_pandas():
+    manifests = [
+        {
+            "timestamp": "2020-07-30T21:12:00.0000000Z",
+            "digest": "digest_image1",
+            "repo": "test_repo",
+        },
+        {
+            "timestamp": "2020-04-30T21:12:00.0000000Z",
+            "digest": "digest_image2",
+            "repo": "test_repo",
+        },
+    ]
+    registry = make_registry(5000.0, manifests)
+
+    with patch(
+        "docker_bot.app.get_backend", return_value=registry
+    ), freeze_time("2020-08-01T09:30:00.0000000Z"):
+        run("test_acr", 90, 2.0, 2)
+
+        registry.delete_image.assert_called_once_with(
+            "test_repo@digest_image2"
+        )
+
+        # Purging an ACR under its limit deletes whole repositories
+        registry.check_size.return_value = (1000.0, False)
+        result = run("test_acr", 90, 2.0, 2, purge=True)
+        registry.delete_repo.assert_called_once_with("test_repo")
+        assert result == {"size": 1000.0, "deleted": 2}
+
+        with pytest.raises(RuntimeError):
+            run("test_acr", 90, 2.0, 2, to_limit=True)
+
+
+def test_run_closes_backend_on_error():
+    registry = make_registry(5000.0, [])
+    registry.pull_repos.side_effect = RuntimeError("Could not list repos")
+
+    with patch("docker_bot.app.get_backend", return_value=registry):
+        with pytest.raises(RuntimeError):
+            run("test_acr", 90, 2.0, 2)
+
+    registry.close.assert_called_once()
+
+
+def test_run_records_metrics(tmp_path):
+    registry = make_registry(
+        5000.0,
+        [
+            {
+                "timestamp": "2020-04-30T21:12:00.0000000Z",
+                "digest": "digest_image1",
+                "repo": "test_repo",
+            },
+        ],
+    )
+    registry.check_size.side_effect = [(5000.0, True), (1500.0, False)]
+    summary = tmp_path / "summary.json"
+
+    with patch(
+        "docker_bot.app.get_backend", return_value=registry
+    ), freeze_time("2020-08-01T09:30:00.0000000Z"):
+        with collect_metrics(summary=str(summary)):
+            run("test_acr", 90, 2.0, 2)
+
+    result = json.loads(summary.read_text())
+    assert result["reclaimed_bytes"] == 3.5e12
+    assert result["stages"]["compute_image_ages"]["calls"] == 1
+
+
+@patch("docker_bot.app.iter_manifests")
+def test_take_older_records_pull_manifests(mock_iter, tmp_path):
+    mock_iter.return_value = iter(
+        [
+            {"timestamp": "2020-04-30T21:12:00.0000000Z"},
+            {"timestamp": "2020-07-30T21:12:00.0000000Z"},
+        ]
+    )
+    registry = AzCliBackend("test_acr")
+    summary = tmp_path / "summary.json"
+
+    with collect_metrics(summary=str(summary)):
+        manifests, complete = take_older(
+            registry.iter_manifests("test_repo", oldest_first=True),
+            "2020-05-03T00:00:00",
+        )
+
+    assert len(manifests) == 1
+    assert not complete
+    result = json.loads(summary.read_text())
+    assert result["stages"]["pull_manifests"]["calls"] == 1
+
+
+def test_run_resume(tmp_path):
+    registry = make_registry(1500.0, [])
+    path = str(tmp_path / "journal.jsonl")
+
+    journal = DeletionJournal(path)
+    journal.write_plan(
+        "test_acr",
+        [("image", "test_repo@digest1", 1), ("image", "test_repo@digest2", 1)],
+    )
+    journal.record_done("test_repo@digest1")
+    journal.close()
+
+    with patch("docker_bot.app.get_backend", return_value=registry):
+        run("test_acr", 90, 2.0, 2, journal=path, resume=True)
+
+    registry.pull_repos.assert_not_called()
+    registry.delete_image.assert_called_once_with("test_repo@digest2")
+    assert DeletionJournal(path).remaining("test_acr") == []
+
+
+def test_run_dry_run():
+    registry = make_registry(
+        5000.0,
+        [
+            {
+                "timestamp": "2020-04-30T21:12:00.0000000Z",
+                "digest": "digest_image1",
+                "repo": "test_repo",
+            }
+        ],
+    )
+
+    with patch(
+        "docker_bot.app.get_backend", return_value=registry
+    ), freeze_time("2020-08-01T09:30:00.0000000Z"):
+        run("test_acr", 90, 2.0, 2, dry_run=True)
+
+    registry.delete_image.assert_not_called()
+
+
+def test_run_nothing_to_do():
+    registry = make_registry(1000.0, [])
+
+    with patch("docker_bot.app.get_backend", return_value=registry):
+        run("test_acr", 90, 2.0, 2)
+
+    registry.pull_repos.assert_not_called()
+    registry.delete_image.assert_not_called()
+
+
+def test_run_stop_under_limit():
+    registry = make_registry(
+        2070.0,
+        [
+            {
+                "timestamp": "2020-07-30T21:12:00.0000000Z",
+                "digest": "digest_image1",
+                "repo": "test_repo",
+                "imageSize": 10 * 10**9,
+            },
+            {
+                "timestamp": "2020-04-30T21:12:00.0000000Z",
+                "digest": "digest_image2",
+                "repo": "test_repo",
+                "imageSize": 40 * 10**9,
+            },
+            {
+                "timestamp": "2020-03-30T21:12:00.0000000Z",
+                "digest": "digest_image3",
+                "repo": "test_repo",
+                "imageSize": 40 * 10**9,
+            },
+            {
+                "timestamp": "2020-02-28T21:12:00.0000000Z",
+                "digest": "digest_image4",
+                "repo": "test_repo",
+                "imageSize": 40 * 10**9,
+            },
+        ],
+    )
+    registry.check_size.side_effect = [(2070.0, True), (1995.0, False)]
+
+    with patch(
+        "docker_bot.app.get_backend", return_value=registry
+    ), freeze_time("2020-08-01T09:30:00.0000000Z"):
+        result = run(
+            "test_acr", 90, 2.0, delete_threads=1, stop_under_limit=True
+        )
+
+    # The oldest images are deleted until the estimate is under the limit,
+    # which the second size check confirms and the last reuses
+    assert registry.delete_image.call_args_list == [
+        call("test_repo@digest_image4"),
+        call("test_repo@digest_image3"),
+    ]
+    assert registry.check_size.call_count == 2
+    assert result == {"size": 1995.0, "deleted": 2}
+
+
+def test_run_policy(tmp_path):
+    registry = make_registry(
+        5000.0,
+        [
+            {
+                "timestamp": "2020-07-30T21:12:00.0000000Z",
+                "digest": "digest_image1",
+                "repo": "test_repo",
+            },
+            {
+                "timestamp": "2020-04-30T21:12:00.0000000Z",
+                "digest": "digest_image2",
+                "repo": "test_repo",
+            },
+            {
+                "timestamp": "2020-03-30T21:12:00.0000000Z",
+                "digest": "digest_image3",
+                "repo": "test_repo",
+            },
+        ],
+    )
+    policy = RetentionPolicy(90, keep_last=2)
+    report = tmp_path / "decisions.csv"
+
+    with patch(
+        "docker_bot.app.get_backend", return_value=registry
+    ), freeze_time("2020-08-01T09:30:00.0000000Z"):
+        run("test_acr", 90, 2.0, 2, policy=policy, policy_report=str(report))
+
+    # Keeping the newest images needs every image listed, not only the old
+    registry.iter_manifests.assert_not_called()
+    registry.delete_image.assert_called_once_with("test_repo@digest_image3")
+    assert len(report.read_text().splitlines()) == 4
+
+
+def test_run_policy_protects_tags():
+    registry = make_registry(
+        5000.0,
+        [
+            {
+                "timestamp": "2020-04-30T21:12:00.0000000Z",
+                "digest": "digest_image1",
+                "repo": "test_repo",
+                "tags": ["v1"],
+            },
+            {
+                "timestamp": "2020-03-30T21:12:00.0000000Z",
+                "digest": "digest_image2",
+                "repo": "test_repo",
+                "tags": ["latest"],
+            },
+        ],
+    )
+    policy = RetentionPolicy(90, protect=["latest"])
+
+    with patch(
+        "docker_bot.app.get_backend", return_value=registry
+    ), freeze_time("2020-08-01T09:30:00.0000000Z"):
+        run("test_acr", 90, 2.0, 2, policy=policy)
+
+    registry.delete_image.assert_called_once_with("test_repo@digest_image1")
+
+
+def test_compute_image_ages():
+    manifests = [
+        {
+            "timestamp": "2020-07-30T21:12:00.0000000Z",
+            "digest": "digest1",
+            "repo": "repo1",
+        },
+        {
+            "timestamp": "2020-05-01T10:00:00Z",
+            "digest": "digest2",
+            "repo": "repo2",
+        },
+        {
+            "timestamp": "2020-08-01T09:29:59.5Z",
+            "digest": "digest3",
+            "repo": "repo1",
+        },
+    ]
+    now = datetime.datetime(2020, 8, 1, 9, 30)
+
+    out = compute_image_ages(manifests, now=now)
+
+    assert list(out["image_name"]) == [
+        "repo1@digest1",
+        "repo2@digest2",
+        "repo1@digest3",
+    ]
+    assert list(out["age_days"]) == [1, 91, 0]
+    assert out["age_days"].dtype == np.int32
+
+
+def test_compute_image_ages_now_with_timezone():
+    manifests = [
+        {
+            "timestamp": "2020-07-31T09:30:00.0000000Z",
+            "digest": "digest1",
+            "repo": "repo1",
+        }
+    ]
+    now = datetime.datetime(
+        2020,
+        8,
+        1,
+        10,
+        30,
+        tzinfo=datetime.timezone(datetime.timedelta(hours=1)),
+    )
+
+    out = compute_image_ages(manifests, now=now)
+
+    assert list(out["age_days"]) == [1]
+
+
+def test_compute_image_ages_empty():
+    out = compute_image_ages([])
+
+    assert out.empty
+
+
+@patch("docker_bot.inventory.INVENTORY_BACKEND", "array")
+def test_compute_image_ages_without_pandas():
+    manifests = [
+        {
+            "timestamp": "2020-07-30T21:12:00.0000000Z",
+            "digest": "digest1",
+            "repo": "repo1",
+        },
+        {
+            "timestamp": "2020-05-01T10:00:00Z",
+            "digest": "digest2",
+            "repo": "repo2",
+            "imageSize": 2000,
+        },
+    ]
+    now = datetime.datetime(
+        2020,
+        8,
+        1,
+        10,
+        30,
+        tzinfo=datetime.timezone(datetime.timedelta(hours=1)),
+    )
+
+    out = compute_image_ages(manifests, now=now)
+
+    assert isinstance(out, ImageTable)
+    assert list(out["image_name"]) == ["repo1@digest1", "repo2@digest2"]
+    assert list(out["age_days"]) == [1, 91]
+    assert list(out["image_size"]) == [0, 2000]
+    assert compute_image_ages([]).empty
+
+
+@patch("docker_bot.app.run_cmd", return_value={"returncode": 0})
+def test_delete_repo(mock_args):
+    acr_name = "test_acr"
+    repo = "test_repo"
+
+    delete_repo(acr_name, repo)
+
+    mock_args.assert_called_once_with(
+        [
+            "az",
+            "acr",
+            "repository",
+            "delete",
+            "-n",
+            acr_name,
+            "--repository",
+            repo,
+            "--yes",
+        ],
+        timeout=LIST_TIMEOUT,
+    )
+
+
+@patch(
+    "docker_bot.app.run_cmd",
+    return_value={"returncode": 1, "err_msg": "Could not run command"},
+)
+def test_delete_repo_exception(mock_args):
+    with pytest.raises(RuntimeError):
+        delete_repo("test_acr", "test_repo")
+
+
+@patch("docker_bot.app.run_cmd", return_value={"returncode": 0})
+def test_purge_all_whole_repos(mock_args):
+    acr_name = "test_acr"
+    test_df = pd.DataFrame(
+        {
+            "image_name": ["repo1@digest1", "repo1@digest2"],
+            "repo": ["repo1", "repo1"],
+            "age_days": [67, 53],
+        }
+    )
+    test_df.set_index("image_name", inplace=True)
+
+    purge_all(acr_name, test_df)
+
+    mock_args.assert_called_once_with(
+        [
+            "az",
+            "acr",
+            "repository",
+            "delete",
+            "-n",
+            acr_name,
+            "--repository",
+            "repo1",
+            "--yes",
+        ],
+        timeout=LIST_TIMEOUT,
+    )
+
+
+@patch(
+    "docker_bot.app.run_cmd",
+    return_value={
+        "returncode": 0,
+        "output": '{"lastUpdateTime": "2020-07-30T19:56:00.0000000Z", "manifestCount": 2}',
+    },
+)
+def test_pull_repo_metadata(mock_args):
+    acr_name = "test_acr"
+    repo = "test_repo"
+
+    out = pull_repo_metadata(acr_name, repo)
+
+    mock_args.assert_called_once_with(
+        [
+            "az",
+            "acr",
+            "repository",
+            "show",
+            "-n",
+            acr_name,
+            "--repository",
+            repo,
+        ],
+        timeout=AZ_TIMEOUT,
+    )
+    assert out == {
+        "lastUpdateTime": "2020-07-30T19:56:00.0000000Z",
+        "manifestCount": 2,
+    }
+
+
+@patch(
+    "docker_bot.app.run_cmd",
+    return_value={"returncode": 1, "err_msg": "Could not run command"},
+)
+def test_pull_repo_metadata_exception(mock_args):
+    with pytest.raises(RuntimeError):
+        pull_repo_metadata("test_acr", "test_repo")
+
+
+@patch(
+    "docker_bot.app.stream_cmd",
+    return_value=iter(
+        [
+            {
+                "lastUpdateTime": "2020-07-30T19:56:00.0000000Z",
+                "digest": "digest_image1",
+                "tags": ["latest"],
+                "architecture": "amd64",
+            },
+            {
+                "timestamp": "2020-07-29T19:57:00.0000000Z",
+                "digest": "digest_image2",
+            },
+        ]
+    ),
+)
+def test_iter_manifests(mock_args):
+    out = list(iter_manifests("test_acr", "test_repo"))
+
+    mock_args.assert_called_once_with(
+        [
+            "az",
+            "acr",
+            "repository",
+            "show-manifests",
+            "-n",
+            "test_acr",
+            "--repository",
+            "test_repo",
+            "--detail",
+        ],
+        timeout=600,
+    )
+    assert out == [
+        {
+            "digest": "digest_image1",
+            "tags": ["latest"],
+            "timestamp": "2020-07-30T19:56:00.0000000Z",
+            "imageSize": 0,
+            "repo": "test_repo",
+        },
+        {
+            "digest": "digest_image2",
+            "tags": [],
+            "timestamp": "2020-07-29T19:57:00.0000000Z",
+            "imageSize": 0,
+            "repo": "test_repo",
+        },
+    ]
+
+
+@patch("docker_bot.app.stream_cmd", return_value=iter([]))
+def test_iter_manifests_oldest_first(mock_args):
+    list(iter_manifests("test_acr", "test_repo", oldest_first=True))
+
+    assert mock_args.call_args[0][0][-2:] == ["--orderby", "time_asc"]
+
+
+def test_compute_image_ages_inventory():
+    inventory = ImageInventory.from_manifests(
+        [
+            {
+                "timestamp": "2020-07-30T21:12:00.0000000Z",
+                "digest": "digest1",
+                "repo": "repo1",
+            }
+        ]
+    )
+
+    out = compute_image_ages(
+        inventory, now=datetime.datetime(2020, 8, 1, 9, 30)
+    )
+
+    assert list(out["image_name"]) == ["repo1@digest1"]
+    assert list(out["age_days"]) == [1]
+
+
+@patch(
+    "docker_bot.app.run_cmd",
+    return_value={
+        "returncode": 0,
+        "output": '[{"lastUpdateTime": "2020-07-30T19:56:00.0000000Z", "digest": "digest_image1", "imageSize": 1000}]',
+    },
+)
+def test_pull_manifests_detail(mock_args):
+    out = pull_manifests("test_acr", "test_repo", detail=True)
+
+    mock_args.assert_called_once_with(
+        [
+            "az",
+            "acr",
+            "repository",
+            "show-manifests",
+            "-n",
+            "test_acr",
+            "--repository",
+            "test_repo",
+            "--detail",
+        ],
+        timeout=LIST_TIMEOUT,
+    )
+    assert out == [
+        {
+            "lastUpdateTime": "2020-07-30T19:56:00.0000000Z",
+            "timestamp": "2020-07-30T19:56:00.0000000Z",
+            "digest": "digest_image1",
+            "imageSize": 1000,
+            "repo": "test_repo",
+        }
+    ]
+
+
+def test_run_to_limit():
+    registry = make_registry(
+        2001.0,
+        [
+            {
+                "timestamp": "2020-03-30T21:12:00.0000000Z",
+                "digest": "digest_image1",
+                "imageSize": 2 * 10**9,
+                "repo": "test_repo",
+            },
+            {
+                "timestamp": "2020-04-30T21:12:00.0000000Z",
+                "digest": "digest_image2",
+                "imageSize": 3 * 10**9,
+                "repo": "test_repo",
+            },
+            {
+                "timestamp": "2020-07-30T21:12:00.0000000Z",
+                "digest": "digest_image3",
+                "imageSize": 1 * 10**9,
+                "repo": "test_repo",
+            },
+        ],
+    )
+
+    with patch(
+        "docker_bot.app.get_backend", return_value=registry
+    ), freeze_time("2020-08-01T09:30:00.0000000Z"):
+        run("test_acr", 90, 2.0, 2, to_limit=True)
+
+    # Deleting the oldest image frees enough to get under the limit
+    registry.delete_image.assert_called_once_with("test_repo@digest_image1")
+
+
+@patch(
+    "docker_bot.app.run_cmd",
+    return_value={
+        "returncode": 0,
+        "output": '{"schemaVersion": 2, "layers": [{"digest": "sha256:l1", "size": 100}]}',
+    },
+)
+def test_pull_manifest_body(mock_args):
+    out = pull_manifest_body("test_acr", "test_repo@digest1")
+
+    mock_args.assert_called_once_with(
+        [
+            "az",
+            "acr",
+            "manifest",
+            "show",
+            "--registry",
+            "test_acr",
+            "--name",
+            "test_repo@digest1",
+        ],
+        timeout=AZ_TIMEOUT,
+    )
+    assert out["layers"] == [{"digest": "sha256:l1", "size": 100}]
+
+
+def test_run_to_limit_layers():
+    registry = make_registry(
+        2001.0,
+        [
+            {
+                "timestamp": "2020-03-30T21:12:00.0000000Z",
+                "digest": "digest_image1",
+                "repo": "test_repo",
+            },
+            {
+                "timestamp": "2020-04-30T21:12:00.0000000Z",
+                "digest": "digest_image2",
+                "repo": "test_repo",
+            },
+            {
+                "timestamp": "2020-07-30T21:12:00.0000000Z",
+                "digest": "digest_image3",
+                "repo": "test_repo",
+            },
+        ],
+    )
+    # image1 only holds layers shared with image3
+    registry.pull_manifest_body.side_effect = lambda image_name: {
+        "layers": [
+            {"digest": "shared", "size": 10**9},
+            {
+                "digest": image_name,
+                "size": 0 if image_name.endswith("1") else 2 * 10**9,
+            },
+        ]
+    }
+
+    with patch(
+        "docker_bot.app.get_backend", return_value=registry
+    ), freeze_time("2020-08-01T09:30:00.0000000Z"):
+        run("test_acr", 90, 2.0, 2, to_limit=True, layers=True)
+
+    assert registry.pull_manifest_body.call_count == 3
+    registry.delete_image.assert_called_once_with("test_repo@digest_image2")
+
+
+def test_list_images_per_repo():
+    registry = MagicMock()
+    registry.pull_manifests.side_effect = lambda repo: [
+        {
+            "timestamp": "2020-07-30T21:12:00.0000000Z",
+            "digest": "digest_%s" % repo,
+            "repo": repo,
+        }
+    ]
+
+    with freeze_time("2020-08-01T09:30:00.0000000Z"):
+        batch = list_images(registry, ["repo1", "repo2"], workers=2)
+        per_repo = list_images(
+            registry, ["repo1", "repo2"], workers=2, age_mode="per-repo"
+        )
+
+    batch = batch.sort_values("image_name", ignore_index=True)
+    per_repo = per_repo.sort_values("image_name", ignore_index=True)
+    assert list(per_repo["image_name"]) == list(batch["image_name"])
+    assert list(per_repo["age_days"]) == [1, 1]
+    assert isinstance(per_repo["repo"].dtype, pd.CategoricalDtype)
+
+    with pytest.raises(ValueError):
+        list_images(registry, ["repo1"], age_mode="unknown")
+
+
+@patch("docker_bot.inventory.INVENTORY_BACKEND", "array")
+def test_list_images_per_repo_without_pandas():
+    registry = MagicMock()
+    registry.pull_manifests.side_effect = lambda repo: [
+        {
+            "timestamp": "2020-07-30T21:12:00.0000000Z",
+            "digest": "digest_%s" % repo,
+            "repo": repo,
+        }
+    ]
+
+    with freeze_time("2020-08-01T09:30:00.0000000Z"):
+        out = list_images(
+            registry, ["repo1", "repo2"], workers=2, age_mode="per-repo"
+        )
+
+    assert isinstance(out, ImageTable)
+    assert sorted(out["image_name"]) == [
+        "repo1@digest_repo1",
+        "repo2@digest_repo2",
+    ]
+    assert list(out["age_days"]) == [1, 1]
+
+
+def test_age_cutoff():
+    now = datetime.datetime(2020, 8, 1, 9, 30)
+
+    assert age_cutoff(90, now=now) == "2020-05-04T09:30:00"
+
+
+def test_take_older():
+    manifests = iter(
+        [
+            {"digest": "digest1", "timestamp": "2020-04-30T21:12:00Z"},
+            {"digest": "digest2", "timestamp": "2020-05-04T09:30:00.5Z"},
+            {"digest": "digest3", "timestamp": "2020-07-30T21:12:00Z"},
+        ]
+    )
+
+    older, complete = take_older(manifests, "2020-05-04T09:30:00")
+
+    assert [m["digest"] for m in older] == ["digest1", "digest2"]
+    assert not complete
+
+    older, complete = take_older(iter([]), "2020-05-04T09:30:00")
+    assert older == []
+    assert complete
+
+
+def test_list_images_older_than():
+    manifests = {
+        "repo1": [
+            {
+                "timestamp": "2020-04-30T21:12:00.0000000Z",
+                "digest": "digest1",
+                "repo": "repo1",
+            },
+            {
+                "timestamp": "2020-07-30T21:12:00.0000000Z",
+                "digest": "digest2",
+                "repo": "repo1",
+            },
+        ],
+        "repo2": [
+            {
+                "timestamp": "2020-03-30T21:12:00.0000000Z",
+                "digest": "digest3",
+                "repo": "repo2",
+            },
+        ],
+    }
+    registry = MagicMock()
+    registry.iter_manifests.side_effect = lambda repo, **kwargs: iter(
+        manifests[repo]
+    )
+    repo_counts = {}
+
+    with freeze_time("2020-08-01T09:30:00.0000000Z"):
+        out = list_images(
+            registry,
+            ["repo1", "repo2"],
+            workers=2,
+            older_than="2020-05-04T09:30:00",
+            repo_counts=repo_counts,
+        )
+
+    assert sorted(out["image_name"]) == ["repo1@digest1", "repo2@digest3"]
+    registry.iter_manifests.assert_any_call("repo1", oldest_first=True)
+    registry.pull_manifests.assert_not_called()
+
+    # Only repo2 was listed in full, so only it may be deleted whole
+    assert repo_counts == {"repo2": 1}
+
+
+@patch("docker_bot.app.login")
+@patch("docker_bot.app.AzWorkerPool")
+def test_backend_az_workers(mock_pool, mock_login):
+    registry = AzCliBackend("test_acr", az_workers=3)
+
+    registry.login()
+
+    mock_pool.assert_called_once_with(3)
+    assert helper_functions.AZ_POOL is mock_pool.return_value
+
+    registry.close()
+
+    mock_pool.return_value.close.assert_called_once()
+    assert helper_functions.AZ_POOL is None
@@ -0,0 +1,92 @@
+import os
+import json
+import pytest
+from unittest.mock import patch
+from concurrent.futures import ThreadPoolExecutor
+from docker_bot.azpool import AzWorkerPool
+from docker_bot.helper_functions import run_cmd, set_az_pool, stream_cmd
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture
+def az_pool():
+    env = dict(os.environ, PYTHONPATH=TESTS)
+    pool = AzWorkerPool(2, cli="fake_az:get_default_cli", env=env)
+    yield pool
+    pool.close()
+
+
+def test_az_pool(az_pool):
+    pids = {worker.pid for worker in az_pool.workers}
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(
+            executor.map(
+                az_pool.run,
+                [["az", "acr", "show", "-n", str(i)] for i in range(10)],
+            )
+        )
+
+    assert all(result["returncode"] == 0 for result in results)
+    outputs = [json.loads(result["output"]) for result in results]
+    assert outputs[3]["args"] == ["acr", "show", "-n", "3"]
+    # Every command ran on one of the warm workers
+    assert {output["pid"] for output in outputs} <= pids
+    assert results[0]["err_msg"] == "warming up"
+
+
+def test_az_pool_failure(az_pool):
+    result = az_pool.run(["az", "fail"])
+
+    assert result["returncode"] == 1
+    assert result["err_msg"] == "ERROR: command failed"
+
+
+def test_az_pool_restarts_workers(az_pool):
+    result = az_pool.run(["az", "crash"])
+
+    assert result["returncode"] == 1
+    assert len(az_pool.workers) == 2
+    assert az_pool.run(["az", "version"])["returncode"] == 0
+
+
+def test_az_pool_timeout(az_pool):
+    pids = {worker.pid for worker in az_pool.workers}
+
+    result = az_pool.run(["az", "sleep", "5"], timeout=0.2)
+
+    assert result["returncode"] == 1
+    assert result["err_msg"] == "az sleep 5 timed out after 0.2s"
+    # The stuck worker was replaced
+    assert len(az_pool.workers) == 2
+    assert len(pids & {worker.pid for worker in az_pool.workers}) == 1
+    assert az_pool.run(["az", "sleep", "0"], timeout=5)["returncode"] == 0
+
+
+def test_run_cmd_uses_az_pool(az_pool):
+    set_az_pool(az_pool)
+    try:
+        with patch("docker_bot.helper_functions.subprocess.Popen") as popen:
+            result = run_cmd(["az", "acr", "list"])
+
+        popen.assert_not_called()
+        assert json.loads(result["output"])["args"] == ["acr", "list"]
+        # Other commands still get their own process
+        assert run_cmd(["echo", "hello"])["output"] == "hello"
+    finally:
+        set_az_pool(None)
+
+
+def test_stream_cmd_uses_az_pool(az_pool):
+    set_az_pool(az_pool)
+    try:
+        items = stream_cmd(["az", "items", "a", "b"], timeout=5)
+
+        assert next(items) == "a"
+        assert list(items) == ["b"]
+
+        with pytest.raises(RuntimeError, match="timed out"):
+            list(stream_cmd(["az", "sleep", "5"], timeout=0.2))
+    finally:
+        set_az_pool(None)
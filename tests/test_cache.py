@@ -0,0 +1,186 @@
+from unittest.mock import MagicMock
+from docker_bot.cache import CachingBackend, ManifestCache
+
+MANIFESTS = [
+    {
+        "digest": "digest1",
+        "tags": ["latest"],
+        "timestamp": "2020-07-30T19:56:00.0000000Z",
+        "repo": "repo1",
+    },
+    {
+        "digest": "digest2",
+        "tags": [],
+        "timestamp": "2020-05-01T10:00:00.0000000Z",
+        "imageSize": 2000,
+        "repo": "repo1",
+    },
+]
+
+
+def test_manifest_cache(tmp_path):
+    cache = ManifestCache(str(tmp_path / "cache.db"))
+
+    assert cache.get("repo1", "t1") is None
+
+    cache.put("repo1", "t1", MANIFESTS)
+    out = cache.get("repo1", "t1")
+
+    assert [m["digest"] for m in out] == ["digest1", "digest2"]
+    assert out[0]["tags"] == ["latest"]
+    assert out[1]["imageSize"] == 2000
+    assert out[1]["repo"] == "repo1"
+    # The repository has been updated since it was cached
+    assert cache.get("repo1", "t2") is None
+
+
+def test_manifest_cache_persists(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = ManifestCache(path)
+    cache.put("repo1", "t1", MANIFESTS)
+    cache.close()
+
+    out = ManifestCache(path).get("repo1", "t1")
+
+    assert len(out) == 2
+
+
+def test_manifest_cache_evict(tmp_path):
+    cache = ManifestCache(str(tmp_path / "cache.db"))
+    cache.put("repo1", "t1", MANIFESTS)
+    cache.put("repo2", "t1", [])
+    cache.put("repo3", "t1", [])
+
+    cache.evict_image("repo1@digest1")
+    cache.evict_repo("repo2")
+    cache.prune(["repo1"])
+
+    assert [m["digest"] for m in cache.get("repo1", "t1")] == ["digest2"]
+    assert cache.get("repo2", "t1") is None
+    assert cache.get("repo3", "t1") is None
+
+
+def test_manifest_cache_bodies(tmp_path):
+    cache = ManifestCache(str(tmp_path / "cache.db"))
+    body = {"schemaVersion": 2, "layers": [{"digest": "l1", "size": 100}]}
+
+    assert cache.get_body("digest1") is None
+    cache.put_body("digest1", body)
+    # Bodies outlive the images that reference them
+    cache.evict_repo("repo1")
+
+    assert cache.get_body("digest1") == body
+
+
+def test_caching_backend(tmp_path):
+    registry = MagicMock()
+    registry.acr_name = "test_acr"
+    registry.pull_repos.return_value = ["repo1"]
+    registry.pull_repo_metadata.return_value = {"lastUpdateTime": "t1"}
+    registry.pull_manifests.return_value = MANIFESTS
+    cached = CachingBackend(registry, ManifestCache(str(tmp_path / "db")))
+
+    assert cached.acr_name == "test_acr"
+    assert cached.pull_repos() == ["repo1"]
+    first = cached.pull_manifests("repo1")
+    second = cached.pull_manifests("repo1")
+
+    registry.pull_manifests.assert_called_once_with("repo1")
+    assert [m["digest"] for m in first] == [m["digest"] for m in second]
+
+    cached.delete_image("repo1@digest1")
+    registry.delete_image.assert_called_once_with("repo1@digest1")
+    assert len(cached.pull_manifests("repo1")) == 1
+
+    # A changed repository is listed again
+    registry.pull_repo_metadata.return_value = {"lastUpdateTime": "t2"}
+    cached.pull_manifests("repo1")
+    assert registry.pull_manifests.call_count == 2
+
+    registry.pull_manifest_body.return_value = {"layers": []}
+    cached.pull_manifest_body("repo1@digest2")
+    cached.pull_manifest_body("repo1@digest2")
+    registry.pull_manifest_body.assert_called_once_with("repo1@digest2")
+
+    cached.delete_repo("repo1")
+    registry.delete_repo.assert_called_once_with("repo1")
+    cached.close()
+    registry.close.assert_called_once()
+
+
+def test_caching_backend_iter_manifests(tmp_path):
+    registry = MagicMock()
+    registry.pull_repo_metadata.return_value = {"lastUpdateTime": "t1"}
+    registry.iter_manifests.side_effect = lambda repo, page_size: iter(
+        MANIFESTS
+    )
+    cached = CachingBackend(registry, ManifestCache(str(tmp_path / "db")))
+
+    # An interrupted listing isn't cached
+    manifests = cached.iter_manifests("repo1", page_size=1)
+    next(manifests)
+    manifests.close()
+    assert cached.cache.get("repo1", "t1") is None
+
+    out = list(cached.iter_manifests("repo1", page_size=1))
+    assert [m["digest"] for m in out] == ["digest1", "digest2"]
+    assert len(cached.cache.get("repo1", "t1")) == 2
+
+    list(cached.iter_manifests("repo1", page_size=1))
+    assert registry.iter_manifests.call_count == 2
+
+
+def test_caching_backend_iter_manifests_oldest_first(tmp_path):
+    registry = MagicMock()
+    registry.pull_repo_metadata.return_value = {
+        "lastUpdateTime": "t1",
+        "manifestCount": 2,
+    }
+    registry.iter_manifests.side_effect = lambda repo, **kwargs: iter(
+        MANIFESTS
+    )
+    cached = CachingBackend(registry, ManifestCache(str(tmp_path / "db")))
+
+    # The first ordered listing reads the whole repository and caches it,
+    # even when the caller stops early
+    manifests = cached.iter_manifests("repo1", oldest_first=True)
+    assert next(manifests)["digest"] == "digest2"
+    manifests.close()
+    registry.iter_manifests.assert_called_once_with("repo1", page_size=1000)
+    assert len(cached.cache.get("repo1", "t1")) == 2
+
+    # Cached manifests are ordered like the registry would
+    out = list(cached.iter_manifests("repo1", oldest_first=True))
+    assert [m["digest"] for m in out] == ["digest2", "digest1"]
+    assert registry.iter_manifests.call_count == 1
+
+
+def test_caching_backend_uncached_repo(tmp_path):
+    registry = MagicMock()
+    registry.pull_repo_metadata.return_value = {
+        "lastUpdateTime": "t1",
+        "manifestCount": 3,
+    }
+    registry.iter_manifests.side_effect = lambda repo, **kwargs: iter(
+        MANIFESTS
+    )
+    cached = CachingBackend(registry, ManifestCache(str(tmp_path / "db")))
+
+    # Nothing to check the metadata against until the listing is complete
+    manifests = cached.iter_manifests("repo1")
+    next(manifests)
+    registry.pull_repo_metadata.assert_not_called()
+
+    # An image was pushed while the repository was listed
+    list(manifests)
+    registry.pull_repo_metadata.assert_called_once_with("repo1")
+    assert cached.cache.last_update("repo1") is None
+
+    registry.pull_repo_metadata.return_value["manifestCount"] = 2
+    list(cached.iter_manifests("repo1"))
+    assert cached.cache.last_update("repo1") == "t1"
+
+    # An image was deleted without the time changing
+    registry.pull_repo_metadata.return_value["manifestCount"] = 1
+    list(cached.iter_manifests("repo1"))
+    assert registry.iter_manifests.call_count == 3
@@ -1,7 +1,10 @@
+import sys
+import json
 import pytest
 import argparse
+import subprocess
 from unittest.mock import patch
-from docker_bot.cli import check_parser, parse_args
+from docker_bot.cli import check_parser, main, parse_args
 
 
 def test_check_parser():
@@ -31,14 +34,25 @@ def test_check_parser_alternate_values():
         pytest.fail("Unexpected error")
 
 
-@patch("docker_bot.cli.cpu_count", return_value=4)
-def test_check_parser_threads(mock_args):
-    test_args = argparse.Namespace(dry_run=True, purge=False, threads=5)
+def test_check_parser_threads():
+    test_args = argparse.Namespace(
+        dry_run=False, purge=False, threads=None, list_threads=0
+    )
 
     with pytest.raises(ValueError):
         check_parser(test_args)
-        assert mock_args.call_count == 1
-        assert mock_args.return_value == 4
+
+
+def test_check_parser_threads_not_capped_by_cpus():
+    test_args = argparse.Namespace(
+        dry_run=False,
+        purge=False,
+        threads=64,
+        list_threads=128,
+        delete_threads=32,
+    )
+
+    check_parser(test_args)
 
 
 @patch(
@@ -90,3 +104,240 @@ def test_parser_run_options(mock_args):
     assert parser.limit == 1.5
     assert parser.threads == 4
     assert mock_args.call_count == 1
+
+
+def test_check_parser_pipeline_to_limit():
+    test_args = argparse.Namespace(
+        dry_run=False, purge=False, threads=1, pipeline=True, to_limit=True
+    )
+
+    with pytest.raises(ValueError):
+        check_parser(test_args)
+
+
+def test_check_parser_layers_without_to_limit():
+    test_args = argparse.Namespace(
+        dry_run=False, purge=False, threads=1, to_limit=False, layers=True
+    )
+
+    with pytest.raises(ValueError):
+        check_parser(test_args)
+
+
+def test_check_parser_pipeline_stop_under_limit():
+    test_args = argparse.Namespace(
+        dry_run=False,
+        purge=False,
+        threads=1,
+        pipeline=True,
+        stop_under_limit=True,
+    )
+
+    with pytest.raises(ValueError):
+        check_parser(test_args)
+
+
+def test_check_parser_pipeline_time_limit():
+    test_args = argparse.Namespace(
+        dry_run=False,
+        purge=False,
+        threads=1,
+        pipeline=True,
+        time_limit=30,
+    )
+
+    with pytest.raises(ValueError, match="time-limit"):
+        check_parser(test_args)
+
+
+def test_check_parser_time_limit():
+    test_args = argparse.Namespace(
+        dry_run=False, purge=False, threads=1, time_limit=-1
+    )
+
+    with pytest.raises(ValueError, match="time-limit"):
+        check_parser(test_args)
+
+    # A limit of 0 minutes starts no deletions, so pipeline can't honour it
+    test_args.time_limit = 0
+    check_parser(test_args)
+
+    test_args.pipeline = True
+    with pytest.raises(ValueError, match="time-limit"):
+        check_parser(test_args)
+
+
+def test_main_time_limit_zero():
+    argv = ["docker-bot", "test_acr", "--time-limit", "0"]
+
+    with patch.object(sys, "argv", argv), patch(
+        "docker_bot.app.run", return_value={"size": 1000.0, "deleted": 0}
+    ) as mock_run:
+        main()
+
+    assert mock_run.call_args[1]["time_limit"] == 0
+
+
+def test_check_parser_resume_without_journal():
+    test_args = argparse.Namespace(
+        dry_run=False, purge=False, threads=1, resume=True, journal=None
+    )
+
+    with pytest.raises(ValueError):
+        check_parser(test_args)
+
+
+def test_check_parser_no_registries():
+    test_args = argparse.Namespace(
+        dry_run=False, purge=False, threads=1, name=[], config=None
+    )
+
+    with pytest.raises(ValueError):
+        check_parser(test_args)
+
+
+def test_check_parser_multi_journal():
+    test_args = argparse.Namespace(
+        dry_run=False,
+        purge=False,
+        threads=1,
+        name=["acr1", "acr2"],
+        config=None,
+        journal="journal.jsonl",
+    )
+
+    with pytest.raises(ValueError):
+        check_parser(test_args)
+
+
+def test_check_parser_multi_report():
+    test_args = argparse.Namespace(
+        dry_run=False,
+        purge=False,
+        threads=1,
+        name=["acr1", "acr2"],
+        config=None,
+        report="report.json",
+    )
+
+    check_parser(test_args)
+
+    test_args.shard = "0/2"
+    with pytest.raises(ValueError):
+        check_parser(test_args)
+
+
+def test_main_multi_report(tmp_path):
+    report = tmp_path / "report.json"
+    results = {
+        "acr1": {"status": "ok", "size": 1500.0, "deleted": 3},
+        "acr2": {"status": "failed", "size": None, "deleted": 0},
+    }
+    argv = ["docker-bot", "acr1", "acr2", "--report", str(report)]
+
+    with patch.object(sys, "argv", argv), patch(
+        "docker_bot.multi.run_many", return_value=(results, ["acr2"])
+    ) as mock_run_many:
+        # The report is written before exiting for the failed registry
+        with pytest.raises(SystemExit) as exc:
+            main()
+
+    assert exc.value.code == 1
+    assert [r["name"] for r in mock_run_many.call_args[0][0]] == [
+        "acr1",
+        "acr2",
+    ]
+    assert json.loads(report.read_text()) == results
+
+
+def test_check_parser_shard():
+    for shard, to_limit in [("2/2", False), ("0/2", True)]:
+        test_args = argparse.Namespace(
+            dry_run=False,
+            purge=False,
+            threads=1,
+            name=["acr1"],
+            shard=shard,
+            to_limit=to_limit,
+        )
+
+        with pytest.raises(ValueError):
+            check_parser(test_args)
+
+    test_args.to_limit = False
+    check_parser(test_args)
+
+
+def test_check_parser_policy():
+    for options in [
+        dict(name=["acr1", "acr2"]),
+        dict(to_limit=True),
+        dict(pipeline=True),
+    ]:
+        test_args = argparse.Namespace(
+            dry_run=False,
+            purge=False,
+            threads=1,
+            name=["acr1"],
+            config=None,
+            policy="policy.json",
+        )
+        vars(test_args).update(options)
+
+        with pytest.raises(ValueError):
+            check_parser(test_args)
+
+    test_args = argparse.Namespace(
+        dry_run=False, purge=False, threads=1, policy_report="decisions.csv"
+    )
+    with pytest.raises(ValueError):
+        check_parser(test_args)
+
+    test_args.policy = "policy.json"
+    check_parser(test_args)
+
+
+def test_check_parser_merge_reports():
+    test_args = argparse.Namespace(
+        dry_run=False,
+        purge=False,
+        name=[],
+        config=None,
+        merge_reports=["shard0.json", "shard1.json"],
+    )
+
+    check_parser(test_args)
+
+    test_args.name = ["acr1"]
+    with pytest.raises(ValueError):
+        check_parser(test_args)
+
+
+def test_cli_import_is_light():
+    # Parsing arguments shouldn't wait on the modules the clean up needs
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import docker_bot.cli"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    imported = {
+        line.split("|")[-1].strip()
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+
+    assert "docker_bot.cli" in imported
+    for module in ["pandas", "numpy", "requests", "asyncio", "docker_bot.app"]:
+        assert module not in imported
+
+
+def test_package_exports_are_lazy():
+    import docker_bot
+    from docker_bot.app import run
+
+    assert docker_bot.run is run
+    assert "run" in dir(docker_bot)
+    with pytest.raises(AttributeError):
+        docker_bot.not_exported
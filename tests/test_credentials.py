@@ -0,0 +1,66 @@
+import os
+import json
+import time
+import base64
+from docker_bot.credentials import TokenCache, token_expiry
+
+
+def make_jwt(exp: float) -> str:
+    payload = base64.urlsafe_b64encode(json.dumps({"exp": exp}).encode())
+    return "header.%s.signature" % payload.decode().rstrip("=")
+
+
+def test_token_expiry():
+    assert token_expiry(make_jwt(1234567890), 60) == 1234567890
+
+    # Opaque tokens are assumed to last for the given time
+    before = time.time()
+    assert before + 60 <= token_expiry("opaque", 60) <= time.time() + 60
+
+
+def test_token_cache_round_trip(tmp_path):
+    path = str(tmp_path / "tokens" / "tokens.json")
+    expires = time.time() + 3600
+
+    cache = TokenCache(path)
+    cache.put("refresh:acr", "token", expires, login_server="acr.io")
+    cache.put("access:acr.io:old", "stale", time.time() - 1)
+    cache.save()
+
+    assert os.stat(path).st_mode & 0o777 == 0o600
+
+    out = TokenCache(path)
+    assert out.get("refresh:acr") == {
+        "token": "token",
+        "expires": expires,
+        "login_server": "acr.io",
+    }
+    # Expired tokens aren't kept, nor returned within the margin
+    assert out.get("access:acr.io:old") is None
+    assert out.get("refresh:acr", margin=7200) is None
+
+
+def test_token_cache_merges_concurrent_runs(tmp_path):
+    path = str(tmp_path / "tokens.json")
+    expires = time.time() + 3600
+
+    first = TokenCache(path)
+    second = TokenCache(path)
+    first.put("refresh:acr1", "token1", expires)
+    second.put("refresh:acr2", "token2", expires)
+    first.save()
+    second.save()
+
+    out = TokenCache(path)
+    assert out.get("refresh:acr1")["token"] == "token1"
+    assert out.get("refresh:acr2")["token"] == "token2"
+
+
+def test_token_cache_ignores_readable_file(tmp_path):
+    path = tmp_path / "tokens.json"
+    path.write_text(
+        json.dumps({"refresh:acr": {"token": "t", "expires": 1e12}})
+    )
+    path.chmod(0o644)
+
+    assert TokenCache(str(path)).get("refresh:acr") is None
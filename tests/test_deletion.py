@@ -0,0 +1,225 @@
+from unittest.mock import MagicMock, call, patch
+from docker_bot.deletion import bulk_delete, plan_deletions, run_deletions
+from docker_bot.journal import DeletionJournal
+from docker_bot.throttle import ConcurrencyController, ThrottledError
+from docker_bot.usage import UsageMonitor
+
+
+def test_plan_deletions_no_counts():
+    images = ["repo1@digest1", "repo1@digest2"]
+
+    out = plan_deletions(images)
+
+    assert out == [
+        ("image", "repo1@digest1", 1),
+        ("image", "repo1@digest2", 1),
+    ]
+
+
+def test_plan_deletions_whole_repo():
+    images = ["repo1@digest1", "repo2@digest3", "repo1@digest2"]
+    repo_counts = {"repo1": 2, "repo2": 5}
+
+    out = plan_deletions(images, repo_counts)
+
+    assert out == [("repo", "repo1", 2), ("image", "repo2@digest3", 1)]
+
+
+def test_bulk_delete():
+    registry = MagicMock()
+    images = ["repo1@digest1", "repo1@digest2", "repo2@digest3"]
+
+    report = bulk_delete(
+        registry, images, workers=4, repo_counts={"repo1": 2, "repo2": 2}
+    )
+
+    registry.delete_repo.assert_called_once_with("repo1")
+    registry.delete_image.assert_called_once_with("repo2@digest3")
+    assert report["deleted"] == 3
+    assert report["calls"] == 2
+    assert report["failed"] == {}
+    assert report["elapsed"] >= 0
+
+
+@patch("docker_bot.deletion.time.sleep")
+def test_bulk_delete_retries(mock_sleep):
+    registry = MagicMock()
+    registry.delete_image.side_effect = [RuntimeError("throttled"), None]
+
+    report = bulk_delete(registry, ["repo1@digest1"], retries=2, backoff=1.0)
+
+    assert registry.delete_image.call_count == 2
+    assert mock_sleep.call_args_list == [call(1.0)]
+    assert report["deleted"] == 1
+    assert report["calls"] == 2
+    assert report["failed"] == {}
+
+
+@patch("docker_bot.deletion.time.sleep")
+def test_run_deletions_not_found_is_not_deleted(mock_sleep):
+    for message in [
+        "(ResourceNotFound) The Resource 'Microsoft.ContainerRegistry/registries/myacr' under resource group 'rg' was not found.",
+        "az: command not found",
+    ]:
+        registry = MagicMock()
+        registry.delete_image.side_effect = RuntimeError(message)
+
+        report = run_deletions(
+            registry, [("image", "repo1@digest1", 1)], retries=0
+        )
+
+        assert report["deleted"] == 0
+        assert report["failed"] == {"repo1@digest1": message}
+
+
+def test_run_deletions_manifest_not_in_repository():
+    registry = MagicMock()
+    registry.delete_image.side_effect = RuntimeError(
+        "manifest sha256:abc is not found in repository repo1"
+    )
+
+    report = run_deletions(registry, [("image", "repo1@digest1", 1)])
+
+    assert report["deleted"] == 1
+    assert report["failed"] == {}
+
+
+@patch("docker_bot.throttle.time.sleep")
+@patch("docker_bot.deletion.time.sleep")
+def test_bulk_delete_throttled_not_retried_twice(mock_sleep, mock_throttle):
+    registry = MagicMock()
+    registry.delete_image.side_effect = ThrottledError("429")
+    controller = ConcurrencyController(initial=1, retries=2, backoff=0.0)
+
+    report = bulk_delete(
+        registry, ["repo1@digest1"], retries=2, controller=controller
+    )
+
+    # Only the controller's 3 attempts, not 3 for each of the outer ones
+    assert registry.delete_image.call_count == 3
+    mock_sleep.assert_not_called()
+    assert list(report["failed"]) == ["repo1@digest1"]
+
+
+@patch("docker_bot.deletion.time.sleep")
+def test_bulk_delete_failures(mock_sleep):
+    registry = MagicMock()
+
+    def delete_image(image_name):
+        if image_name == "repo1@digest1":
+            raise RuntimeError("Could not run command")
+
+    registry.delete_image.side_effect = delete_image
+
+    report = bulk_delete(
+        registry, ["repo1@digest1", "repo1@digest2"], retries=1, backoff=1.0
+    )
+
+    assert mock_sleep.call_args_list == [call(1.0)]
+    assert report["deleted"] == 1
+    assert report["calls"] == 3
+    assert report["failed"] == {"repo1@digest1": "Could not run command"}
+
+
+@patch("docker_bot.throttle.time.sleep")
+def test_bulk_delete_controller(mock_sleep):
+    registry = MagicMock()
+    registry.delete_image.side_effect = [ThrottledError("429"), None, None]
+    controller = ConcurrencyController(initial=2, maximum=4)
+
+    report = bulk_delete(
+        registry, ["repo1@digest1", "repo1@digest2"], controller=controller
+    )
+
+    assert registry.delete_image.call_count == 3
+    assert report["deleted"] == 2
+    assert report["failed"] == {}
+    assert report["concurrency"]["throttled"] == 1
+
+
+def test_bulk_delete_journal(tmp_path):
+    registry = MagicMock()
+    journal = DeletionJournal(str(tmp_path / "journal.jsonl"))
+    images = ["repo1@digest1", "repo2@digest2"]
+
+    report = bulk_delete(registry, images, journal=journal, acr_name="acr")
+
+    assert report["deleted"] == 2
+    assert DeletionJournal(journal.path).remaining("acr") == []
+
+
+def test_bulk_delete_journals_repo_images(tmp_path):
+    registry = MagicMock()
+    journal = DeletionJournal(str(tmp_path / "journal.jsonl"))
+    images = ["repo1@digest1", "repo1@digest2", "repo2@digest3"]
+
+    report = bulk_delete(
+        registry,
+        images,
+        journal=journal,
+        acr_name="acr",
+        repo_counts={"repo1": 2, "repo2": 2},
+        time_limit=0,
+    )
+
+    registry.delete_repo.assert_not_called()
+    assert report["skipped"] == 3
+    assert DeletionJournal(journal.path).remaining("acr") == [
+        ("image", "repo1@digest1", 1),
+        ("image", "repo1@digest2", 1),
+        ("image", "repo2@digest3", 1),
+    ]
+
+
+def test_bulk_delete_time_limit(tmp_path):
+    registry = MagicMock()
+    journal = DeletionJournal(str(tmp_path / "journal.jsonl"))
+    images = ["repo1@digest1", "repo2@digest2"]
+
+    report = bulk_delete(
+        registry, images, journal=journal, acr_name="acr", time_limit=0
+    )
+
+    registry.delete_image.assert_not_called()
+    assert report["deleted"] == 0
+    assert report["skipped"] == 2
+    assert DeletionJournal(journal.path).remaining("acr") == [
+        ("image", "repo1@digest1", 1),
+        ("image", "repo2@digest2", 1),
+    ]
+
+
+def test_bulk_delete_stop_under_limit():
+    registry = MagicMock()
+    registry.check_size.side_effect = [(2050.0, True), (1990.0, False)]
+    monitor = UsageMonitor(registry, 2.0, stop_under_limit=True)
+    monitor.read()
+    images = ["repo1@digest1", "repo1@digest2", "repo2@digest3"]
+
+    report = bulk_delete(
+        registry,
+        images,
+        repo_counts={"repo1": 2, "repo2": 2},
+        sizes=[40.0e9, 30.0e9, 60.0e9],
+        monitor=monitor,
+    )
+
+    # Deleting repo1 was estimated to free 70 GB, so repo2 wasn't needed
+    registry.delete_repo.assert_called_once_with("repo1")
+    registry.delete_image.assert_not_called()
+    assert registry.check_size.call_count == 2
+    assert report["deleted"] == 2
+    assert report["skipped"] == 1
+
+
+def test_run_deletions_already_deleted():
+    registry = MagicMock()
+    registry.delete_image.side_effect = RuntimeError(
+        "(ManifestUnknown) manifest sha256:abc is not found"
+    )
+
+    report = run_deletions(registry, [("image", "repo1@digest1", 1)])
+
+    registry.delete_image.assert_called_once_with("repo1@digest1")
+    assert report["deleted"] == 1
+    assert report["failed"] == {}
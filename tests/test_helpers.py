@@ -1,5 +1,8 @@
+import io
+import sys
+import time
 import pytest
-from docker_bot.helper_functions import run_cmd
+from docker_bot.helper_functions import iter_json_items, run_cmd, stream_cmd
 
 
 def test_run_cmd():
@@ -16,3 +19,73 @@ def test_run_cmd_exception():
 
     with pytest.raises(FileNotFoundError):
         run_cmd(test_cmd)
+
+
+def test_run_cmd_timeout():
+    result = run_cmd(["sleep", "5"], timeout=0.1)
+
+    assert result["returncode"] != 0
+    assert "timed out" in result["err_msg"]
+
+
+def test_iter_json_items():
+    data = '[{"digest": "sha256:é1"}, 12, "x", [1, 2], 345]'.encode()
+
+    # Every chunk size splits the items and the é differently
+    for chunk_size in [1, 2, 3, 7, 1000]:
+        items = list(iter_json_items(io.BytesIO(data), chunk_size))
+        assert items == [{"digest": "sha256:é1"}, 12, "x", [1, 2], 345]
+
+    assert list(iter_json_items(io.BytesIO(b" [ ] "))) == []
+    assert list(iter_json_items(io.BytesIO(b""))) == []
+
+
+def test_iter_json_items_invalid():
+    with pytest.raises(ValueError):
+        list(iter_json_items(io.BytesIO(b'{"a": 1}')))
+    with pytest.raises(ValueError):
+        list(iter_json_items(io.BytesIO(b'[{"a": 1}, {"b"')))
+
+
+def test_stream_cmd():
+    script = (
+        "import json, sys; print(json.dumps([{'n': i} for i in range(5)]))"
+    )
+
+    items = list(stream_cmd([sys.executable, "-c", script]))
+
+    assert items == [{"n": i} for i in range(5)]
+
+
+def test_stream_cmd_yields_before_exit():
+    # The first item arrives while the command is still running
+    script = (
+        "import sys, time; sys.stdout.write('[1,'); sys.stdout.flush(); "
+        "time.sleep(5); print('2]')"
+    )
+    start = time.perf_counter()
+    items = stream_cmd([sys.executable, "-c", script])
+
+    assert next(items) == 1
+    items.close()
+
+    assert time.perf_counter() - start < 4
+
+
+def test_stream_cmd_exception():
+    script = (
+        "import sys; sys.stderr.write('Could not run command'); sys.exit(1)"
+    )
+
+    with pytest.raises(RuntimeError, match="Could not run command"):
+        list(stream_cmd([sys.executable, "-c", script]))
+
+
+def test_stream_cmd_timeout():
+    script = "import sys, time; print('[1,', flush=True); time.sleep(5)"
+    start = time.perf_counter()
+
+    with pytest.raises(RuntimeError, match="timed out"):
+        list(stream_cmd([sys.executable, "-c", script], timeout=0.5))
+
+    assert time.perf_counter() - start < 4
@@ -0,0 +1,105 @@
+import sys
+import subprocess
+import numpy as np
+import pandas as pd
+from docker_bot.inventory import ImageInventory, ImageRecord
+
+
+def test_image_record():
+    manifest = {
+        "repo": "repo1",
+        "digest": "digest1",
+        "timestamp": "2020-07-30T19:56:00.0000000Z",
+        "tags": ["latest"],
+        "architecture": "amd64",
+    }
+
+    record = ImageRecord.from_manifest(manifest)
+
+    assert record == ImageRecord(
+        "repo1", "digest1", "2020-07-30T19:56:00.0000000Z", 0, "latest"
+    )
+    assert record.image_name == "repo1@digest1"
+    assert not hasattr(record, "__dict__")
+
+
+def test_image_inventory():
+    inventory = ImageInventory.from_manifests(
+        [
+            {"repo": "repo1", "digest": "digest1", "timestamp": "t1"},
+            {
+                "repo": "repo2",
+                "digest": "digest2",
+                "timestamp": "t2",
+                "imageSize": 2000,
+            },
+        ]
+    )
+    inventory.add(ImageRecord("repo1", "digest3", "t3", 3000))
+
+    assert len(inventory) == 3
+    assert inventory.repos == ["repo1", "repo2"]
+    assert list(inventory.repo) == ["repo1", "repo2", "repo1"]
+    assert inventory.digests == ["digest1", "digest2", "digest3"]
+    assert inventory.timestamps == ["t1", "t2", "t3"]
+    assert list(inventory.sizes) == [0, 2000, 3000]
+    assert list(inventory)[1] == ImageRecord("repo2", "digest2", "t2", 2000)
+    # Repository names are shared between records
+    records = list(inventory)
+    assert records[0].repo is records[2].repo
+
+
+def test_image_inventory_tags():
+    manifests = [
+        {"repo": "repo1", "digest": "digest1", "timestamp": "t1"},
+        {
+            "repo": "repo1",
+            "digest": "digest2",
+            "timestamp": "t2",
+            "tags": ["latest", "v1"],
+        },
+    ]
+
+    inventory = ImageInventory.from_manifests(manifests)
+    assert inventory.tags is None
+    assert list(inventory)[1].tags == ""
+
+    inventory = ImageInventory.from_manifests(manifests, keep_tags=True)
+    assert inventory.tags == ["", "latest,v1"]
+    assert list(inventory)[1].tags == "latest,v1"
+
+
+def test_image_inventory_empty():
+    inventory = ImageInventory()
+
+    assert len(inventory) == 0
+    assert list(inventory.repo) == []
+    assert list(inventory.sizes) == []
+
+
+def test_inventory_without_pandas():
+    # numpy and pandas can't be imported in this interpreter
+    script = """
+import sys
+sys.modules["numpy"] = sys.modules["pandas"] = None
+
+import datetime
+from docker_bot.app import compute_image_ages, sort_image_df
+
+out = compute_image_ages(
+    [
+        {"repo": "repo1", "digest": "digest1", "timestamp": "2020-05-01T10:00:00Z"},
+        {"repo": "repo1", "digest": "digest2", "timestamp": "2020-07-30T10:00:00Z"},
+    ],
+    now=datetime.datetime(2020, 8, 1),
+)
+print(type(out).__name__, list(sort_image_df(out, 90)["image_name"]))
+"""
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+    assert result.stdout.strip() == "ImageTable ['repo1@digest1']"
@@ -0,0 +1,110 @@
+import pytest
+from docker_bot.journal import DeletionJournal
+
+TASKS = [
+    ("repo", "repo1", 2),
+    ("image", "repo2@digest3", 1),
+    ("image", "repo2@digest4", 1),
+]
+COVERED = {"repo1": ["repo1@digest1", "repo1@digest2"]}
+
+
+def test_journal_remaining(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+
+    journal = DeletionJournal(path, sync_every=1)
+    journal.write_plan("test_acr", TASKS, COVERED)
+    journal.record_done("repo1")
+    journal.close()
+
+    resumed = DeletionJournal(path)
+    assert resumed.remaining("test_acr") == TASKS[1:]
+
+    resumed.record_done("repo2@digest4")
+    resumed.close()
+
+    assert DeletionJournal(path).remaining("test_acr") == [TASKS[1]]
+
+
+def test_journal_resumes_repo_by_image(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+
+    journal = DeletionJournal(path, sync_every=1)
+    journal.write_plan("test_acr", TASKS, COVERED)
+    journal.close()
+
+    # Images pushed to repo1 since the plan was made are left alone
+    resumed = DeletionJournal(path)
+    assert (
+        resumed.remaining("test_acr")
+        == [
+            ("image", "repo1@digest1", 1),
+            ("image", "repo1@digest2", 1),
+        ]
+        + TASKS[1:]
+    )
+
+    resumed.record_done("repo1@digest1")
+    resumed.close()
+
+    assert (
+        DeletionJournal(path).remaining("test_acr")
+        == [("image", "repo1@digest2", 1)] + TASKS[1:]
+    )
+
+
+def test_journal_repo_needs_images(tmp_path):
+    journal = DeletionJournal(str(tmp_path / "journal.jsonl"))
+
+    with pytest.raises(ValueError):
+        journal.write_plan("test_acr", TASKS)
+
+
+def test_journal_truncated_line(tmp_path):
+    path = tmp_path / "journal.jsonl"
+
+    journal = DeletionJournal(str(path))
+    journal.write_plan("test_acr", TASKS, COVERED)
+    journal.close()
+
+    # A crash part way through writing a completion
+    with open(str(path), "a") as f:
+        f.write('{"done": "rep')
+
+    resumed = DeletionJournal(str(path))
+    assert resumed.remaining("test_acr")[2:] == TASKS[1:]
+    resumed.record_done("repo2@digest3")
+    resumed.close()
+
+    assert DeletionJournal(str(path)).remaining("test_acr")[2:] == [TASKS[2]]
+
+
+def test_journal_plan_replaces_old_journal(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+
+    journal = DeletionJournal(path)
+    journal.write_plan("test_acr", TASKS, COVERED)
+    journal.record_done("repo1")
+    journal.write_plan("test_acr", TASKS[:1], COVERED)
+    journal.close()
+
+    assert DeletionJournal(path).remaining("test_acr") == [
+        ("image", "repo1@digest1", 1),
+        ("image", "repo1@digest2", 1),
+    ]
+
+
+def test_journal_wrong_acr(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+
+    journal = DeletionJournal(path)
+    journal.write_plan("test_acr", TASKS, COVERED)
+    journal.close()
+
+    with pytest.raises(RuntimeError):
+        DeletionJournal(path).remaining("other_acr")
+
+
+def test_journal_missing(tmp_path):
+    with pytest.raises(RuntimeError):
+        DeletionJournal(str(tmp_path / "journal.jsonl")).remaining("test_acr")
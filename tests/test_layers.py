@@ -0,0 +1,57 @@
+from unittest.mock import MagicMock
+from docker_bot.layers import LayerIndex, build_layer_index, manifest_blobs
+
+
+def make_body(*layers, config=None) -> dict:
+    body = {
+        "schemaVersion": 2,
+        "layers": [{"digest": d, "size": size} for d, size in layers],
+    }
+    if config is not None:
+        body["config"] = {"digest": config[0], "size": config[1]}
+    return body
+
+
+def test_manifest_blobs():
+    body = make_body(("l1", 100), ("l2", 200), config=("c1", 10))
+
+    assert manifest_blobs(body) == {"c1": 10, "l1": 100, "l2": 200}
+    assert manifest_blobs({"schemaVersion": 2, "manifests": []}) == {}
+
+
+def test_layer_index():
+    index = LayerIndex()
+    index.add("repo1@d1", make_body(("base", 1000), ("l1", 100)))
+    index.add("repo1@d2", make_body(("base", 1000), ("l2", 200)))
+    index.add("repo2@d3", make_body(("l2", 200), ("l3", 300)))
+
+    assert len(index) == 3
+    assert "repo1@d1" in index
+    assert index.total_bytes() == 1600
+    assert index.refs["base"] == {"repo1@d1", "repo1@d2"}
+
+    # d2 shares base with d1 and l2 with d3
+    assert index.reclaimable_bytes(["repo1@d2"]) == 0
+    assert index.reclaimable_bytes(["repo1@d1", "repo1@d2"]) == 1100
+    assert index.reclaimed_in_order(["repo1@d2", "repo2@d3", "repo1@d1"]) == [
+        0,
+        500,
+        1100,
+    ]
+    # Images that weren't indexed free nothing
+    assert index.reclaimable_bytes(["repo3@d4"]) == 0
+
+
+def test_build_layer_index():
+    registry = MagicMock()
+    registry.pull_manifest_body.side_effect = lambda image_name: make_body(
+        (image_name, 10), ("base", 1000)
+    )
+
+    index = build_layer_index(
+        registry, ["repo1@d1", "repo1@d2", "repo2@d3"], workers=2
+    )
+
+    assert len(index) == 3
+    assert index.total_bytes() == 1030
+    assert registry.pull_manifest_body.call_count == 3
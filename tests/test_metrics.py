@@ -0,0 +1,149 @@
+import json
+import pytest
+from docker_bot import metrics
+from docker_bot.metrics import (
+    RunMetrics,
+    collect_metrics,
+    instrument,
+    record_reclaimed,
+    watch_controller,
+)
+from docker_bot.throttle import ConcurrencyController
+
+
+@instrument("work")
+def work(fail=False):
+    if fail:
+        raise RuntimeError("failed")
+    return "done"
+
+
+@instrument("listing")
+def listing(n, fail=False):
+    for i in range(n):
+        yield i
+    if fail:
+        raise RuntimeError("failed")
+
+
+def test_instrument_disabled():
+    assert metrics.METRICS is None
+    assert work() == "done"
+    # Nothing to record into, and nothing breaks
+    record_reclaimed(100)
+
+
+def test_instrument_records_calls_and_errors():
+    run_metrics = RunMetrics()
+    metrics.set_metrics(run_metrics)
+    try:
+        assert work() == "done"
+        with pytest.raises(RuntimeError):
+            work(fail=True)
+    finally:
+        metrics.set_metrics(None)
+
+    stage = run_metrics.summary()["stages"]["work"]
+    assert stage["calls"] == 2
+    assert stage["errors"] == 1
+    assert stage["max_seconds"] >= stage["mean_seconds"] >= 0
+
+
+def test_instrument_generator():
+    run_metrics = RunMetrics()
+    metrics.set_metrics(run_metrics)
+    try:
+        assert list(listing(3)) == [0, 1, 2]
+        # Stopping early still records the call
+        items = listing(3)
+        next(items)
+        items.close()
+        with pytest.raises(RuntimeError):
+            list(listing(1, fail=True))
+    finally:
+        metrics.set_metrics(None)
+
+    stage = run_metrics.summary()["stages"]["listing"]
+    assert stage["calls"] == 3
+    assert stage["errors"] == 1
+    assert list(listing(2)) == [0, 1]
+
+
+def test_to_prometheus():
+    run_metrics = RunMetrics()
+    run_metrics.observe("delete_image", 0.2)
+    run_metrics.observe("delete_image", 7.0, error=True)
+    run_metrics.observe("delete_image", 1000.0)
+    run_metrics.add_reclaimed(5e9)
+
+    lines = run_metrics.to_prometheus().splitlines()
+
+    assert 'docker_bot_calls_total{stage="delete_image"} 3' in lines
+    assert 'docker_bot_errors_total{stage="delete_image"} 1' in lines
+    # Buckets are cumulative
+    assert (
+        'docker_bot_call_duration_seconds_bucket{stage="delete_image",le="0.1"} 0'
+        in lines
+    )
+    assert (
+        'docker_bot_call_duration_seconds_bucket{stage="delete_image",le="0.25"} 1'
+        in lines
+    )
+    assert (
+        'docker_bot_call_duration_seconds_bucket{stage="delete_image",le="10.0"} 2'
+        in lines
+    )
+    assert (
+        'docker_bot_call_duration_seconds_bucket{stage="delete_image",le="+Inf"} 3'
+        in lines
+    )
+    assert (
+        'docker_bot_call_duration_seconds_sum{stage="delete_image"} 1007.2'
+        in lines
+    )
+    assert "docker_bot_reclaimed_bytes 5000000000.0" in lines
+    assert "# TYPE docker_bot_call_duration_seconds histogram" in lines
+
+
+def test_concurrency_metrics(tmp_path):
+    prometheus = tmp_path / "docker_bot.prom"
+    summary = tmp_path / "summary.json"
+    controller = ConcurrencyController(initial=4, maximum=8)
+
+    with collect_metrics(str(prometheus), str(summary)):
+        watch_controller(controller)
+        watch_controller(controller)
+        controller.limit = 2.0
+        controller.throttled = 3
+
+    lines = prometheus.read_text().splitlines()
+    assert "docker_bot_concurrency_limit 2.0" in lines
+    assert "docker_bot_throttled_calls_total 3.0" in lines
+    assert json.loads(summary.read_text())["concurrency"] == {
+        "limit": 2,
+        "throttled": 3,
+    }
+
+
+def test_collect_metrics_writes_files_on_error(tmp_path):
+    prometheus = tmp_path / "docker_bot.prom"
+    summary = tmp_path / "summary.json"
+
+    with pytest.raises(RuntimeError):
+        with collect_metrics(str(prometheus), str(summary)):
+            work()
+            record_reclaimed(2e9)
+            work(fail=True)
+
+    assert metrics.METRICS is None
+    assert 'docker_bot_errors_total{stage="work"} 1' in prometheus.read_text()
+
+    result = json.loads(summary.read_text())
+    assert result["reclaimed_bytes"] == 2e9
+    assert result["stages"]["work"]["calls"] == 2
+
+
+def test_collect_metrics_disabled(tmp_path):
+    with collect_metrics() as run_metrics:
+        assert run_metrics is None
+        assert metrics.METRICS is None
@@ -0,0 +1,78 @@
+import json
+import pytest
+from unittest.mock import patch
+from docker_bot.multi import load_registries, registry_cache, run_many
+
+
+def test_load_registries(tmp_path):
+    path = tmp_path / "registries.json"
+    path.write_text(
+        json.dumps({"registries": ["acr1", {"name": "acr2", "max_age": 30}]})
+    )
+
+    out = load_registries(str(path), 90, 2.0)
+
+    assert out == [
+        {"name": "acr1", "max_age": 90, "limit": 2.0},
+        {"name": "acr2", "max_age": 30, "limit": 2.0},
+    ]
+
+
+def test_load_registries_without_name(tmp_path):
+    path = tmp_path / "registries.json"
+    path.write_text(json.dumps([{"limit": 1.0}]))
+
+    with pytest.raises(ValueError):
+        load_registries(str(path), 90, 2.0)
+
+
+def test_registry_cache():
+    assert registry_cache(None, "acr1") is None
+    assert registry_cache("/tmp/cache.db", "acr1") == "/tmp/cache-acr1.db"
+
+
+@patch("docker_bot.multi.run")
+@patch("docker_bot.multi.azure_login")
+def test_run_many(mock_login, mock_run):
+    mock_run.return_value = {"size": 1000.0, "deleted": 3}
+    registries = [
+        {"name": "acr1", "max_age": 90, "limit": 2.0},
+        {"name": "acr2", "max_age": 30, "limit": 1.0},
+    ]
+
+    report, failed = run_many(registries, workers=2, threads=4, dry_run=True)
+
+    mock_login.assert_called_once_with(identity=False)
+    assert mock_run.call_count == 2
+    calls = sorted(mock_run.call_args_list, key=lambda c: c[0][0])
+    assert [c[0] for c in calls] == [("acr1", 90, 2.0), ("acr2", 30, 1.0)]
+    # Every registry shares one controller and the Azure login
+    controllers = {id(c[1]["controller"]) for c in calls}
+    assert len(controllers) == 1
+    assert all(c[1]["logged_in"] and c[1]["dry_run"] for c in calls)
+    assert report["acr1"]["status"] == "ok"
+    assert report["acr2"]["deleted"] == 3
+    assert failed == []
+
+
+@patch("docker_bot.multi.run")
+@patch("docker_bot.multi.azure_login")
+def test_run_many_failure(mock_login, mock_run):
+    def run(acr_name, *args, **kwargs):
+        if acr_name == "acr1":
+            raise RuntimeError("Could not delete 1 images or repositories")
+        return {"size": 1000.0, "deleted": 1}
+
+    mock_run.side_effect = run
+    registries = [
+        {"name": "acr1", "max_age": 90, "limit": 2.0},
+        {"name": "acr2", "max_age": 90, "limit": 2.0},
+    ]
+
+    # The other registries are still cleaned
+    report, failed = run_many(registries)
+
+    assert mock_run.call_count == 2
+    assert failed == ["acr1"]
+    assert report["acr1"]["status"] == "failed"
+    assert report["acr2"]["deleted"] == 1
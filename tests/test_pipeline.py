@@ -0,0 +1,229 @@
+import pytest
+import asyncio
+import threading
+from freezegun import freeze_time
+from unittest.mock import patch
+from docker_bot.app import RegistryBackend
+from docker_bot.registry import RegistryClient
+from docker_bot.pipeline import run_async, stream_cleanup
+from docker_bot.throttle import ConcurrencyController, ThrottledError
+
+
+class StubBackend:
+    def __init__(self, repos: dict, size: float = 5000.0):
+        self.acr_name = "test_acr"
+        self.repos = repos
+        self.size = size
+        self.deleted = []
+        self.events = []
+
+    def login(self):
+        pass
+
+    def check_size(self, limit):
+        return self.size, self.size >= limit * 1.0e3
+
+    def pull_repos(self):
+        return list(self.repos)
+
+    def pull_manifests(self, repo):
+        self.events.append(("list", repo))
+        return [
+            {"digest": digest, "timestamp": timestamp, "repo": repo}
+            for digest, timestamp in self.repos[repo]
+        ]
+
+    def iter_manifests(self, repo, page_size=1000):
+        yield from self.pull_manifests(repo)
+
+    def delete_image(self, image_name):
+        self.events.append(("delete", image_name))
+        self.deleted.append(image_name)
+
+    def close(self):
+        pass
+
+
+def test_stream_cleanup(fake_registry):
+    registry = RegistryBackend("test_acr")
+    registry.client = RegistryClient(
+        fake_registry.login_server, refresh_token="secret-token", scheme="http"
+    )
+
+    with freeze_time("2020-08-01T09:30:00.0000000Z"):
+        stats = asyncio.run(
+            stream_cleanup(registry, 60, list_workers=2, delete_workers=2)
+        )
+
+    assert stats == {"repos": 2, "manifests": 3, "eligible": 2, "deleted": 2}
+    assert sorted(fake_registry.deleted) == [
+        "binder/image-a@sha256:a2",
+        "binder/image-b@sha256:b1",
+    ]
+
+
+def test_stream_cleanup_dry_run():
+    registry = StubBackend(
+        {"repo1": [("digest1", "2020-05-01T10:00:00.0000000Z")]}
+    )
+
+    with freeze_time("2020-08-01T09:30:00.0000000Z"):
+        stats = asyncio.run(stream_cleanup(registry, 60, dry_run=True))
+
+    assert stats["eligible"] == 1
+    assert stats["deleted"] == 0
+    assert registry.deleted == []
+
+
+def test_stream_cleanup_deletes_while_listing():
+    deleting = threading.Event()
+
+    class SlowBackend(StubBackend):
+        def pull_manifests(self, repo):
+            if repo == "slow":
+                # Only returns once a deletion from another repo has started
+                assert deleting.wait(timeout=5)
+            return super().pull_manifests(repo)
+
+        def delete_image(self, image_name):
+            deleting.set()
+            super().delete_image(image_name)
+
+    registry = SlowBackend(
+        {
+            "slow": [("digest1", "2020-05-01T10:00:00.0000000Z")],
+            "fast": [("digest2", "2020-05-01T10:00:00.0000000Z")],
+        }
+    )
+
+    with freeze_time("2020-08-01T09:30:00.0000000Z"):
+        asyncio.run(
+            stream_cleanup(registry, 60, list_workers=2, delete_workers=1)
+        )
+
+    assert registry.events.index(("delete", "fast@digest2")) < (
+        registry.events.index(("list", "slow"))
+    )
+    assert sorted(registry.deleted) == ["fast@digest2", "slow@digest1"]
+
+
+def test_stream_cleanup_exception():
+    class BrokenBackend(StubBackend):
+        def pull_manifests(self, repo):
+            raise RuntimeError("Could not run command")
+
+    registry = BrokenBackend({"repo1": [], "repo2": []})
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(stream_cleanup(registry, 60))
+
+
+def test_stream_cleanup_throttled_listing():
+    class ThrottledBackend(StubBackend):
+        throttle = True
+
+        def iter_manifests(self, repo, page_size=1000):
+            for i, manifest in enumerate(self.pull_manifests(repo)):
+                if i == 1 and self.throttle:
+                    self.throttle = False
+                    raise ThrottledError("Too many requests")
+                yield manifest
+
+    registry = ThrottledBackend(
+        {
+            "repo1": [
+                ("digest1", "2020-05-01T10:00:00.0000000Z"),
+                ("digest2", "2020-05-02T10:00:00.0000000Z"),
+                ("digest3", "2020-05-03T10:00:00.0000000Z"),
+            ]
+        }
+    )
+    controller = ConcurrencyController(initial=2, maximum=4, backoff=0)
+
+    with freeze_time("2020-08-01T09:30:00.0000000Z"):
+        stats = asyncio.run(
+            stream_cleanup(
+                registry,
+                60,
+                list_workers=1,
+                page_size=1,
+                controller=controller,
+            )
+        )
+
+    # The throttled page is listed again without repeating earlier pages,
+    # and the deleters see the lower limit too
+    assert stats["manifests"] == 3
+    assert sorted(registry.deleted) == [
+        "repo1@digest1",
+        "repo1@digest2",
+        "repo1@digest3",
+    ]
+    assert controller.throttled == 1
+
+
+def test_run_async_controller():
+    registry = StubBackend({"repo1": []})
+
+    with patch(
+        "docker_bot.pipeline.get_backend", return_value=registry
+    ), patch(
+        "docker_bot.pipeline.ConcurrencyController",
+        wraps=ConcurrencyController,
+    ) as controller:
+        asyncio.run(
+            run_async("test_acr", 60, 2.0, list_workers=4, delete_workers=2)
+        )
+
+    controller.assert_called_once_with(initial=4, maximum=6)
+
+
+def test_run_async_nothing_to_do():
+    registry = StubBackend({"repo1": []}, size=1.0)
+
+    with patch("docker_bot.pipeline.get_backend", return_value=registry):
+        stats = asyncio.run(run_async("test_acr", 60, 2.0))
+
+    assert stats["repos"] == 0
+    assert registry.events == []
+
+
+def test_run_async_purge():
+    registry = StubBackend(
+        {
+            "repo1": [
+                ("digest1", "2020-07-31T10:00:00.0000000Z"),
+                ("digest2", "2020-05-01T10:00:00.0000000Z"),
+            ]
+        },
+        size=1.0,
+    )
+
+    with patch(
+        "docker_bot.pipeline.get_backend", return_value=registry
+    ), freeze_time("2020-08-01T09:30:00.0000000Z"):
+        stats = asyncio.run(run_async("test_acr", 60, 2.0, purge=True))
+
+    assert stats["deleted"] == 2
+    assert sorted(registry.deleted) == ["repo1@digest1", "repo1@digest2"]
+
+
+def test_stream_cleanup_pages(fake_registry):
+    registry = RegistryBackend("test_acr")
+    registry.client = RegistryClient(
+        fake_registry.login_server, refresh_token="secret-token", scheme="http"
+    )
+
+    with freeze_time("2020-08-01T09:30:00.0000000Z"):
+        stats = asyncio.run(
+            stream_cleanup(registry, 60, list_workers=1, page_size=1)
+        )
+
+    assert stats["manifests"] == 3
+    assert stats["deleted"] == 2
+    # One request per page, plus the first one being challenged for a token
+    assert [
+        path
+        for method, path in fake_registry.requests
+        if path == "/acr/v1/binder/image-a/_manifests"
+    ] == ["/acr/v1/binder/image-a/_manifests"] * 3
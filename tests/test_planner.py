@@ -0,0 +1,132 @@
+import pandas as pd
+from docker_bot.layers import LayerIndex
+from docker_bot.planner import (
+    estimate_reclaimed_bytes,
+    plan_to_limit,
+    plan_with_layers,
+)
+
+
+def make_df(rows: list) -> pd.DataFrame:
+    image_df = pd.DataFrame(
+        rows, columns=["image_name", "repo", "age_days", "image_size"]
+    )
+    image_df["repo"] = image_df["repo"].astype("category")
+    return image_df
+
+
+def test_estimate_reclaimed_bytes():
+    image_df = make_df(
+        [
+            ("repo1@d1", "repo1", 100, 5 * 10**9),
+            ("repo1@d2", "repo1", 90, 3 * 10**9),
+            ("repo2@d3", "repo2", 80, 2 * 10**9),
+            ("repo2@d4", "repo2", 10, 1 * 10**9),
+        ]
+    )
+    candidates = image_df.iloc[[0, 1, 2]]
+
+    out = estimate_reclaimed_bytes(image_df, candidates)
+
+    # repo1 is emptied, so its 3 GB base is freed with its last image.
+    # repo2 keeps d4, so only d3's own 1 GB on top of the base is freed.
+    assert list(out) == [2 * 10**9, 3 * 10**9, 1 * 10**9]
+
+
+def test_plan_to_limit():
+    image_df = make_df(
+        [
+            ("repo1@d1", "repo1", 30, 2 * 10**9),
+            ("repo1@d2", "repo1", 200, 3 * 10**9),
+            ("repo2@d3", "repo2", 100, 4 * 10**9),
+            ("repo2@d4", "repo2", 150, 2 * 10**9),
+        ]
+    )
+
+    # 2 GB over a 0.001 TB limit
+    out = plan_to_limit(image_df, 3.0, 0.001, 90)
+
+    # d4 frees nothing while d3 still shares its base layers
+    assert list(out["image_name"]) == ["repo1@d2", "repo2@d4", "repo2@d3"]
+    assert list(out["reclaimed_bytes"]) == [1 * 10**9, 0, 4 * 10**9]
+
+
+def test_plan_to_limit_stops_once_under():
+    image_df = make_df(
+        [
+            ("repo1@d1", "repo1", 300, 5 * 10**9),
+            ("repo1@d2", "repo1", 200, 5 * 10**9),
+            ("repo1@d3", "repo1", 100, 1 * 10**9),
+        ]
+    )
+
+    out = plan_to_limit(image_df, 5.0, 0.001, 90)
+
+    assert list(out["image_name"]) == ["repo1@d1"]
+
+
+def test_plan_to_limit_under_limit():
+    image_df = make_df([("repo1@d1", "repo1", 300, 5 * 10**9)])
+
+    out = plan_to_limit(image_df, 1.0, 2.0, 90)
+
+    assert out.empty
+
+
+def test_plan_to_limit_unknown_sizes():
+    image_df = make_df(
+        [("repo1@d1", "repo1", 300, 0), ("repo1@d2", "repo1", 100, 0)]
+    )
+
+    out = plan_to_limit(image_df, 5000.0, 2.0, 90)
+
+    assert list(out["image_name"]) == ["repo1@d1", "repo1@d2"]
+
+
+def test_plan_with_layers():
+    image_df = make_df(
+        [
+            ("repo1@d1", "repo1", 300, 0),
+            ("repo1@d2", "repo1", 200, 0),
+            ("repo2@d3", "repo2", 150, 0),
+            ("repo2@d4", "repo2", 10, 0),
+            ("repo3@d5", "repo3", 100, 0),
+        ]
+    )
+    index = LayerIndex()
+    index.add("repo1@d1", {"layers": [{"digest": "a", "size": 10**9}]})
+    index.add("repo1@d2", {"layers": [{"digest": "a", "size": 10**9}]})
+    index.add("repo2@d3", {"layers": [{"digest": "b", "size": 3 * 10**9}]})
+    index.add("repo2@d4", {"layers": [{"digest": "c", "size": 10**9}]})
+    index.add("repo3@d5", {"layers": [{"digest": "d", "size": 2 * 10**9}]})
+
+    # 4 GB over a 0.001 TB limit
+    out = plan_with_layers(image_df, index, 5.0, 0.001, 90)
+
+    # d3 frees the most in one call, then d5. repo1 is deleted in one call
+    # but frees less.
+    assert list(out["image_name"]) == ["repo2@d3", "repo3@d5"]
+    assert list(out["reclaimed_bytes"]) == [3 * 10**9, 2 * 10**9]
+
+
+def test_plan_with_layers_whole_repos():
+    image_df = make_df(
+        [("repo1@d1", "repo1", 300, 0), ("repo1@d2", "repo1", 200, 0)]
+    )
+    index = LayerIndex()
+    index.add("repo1@d1", {"layers": [{"digest": "a", "size": 2 * 10**9}]})
+    index.add("repo1@d2", {"layers": [{"digest": "a", "size": 2 * 10**9}]})
+
+    out = plan_with_layers(image_df, index, 3.0, 0.002, 90)
+
+    # Neither image frees anything alone, but the repository does
+    assert list(out["image_name"]) == ["repo1@d1", "repo1@d2"]
+    assert list(out["reclaimed_bytes"]) == [0, 2 * 10**9]
+
+
+def test_plan_with_layers_under_limit():
+    image_df = make_df([("repo1@d1", "repo1", 300, 0)])
+
+    out = plan_with_layers(image_df, LayerIndex(), 1.0, 2.0, 90)
+
+    assert out.empty
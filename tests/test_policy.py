@@ -0,0 +1,189 @@
+import csv
+import json
+import pytest
+import datetime
+from unittest.mock import patch
+from docker_bot.app import compute_image_ages
+from docker_bot.policy import (
+    RetentionPolicy,
+    RetentionRule,
+    apply_policy,
+    load_policy,
+)
+
+NOW = datetime.datetime(2020, 8, 1)
+
+
+def make_manifests():
+    manifests = []
+    for month, tags in enumerate([["latest"], ["v1.0"], [], ["main"]]):
+        manifests.append(
+            {
+                "repo": "releases/app",
+                "digest": "sha256:r%d" % month,
+                "timestamp": "2020-0%d-01T00:00:00Z" % (month + 1),
+                "tags": tags,
+            }
+        )
+    for month in range(3):
+        manifests.append(
+            {
+                "repo": "dev",
+                "digest": "sha256:d%d" % month,
+                "timestamp": "2020-0%d-01T00:00:00Z" % (month + 5),
+                "tags": ["latest"] if month == 0 else [],
+            }
+        )
+    return manifests
+
+
+def make_policy():
+    return RetentionPolicy(
+        60,
+        [
+            RetentionRule(
+                "releases",
+                "releases/*",
+                max_age=150,
+                keep_last=1,
+                protect=["latest", "v*"],
+            )
+        ],
+    )
+
+
+def test_rule_protects_whole_tags():
+    rule = RetentionRule("rule", protect=["v*", "stable"])
+
+    assert rule.tag_pattern.search("v1.0")
+    assert rule.tag_pattern.search("main,stable")
+    assert not rule.tag_pattern.search("unstable")
+    assert not rule.tag_pattern.search("dev-v1")
+    assert not rule.tag_pattern.search("")
+
+
+def test_policy_rule_index():
+    policy = make_policy()
+
+    assert policy.rule_index("releases/app") == 0
+    assert policy.rule_index("releases") == 1
+    assert policy.rule_index("dev") == 1
+    assert policy.rules[1].name == "default"
+    assert policy.rules[1].max_age == 60
+
+
+def test_policy_needs_different_rule_names():
+    with pytest.raises(ValueError):
+        RetentionPolicy(60, [RetentionRule("default", "dev")])
+
+
+def test_policy_listing_max_age():
+    assert make_policy().listing_max_age() is None
+    assert (
+        RetentionPolicy(60, [RetentionRule("dev", "dev", 7)]).listing_max_age()
+        == 7
+    )
+
+
+@pytest.mark.parametrize("backend", ["pandas", "array"])
+def test_policy_evaluate(backend):
+    with patch("docker_bot.inventory.INVENTORY_BACKEND", backend):
+        image_df = compute_image_ages(make_manifests(), now=NOW)
+        decisions = make_policy().evaluate(image_df)
+
+    assert list(zip(decisions["rule"], decisions["reason"])) == [
+        ("releases", "protected"),
+        ("releases", "protected"),
+        ("releases", "expired"),
+        ("releases", "keep-last"),
+        ("default", "expired"),
+        ("default", "expired"),
+        ("default", "too-young"),
+    ]
+    assert list(decisions["delete"]) == [
+        False,
+        False,
+        True,
+        False,
+        True,
+        True,
+        False,
+    ]
+
+
+@pytest.mark.parametrize("backend", ["pandas", "array"])
+def test_policy_keep_last_same_day(backend):
+    manifests = [
+        {
+            "repo": "r",
+            "digest": "sha256:%s" % digest,
+            "timestamp": "2020-06-01T%s:00:00Z" % hour,
+            "tags": [],
+        }
+        for digest, hour in [("older", "13"), ("newest", "20")]
+    ]
+
+    with patch("docker_bot.inventory.INVENTORY_BACKEND", backend):
+        image_df = compute_image_ages(manifests, now=NOW)
+        decisions = RetentionPolicy(30, keep_last=1).evaluate(image_df)
+
+    assert list(decisions["reason"]) == ["expired", "keep-last"]
+
+
+@pytest.mark.parametrize("backend", ["pandas", "array"])
+def test_apply_policy(tmp_path, backend):
+    report = tmp_path / "decisions.csv"
+
+    with patch("docker_bot.inventory.INVENTORY_BACKEND", backend):
+        image_df = compute_image_ages(make_manifests(), now=NOW)
+        to_delete = apply_policy(make_policy(), image_df, report=str(report))
+
+    assert list(to_delete["image_name"]) == [
+        "releases/app@sha256:r2",
+        "dev@sha256:d0",
+        "dev@sha256:d1",
+    ]
+
+    with open(report) as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 7
+    assert rows[0] == {
+        "image_name": "releases/app@sha256:r0",
+        "rule": "releases",
+        "reason": "protected",
+        "delete": "False",
+    }
+
+
+def test_load_policy(tmp_path):
+    path = tmp_path / "policy.json"
+    path.write_text(
+        json.dumps(
+            {
+                "protect": ["latest"],
+                "rules": [
+                    {"repos": "ci/*", "max_age": 7},
+                    {
+                        "name": "releases",
+                        "repos": "releases/*",
+                        "keep_last": 5,
+                    },
+                ],
+            }
+        )
+    )
+
+    policy = load_policy(str(path), 90)
+
+    assert [rule.name for rule in policy.rules] == [
+        "ci/*",
+        "releases",
+        "default",
+    ]
+    assert [rule.max_age for rule in policy.rules] == [7, 90, 90]
+    assert policy.rules[1].keep_last == 5
+    assert policy.rules[2].protect == ["latest"]
+
+    path.write_text(json.dumps({"rules": [{"max_age": 7}]}))
+    with pytest.raises(ValueError):
+        load_policy(str(path), 90)
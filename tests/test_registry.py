@@ -0,0 +1,216 @@
+import time
+import pytest
+import requests
+from docker_bot.credentials import TokenCache
+from docker_bot.registry import RegistryClient, parse_challenge
+from docker_bot.throttle import ThrottledError
+
+
+def test_parse_challenge():
+    header = 'Bearer realm="https://test.azurecr.io/oauth2/token",service="test.azurecr.io",scope="registry:catalog:*"'
+
+    out = parse_challenge(header)
+
+    assert out == {
+        "scheme": "bearer",
+        "realm": "https://test.azurecr.io/oauth2/token",
+        "service": "test.azurecr.io",
+        "scope": "registry:catalog:*",
+    }
+
+
+def test_list_repos(fake_registry):
+    client = RegistryClient(
+        fake_registry.login_server, refresh_token="secret-token", scheme="http"
+    )
+
+    out = client.list_repos(page_size=1)
+
+    assert out == ["binder/image-a", "binder/image-b"]
+    # One token for the catalog scope, reused across pages
+    assert len(fake_registry.token_requests) == 1
+    assert fake_registry.token_requests[0]["scope"] == ["registry:catalog:*"]
+
+
+def test_list_manifests(fake_registry):
+    client = RegistryClient(
+        fake_registry.login_server, refresh_token="secret-token", scheme="http"
+    )
+
+    out = client.list_manifests("binder/image-a", page_size=1)
+
+    assert out == [
+        {
+            "digest": "sha256:a1",
+            "tags": ["latest"],
+            "timestamp": "2020-07-30T19:56:00.0000000Z",
+            "imageSize": 1000,
+            "repo": "binder/image-a",
+        },
+        {
+            "digest": "sha256:a2",
+            "tags": [],
+            "timestamp": "2020-05-01T10:00:00.0000000Z",
+            "imageSize": 2000,
+            "repo": "binder/image-a",
+        },
+    ]
+
+
+def test_delete_manifest(fake_registry):
+    client = RegistryClient(
+        fake_registry.login_server, refresh_token="secret-token", scheme="http"
+    )
+
+    client.delete_manifest("binder/image-b", "sha256:b1")
+    # Deleting twice is not an error
+    client.delete_manifest("binder/image-b", "sha256:b1")
+
+    assert fake_registry.deleted == ["binder/image-b@sha256:b1"]
+    assert fake_registry.repos["binder/image-b"] == []
+
+
+def test_bad_token(fake_registry):
+    client = RegistryClient(
+        fake_registry.login_server, refresh_token="wrong-token", scheme="http"
+    )
+
+    with pytest.raises(RuntimeError):
+        client.list_repos()
+
+
+def test_missing_repo(fake_registry):
+    client = RegistryClient(
+        fake_registry.login_server, refresh_token="secret-token", scheme="http"
+    )
+
+    with pytest.raises(RuntimeError):
+        client.list_manifests("not-a-repo")
+
+
+def test_delete_repo(fake_registry):
+    client = RegistryClient(
+        fake_registry.login_server, refresh_token="secret-token", scheme="http"
+    )
+
+    client.delete_repo("binder/image-a")
+    # Deleting twice is not an error
+    client.delete_repo("binder/image-a")
+
+    assert fake_registry.deleted == [
+        "binder/image-a@sha256:a1",
+        "binder/image-a@sha256:a2",
+    ]
+    assert "binder/image-a" not in fake_registry.repos
+
+
+def test_get_repo(fake_registry):
+    client = RegistryClient(
+        fake_registry.login_server, refresh_token="secret-token", scheme="http"
+    )
+
+    out = client.get_repo("binder/image-a")
+
+    assert out["manifestCount"] == 2
+    assert out["lastUpdateTime"] == "2020-07-30T19:56:00.0000000Z"
+
+
+def test_get_manifest(fake_registry):
+    fake_registry.repos["binder/image-a"][0]["layers"] = [
+        {"digest": "sha256:l1", "size": 100}
+    ]
+    client = RegistryClient(
+        fake_registry.login_server, refresh_token="secret-token", scheme="http"
+    )
+
+    out = client.get_manifest("binder/image-a", "sha256:a1")
+
+    assert out["layers"] == [{"digest": "sha256:l1", "size": 100}]
+    with pytest.raises(RuntimeError):
+        client.get_manifest("binder/image-a", "sha256:missing")
+
+
+def test_iter_manifests(fake_registry):
+    client = RegistryClient(
+        fake_registry.login_server, refresh_token="secret-token", scheme="http"
+    )
+
+    manifests = client.iter_manifests("binder/image-a", page_size=1)
+    first = next(manifests)
+
+    # Only the first page has been requested so far
+    assert first["digest"] == "sha256:a1"
+    assert (
+        fake_registry.requests.count(
+            ("GET", "/acr/v1/binder/image-a/_manifests")
+        )
+        == 2
+    )
+    assert [m["digest"] for m in manifests] == ["sha256:a2"]
+
+
+def test_iter_manifests_oldest_first(fake_registry):
+    client = RegistryClient(
+        fake_registry.login_server, refresh_token="secret-token", scheme="http"
+    )
+
+    # The ordering has to be carried over to the continuation pages
+    manifests = client.iter_manifests(
+        "binder/image-a", page_size=1, oldest_first=True
+    )
+
+    assert [m["digest"] for m in manifests] == ["sha256:a2", "sha256:a1"]
+
+
+def test_throttled_response():
+    client = RegistryClient("myacr.azurecr.io")
+    resp = requests.Response()
+    resp.status_code = 429
+    resp.headers["Retry-After"] = "5"
+    resp.request = requests.Request("GET", "https://myacr/v2/").prepare()
+
+    with pytest.raises(ThrottledError) as err:
+        client._check(resp)
+
+    assert err.value.retry_after == 5.0
+
+
+def test_token_cache_reused_by_next_client(fake_registry, tmp_path):
+    path = str(tmp_path / "tokens.json")
+
+    client = RegistryClient(
+        fake_registry.login_server,
+        refresh_token="secret-token",
+        scheme="http",
+        token_cache=TokenCache(path),
+    )
+    client.list_repos()
+    client.close()
+
+    client = RegistryClient(
+        fake_registry.login_server,
+        refresh_token="secret-token",
+        scheme="http",
+        token_cache=TokenCache(path),
+    )
+    client.list_repos()
+    client.close()
+
+    assert len(fake_registry.token_requests) == 1
+
+
+def test_token_refreshed_before_expiry(fake_registry):
+    client = RegistryClient(
+        fake_registry.login_server, refresh_token="secret-token", scheme="http"
+    )
+    client.list_repos()
+
+    # Close enough to expiring to be refreshed, but still used
+    token, _ = client._tokens["registry:catalog:*"]
+    client._tokens["registry:catalog:*"] = (token, time.time() + 60)
+    client.list_repos()
+    client.close()
+
+    assert len(fake_registry.token_requests) == 2
+    _, expires = client._tokens["registry:catalog:*"]
+    assert expires > time.time() + 60
@@ -0,0 +1,133 @@
+import sys
+import json
+import pytest
+import datetime
+import subprocess
+from conftest import FakeRegistry
+from docker_bot.sharding import (
+    merge_reports,
+    parse_shard,
+    shard_of,
+    shard_repos,
+    write_shard_report,
+)
+
+# Cleans one shard of the fake registry at argv[1] in its own process
+CLEAN_SHARD = """
+import sys
+from unittest.mock import patch
+from docker_bot.app import RegistryBackend, run
+from docker_bot.registry import RegistryClient
+from docker_bot.sharding import write_shard_report
+
+login_server, index, count, report = sys.argv[1:]
+shard = (int(index), int(count))
+
+registry = RegistryBackend("test_acr")
+registry.client = RegistryClient(
+    login_server, refresh_token="secret-token", scheme="http"
+)
+
+with patch.object(registry, "login"), patch.object(
+    registry, "check_size", return_value=(5000.0, True)
+), patch("docker_bot.app.get_backend", return_value=registry):
+    result = run("test_acr", 90, 2.0, shard=shard)
+
+write_shard_report(report, "test_acr", shard, result)
+"""
+
+
+def test_parse_shard():
+    assert parse_shard("0/4") == (0, 4)
+    assert parse_shard("3/4") == (3, 4)
+
+    for value in ["4/4", "-1/4", "0/0", "1", "a/b", "1/2/3"]:
+        with pytest.raises(ValueError):
+            parse_shard(value)
+
+
+def test_shard_repos():
+    repos = ["repo%d" % i for i in range(100)]
+
+    shards = [shard_repos(repos, index, 4) for index in range(4)]
+
+    # Every repository is in exactly one shard, the same one every time
+    assert sorted(sum(shards, [])) == sorted(repos)
+    assert all(shard_of(repo, 4) == 2 for repo in shards[2])
+    assert shard_of("repo1", 4) == shard_of("repo1", 4)
+    assert min(len(shard) for shard in shards) > 10
+
+
+def test_merge_reports(tmp_path):
+    paths = []
+    for index, size, finished in [(0, 1500.0, 2.0), (1, 1400.0, 3.0)]:
+        path = str(tmp_path / ("shard%d.json" % index))
+        write_shard_report(
+            path, "test_acr", (index, 3), {"size": size, "deleted": index + 2}
+        )
+        with open(path) as f:
+            report = json.load(f)
+        report["finished"] = finished
+        with open(path, "w") as f:
+            json.dump(report, f)
+        paths.append(path)
+
+    merged = merge_reports(paths)
+
+    assert merged == {
+        "acr": "test_acr",
+        "shards": 3,
+        "missing": [2],
+        "deleted": 5,
+        "size": 1400.0,
+    }
+
+    other = str(tmp_path / "other.json")
+    write_shard_report(other, "other_acr", (2, 3), {"size": 1.0, "deleted": 0})
+    with pytest.raises(ValueError):
+        merge_reports(paths + [other])
+
+
+def test_clean_shards_in_processes(tmp_path):
+    new = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.0000000Z")
+    repos = {
+        "repo%d"
+        % i: [
+            {"digest": "old%d" % i, "lastUpdateTime": "2020-01-01T00:00:00Z"},
+            {"digest": "new%d" % i, "lastUpdateTime": new},
+        ]
+        for i in range(12)
+    }
+    repos["stale"] = [
+        {"digest": "old", "lastUpdateTime": "2020-01-01T00:00:00Z"}
+    ]
+    old = sorted(
+        "%s@%s" % (repo, manifest["digest"])
+        for repo, manifests in repos.items()
+        for manifest in manifests
+        if manifest["digest"].startswith("old")
+    )
+    paths = [str(tmp_path / ("shard%d.json" % index)) for index in range(3)]
+
+    with FakeRegistry(repos, token="secret-token") as registry:
+        workers = [
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    "-c",
+                    CLEAN_SHARD,
+                    registry.login_server,
+                    str(index),
+                    "3",
+                    path,
+                ]
+            )
+            for index, path in enumerate(paths)
+        ]
+        assert [worker.wait(timeout=60) for worker in workers] == [0, 0, 0]
+
+    # Each old image was deleted once, by the worker for its shard
+    assert sorted(registry.deleted) == old
+    merged = merge_reports(paths)
+    assert merged["missing"] == []
+    assert merged["deleted"] == len(old)
@@ -0,0 +1,83 @@
+from array import array
+from docker_bot.table import ImageTable
+
+
+def make_table() -> ImageTable:
+    return ImageTable.from_columns(
+        ["repo1", "repo2", "repo1"],
+        ["digest1", "digest2", "digest3"],
+        [10, 30, 20],
+        [100, 200, 300],
+    )
+
+
+def test_from_columns():
+    table = make_table()
+
+    assert len(table) == 3
+    assert table.columns == [
+        "image_name",
+        "repo",
+        "digest",
+        "age_days",
+        "image_size",
+        "tags",
+        "timestamp",
+    ]
+    assert list(table["image_name"]) == [
+        "repo1@digest1",
+        "repo2@digest2",
+        "repo1@digest3",
+    ]
+    assert isinstance(table["age_days"].values, array)
+    assert list(table["image_size"]) == [100, 200, 300]
+
+
+def test_from_columns_unknown_sizes():
+    table = ImageTable.from_columns(["repo1"], ["digest1"], [10])
+
+    assert list(table["image_size"]) == [0]
+
+
+def test_filter_with_mask():
+    table = make_table()
+
+    out = table.loc[table["age_days"] >= 20].reset_index(drop=True)
+
+    assert list(out["image_name"]) == ["repo2@digest2", "repo1@digest3"]
+    assert list(out["age_days"]) == [30, 20]
+    assert list(out.index) == [0, 1]
+    assert table.loc[table["age_days"] > 30].empty
+
+
+def test_sort_values():
+    table = ImageTable.from_columns(
+        ["repo1", "repo1", "repo1"], ["a", "b", "c"], [10, 20, 10]
+    )
+
+    out = table.sort_values("age_days", ascending=False)
+
+    # Equal ages keep their order
+    assert list(out["digest"]) == ["b", "a", "c"]
+
+
+def test_set_and_reset_index():
+    table = make_table().set_index("image_name")
+
+    assert "image_name" not in table.columns
+    assert list(table.index)[0] == "repo1@digest1"
+
+    out = table.loc[table["age_days"] < 20]
+    assert list(out.index) == ["repo1@digest1"]
+
+    out = out.reset_index()
+    assert out.columns[0] == "image_name"
+    assert list(out["image_name"]) == ["repo1@digest1"]
+
+
+def test_concat():
+    out = ImageTable.concat([make_table(), make_table()])
+
+    assert len(out) == 6
+    assert list(out["age_days"]) == [10, 30, 20, 10, 30, 20]
+    assert len(make_table()) == 3
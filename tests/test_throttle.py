@@ -0,0 +1,110 @@
+import time
+import pytest
+import threading
+from unittest.mock import MagicMock, patch
+from docker_bot.throttle import (
+    ConcurrencyController,
+    ThrottledError,
+    is_throttled,
+    parse_retry_after,
+)
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("3") == 3.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+    # A date in the past means retry straight away
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+
+
+def test_is_throttled():
+    assert is_throttled(ThrottledError("slow down"))
+    assert is_throttled(RuntimeError("(TooManyRequests) Too many requests"))
+    assert is_throttled(RuntimeError("Operation returned status 503"))
+    assert not is_throttled(RuntimeError("(ResourceNotFound) Not found"))
+    assert is_throttled(
+        RuntimeError("DELETE https://acr/v2/repo returned 502: Bad Gateway")
+    )
+    assert is_throttled(RuntimeError("(503) The server is overloaded"))
+    assert not is_throttled(
+        RuntimeError(
+            "DELETE https://acr/v2/team-503/app/manifests/sha256:abc "
+            "returned 403: denied"
+        )
+    )
+
+
+@patch("docker_bot.throttle.time.sleep")
+def test_controller_retries_throttled_calls(mock_sleep):
+    controller = ConcurrencyController(initial=4, maximum=8, backoff=0.0)
+    func = MagicMock(
+        side_effect=[ThrottledError("429", retry_after=2.0), "done"]
+    )
+
+    assert controller.call(func, "arg") == "done"
+    assert func.call_count == 2
+    mock_sleep.assert_called_once_with(2.0)
+    assert controller.current == 2
+    assert controller.snapshot()["throttled"] == 1
+
+
+@patch("docker_bot.throttle.time.sleep")
+def test_controller_gives_up(mock_sleep):
+    controller = ConcurrencyController(retries=2, backoff=0.0)
+    func = MagicMock(side_effect=ThrottledError("429"))
+
+    with pytest.raises(ThrottledError):
+        controller.call(func)
+
+    assert func.call_count == 3
+    assert controller.current == controller.minimum
+    assert controller.snapshot()["in_flight"] == 0
+
+
+def test_controller_does_not_retry_other_errors():
+    controller = ConcurrencyController()
+    func = MagicMock(side_effect=RuntimeError("Not found"))
+
+    with pytest.raises(RuntimeError):
+        controller.call(func)
+
+    assert func.call_count == 1
+
+
+def test_controller_adapts_to_latency():
+    controller = ConcurrencyController(
+        initial=2, maximum=3, target_latency=0.05
+    )
+
+    for _ in range(5):
+        controller.call(lambda: None)
+    assert controller.current == 3
+
+    controller.call(time.sleep, 0.06)
+    assert controller.current == 2
+
+
+def test_controller_limits_calls_in_flight():
+    controller = ConcurrencyController(initial=2, maximum=2)
+    lock = threading.Lock()
+    state = {"running": 0, "peak": 0}
+
+    def work():
+        with lock:
+            state["running"] += 1
+            state["peak"] = max(state["peak"], state["running"])
+        time.sleep(0.01)
+        with lock:
+            state["running"] -= 1
+
+    threads = [
+        threading.Thread(target=controller.call, args=(work,))
+        for _ in range(6)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert state["peak"] == 2
@@ -0,0 +1,104 @@
+from unittest.mock import MagicMock, call, patch
+from docker_bot.usage import UsageMonitor
+
+
+def make_registry(*sizes) -> MagicMock:
+    registry = MagicMock()
+    registry.check_size.side_effect = [
+        (size, size >= 2000.0) for size in sizes
+    ]
+    return registry
+
+
+def test_read_reuses_fresh_reading():
+    registry = make_registry(2100.0, 2050.0)
+    monitor = UsageMonitor(registry, 2.0)
+
+    assert monitor.read() == (2100.0, True)
+    assert monitor.read() == (2100.0, True)
+    assert registry.check_size.call_args_list == [call(2.0)]
+
+    # Deleting anything makes the reading stale
+    monitor.record_deleted(1, 0)
+    assert monitor.read() == (2050.0, True)
+    assert registry.check_size.call_count == 2
+
+
+def test_read_after_ttl():
+    registry = make_registry(2100.0, 2100.0)
+    monitor = UsageMonitor(registry, 2.0, ttl=0)
+
+    monitor.read()
+    monitor.read()
+
+    assert registry.check_size.call_count == 2
+
+
+def test_estimate():
+    monitor = UsageMonitor(make_registry(2100.0), 2.0)
+    monitor.read()
+
+    monitor.record_deleted(2, 60.0e9)
+    monitor.record_deleted(1, 20.0e9)
+
+    assert monitor.estimate() == 2020.0
+
+
+def test_under_limit_only_reads_when_estimated_under():
+    registry = make_registry(2100.0, 1990.0)
+    monitor = UsageMonitor(registry, 2.0)
+    monitor.read()
+
+    monitor.record_deleted(1, 60.0e9)
+    assert not monitor.under_limit()
+    assert registry.check_size.call_count == 1
+
+    monitor.record_deleted(1, 60.0e9)
+    assert monitor.under_limit()
+    assert monitor.size == 1990.0
+    assert registry.check_size.call_count == 2
+
+    # Once under the limit, it isn't read again
+    assert monitor.under_limit()
+    assert monitor.read() == (1990.0, False)
+    assert registry.check_size.call_count == 2
+
+
+@patch("docker_bot.usage.time.sleep")
+def test_under_limit_waits_for_usage_to_catch_up(mock_sleep):
+    registry = make_registry(2100.0, 2100.0, 2100.0, 1950.0)
+    monitor = UsageMonitor(registry, 2.0, backoff=5.0)
+    monitor.read()
+
+    monitor.record_deleted(3, 150.0e9)
+
+    assert monitor.under_limit()
+    assert registry.check_size.call_count == 4
+    assert mock_sleep.call_args_list == [call(5.0), call(10.0)]
+
+
+@patch("docker_bot.usage.time.sleep")
+def test_under_limit_still_over(mock_sleep):
+    registry = make_registry(2100.0, 2060.0)
+    monitor = UsageMonitor(registry, 2.0)
+    monitor.read()
+
+    # Shared layers freed less than the images' sizes
+    monitor.record_deleted(3, 150.0e9)
+
+    assert not monitor.under_limit()
+    assert monitor.estimate() == 2060.0
+    mock_sleep.assert_not_called()
+
+
+@patch("docker_bot.usage.time.sleep")
+def test_under_limit_gives_up_polling(mock_sleep):
+    registry = make_registry(*[2100.0] * 4)
+    monitor = UsageMonitor(registry, 2.0, polls=2)
+    monitor.read()
+
+    monitor.record_deleted(3, 150.0e9)
+
+    assert not monitor.under_limit()
+    assert registry.check_size.call_count == 4
+    assert mock_sleep.call_count == 2